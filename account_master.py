@@ -0,0 +1,187 @@
+"""
+勘定科目一覧（ショートカット2 = 勘定科目コード）から作る勘定科目マスタ。
+
+推移表の行は（勘定科目コード, 勘定科目）の組で勘定科目マスタの行位置に対応付けます。
+勘定科目一覧は月ごとにほとんど変わらないので、作成したマスタを内容のハッシュを名前にした
+JSON ファイルに保存し、同じ勘定科目一覧では読み込み直さずに使います。
+"""
+import hashlib
+import json
+import os
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import Dict, List, Optional, Tuple, Union
+
+import numpy as np
+import pandas as pd
+
+from diagnostics import stage
+from freee_reader import read_kamoku_csv
+
+FORMAT_VERSION = 1
+
+# 保存先（環境変数 FREEE_CACHE_DIR で変更できる）
+CACHE_DIR = Path(os.environ.get("FREEE_CACHE_DIR", Path.home() / ".cache" / "for_freee"))
+
+Code = Union[int, float, str, None]
+
+
+def _is_missing(value) -> bool:
+    return value is None or (isinstance(value, float) and np.isnan(value)) or value is pd.NA
+
+
+def code_label(value) -> Optional[str]:
+    """勘定科目コードの比較用の文字列（101 と 101.0 は同じ "101"、空欄は None）"""
+    if _is_missing(value):
+        return None
+    if isinstance(value, (float, np.floating)) and float(value).is_integer():
+        return str(int(value))
+    if isinstance(value, (int, np.integer)):
+        return str(int(value))
+    return str(value).strip()
+
+
+def _python_value(value) -> Code:
+    """JSON に保存できる値（空欄は None）"""
+    if _is_missing(value):
+        return None
+    if isinstance(value, (np.integer, np.floating)):
+        return value.item()
+    return value
+
+
+@dataclass
+class AccountMaster:
+    """
+    勘定科目一覧の（勘定科目コード, 勘定科目, 小分類）。
+    行は勘定科目一覧の順で、同じ組の重複は除いてある。
+    """
+    code_values: List[Code]         # 勘定科目一覧の勘定科目コード（空欄は None）
+    names: List[Optional[str]]
+    categories: List[Optional[str]]
+    digest: str = ""                # 元の CSV の内容のハッシュ
+    codes: np.ndarray = field(init=False, repr=False)   # 整数の勘定科目コード（整数でなければ -1）
+    category_index: Dict[Optional[str], Optional[str]] = field(init=False, repr=False)  # 勘定科目 → 小分類
+    code_index: Dict[Optional[str], List[int]] = field(init=False, repr=False)          # 勘定科目コード → 行位置
+    _key_index: Dict[Tuple[Optional[str], Optional[str]], List[int]] = field(init=False, repr=False)
+
+    def __post_init__(self):
+        labels = [code_label(v) for v in self.code_values]
+        self.codes = np.array(
+            [int(c) if c is not None and c.lstrip("-").isdigit() else -1 for c in labels], dtype=np.int64
+        )
+        self.category_index = {}
+        self.code_index = {}
+        self._key_index = {}
+        for i, (code, name, category) in enumerate(zip(labels, self.names, self.categories)):
+            self.category_index.setdefault(name, category)
+            self.code_index.setdefault(code, []).append(i)
+            self._key_index.setdefault((code, name), []).append(i)
+
+    def __len__(self) -> int:
+        return len(self.names)
+
+    @classmethod
+    def from_frame(cls, kamoku_df: pd.DataFrame, digest: str = "") -> "AccountMaster":
+        """read_kamoku_csv で読み込んだ勘定科目一覧から作る。"""
+        accounts = kamoku_df[["勘定科目コード", "勘定科目", "小分類"]].astype(object).drop_duplicates()
+        return cls(
+            code_values=[_python_value(v) for v in accounts["勘定科目コード"]],
+            names=[None if _is_missing(v) else str(v) for v in accounts["勘定科目"]],
+            categories=[None if _is_missing(v) else str(v) for v in accounts["小分類"]],
+            digest=digest,
+        )
+
+    @property
+    def accounts(self) -> pd.DataFrame:
+        """勘定科目コード・勘定科目・小分類 の DataFrame"""
+        return pd.DataFrame({
+            "勘定科目コード": pd.Series(self.code_values, dtype=None if self.code_values else "float64"),
+            "勘定科目": pd.Series(self.names, dtype=object),
+            "小分類": pd.Series(self.categories, dtype=object),
+        })
+
+    def locate(self, codes: pd.Series, names: pd.Series) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        推移表の各行を（勘定科目コード, 勘定科目）が一致するマスタの行に対応付け、
+        (推移表の行位置, マスタの行位置) の配列を返す。一致しない行は含まない。
+        """
+        code_ids, code_uniques = pd.factorize(codes.astype(object), use_na_sentinel=False)
+        name_ids, name_uniques = pd.factorize(names.astype(object), use_na_sentinel=False)
+        combined = code_ids.astype(np.int64) * max(len(name_uniques), 1) + name_ids
+        keys, inverse = np.unique(combined, return_inverse=True)
+
+        matches = []
+        for key in keys:
+            code = code_label(code_uniques[key // max(len(name_uniques), 1)])
+            name = name_uniques[key % max(len(name_uniques), 1)]
+            matches.append(self._key_index.get((code, None if _is_missing(name) else str(name)), []))
+
+        if all(len(m) <= 1 for m in matches):
+            first = np.array([m[0] if m else -1 for m in matches], dtype=np.intp)[inverse]
+            rows = np.flatnonzero(first >= 0)
+            return rows, first[rows]
+        # 同じ（勘定科目コード, 勘定科目）が小分類違いで複数ある場合は、その全ての行に対応付ける
+        counts = np.array([len(m) for m in matches], dtype=np.intp)[inverse]
+        rows = np.repeat(np.arange(len(inverse)), counts)
+        positions = np.array([p for i in inverse for p in matches[i]], dtype=np.intp)
+        return rows, positions
+
+    def to_dict(self) -> dict:
+        return {
+            "version": FORMAT_VERSION,
+            "digest": self.digest,
+            "code_values": self.code_values,
+            "names": self.names,
+            "categories": self.categories,
+        }
+
+    @classmethod
+    def from_dict(cls, data: dict) -> "AccountMaster":
+        if data.get("version") != FORMAT_VERSION:
+            raise ValueError("勘定科目マスタの形式が異なります")
+        return cls(data["code_values"], data["names"], data["categories"], data.get("digest", ""))
+
+    def save(self, path: Path) -> None:
+        path.parent.mkdir(parents=True, exist_ok=True)
+        tmp = path.with_suffix(".tmp")
+        tmp.write_text(json.dumps(self.to_dict(), ensure_ascii=False), encoding="utf-8")
+        tmp.replace(path)
+
+    @classmethod
+    def load(cls, path: Path) -> "AccountMaster":
+        return cls.from_dict(json.loads(path.read_text(encoding="utf-8")))
+
+
+def master_path(digest: str, cache_dir: Optional[Path] = None) -> Path:
+    return (cache_dir or CACHE_DIR) / "account_master" / f"{digest}.json"
+
+
+def load_account_master(source, cache_dir: Optional[Path] = None) -> AccountMaster:
+    """
+    勘定科目一覧の CSV（バイト列・パス・ファイル）から勘定科目マスタを作る。
+    同じ内容のマスタが保存されていれば、CSV を解析せずにそれを読み込む。
+    保存先に書き込めない場合は保存せずに返す。
+    """
+    if isinstance(source, bytes):
+        data = source
+    elif isinstance(source, (str, Path)):
+        data = Path(source).read_bytes()
+    else:
+        data = source.read()
+    digest = hashlib.sha256(data).hexdigest()
+    path = master_path(digest, cache_dir)
+    if path.exists():
+        try:
+            with stage("load_account_master"):
+                return AccountMaster.load(path)
+        except (OSError, ValueError, KeyError):
+            pass  # 壊れている・形式が古い場合は作り直す
+
+    with stage("build_account_master"):
+        master = AccountMaster.from_frame(read_kamoku_csv(data), digest)
+    try:
+        master.save(path)
+    except OSError:
+        pass
+    return master
@@ -0,0 +1,151 @@
+"""
+2期比較表の今期の月の金額のうち、前期と比べて変動の大きいセル（Excel でグレー表示するセル）の判定。
+
+部門 × 行 × 月 の配列をまとめて1回で判定し、結果のマスク（AnomalyMask）を画面のプレビューと
+全ての種類の Excel で使い回します。判定は AnomalyRules で指定し、次のいずれかに当たるセルを対象にします。
+
+- 前年平均との差: 差の絶対値が absolute 円以上、かつ前年平均の relative 倍以上（指定したものだけ判定）
+- z スコア: 前期の月の金額の分布（window を指定すると同じ月までの直近 window か月）の平均との差が
+  標準偏差の zscore 倍以上
+- 前月との差: 前月の金額との差の絶対値が month_over_month 円以上
+"""
+from dataclasses import dataclass
+from typing import Optional, Sequence, Tuple
+
+import numpy as np
+import pandas as pd
+
+# 前年平均との差がこの金額以上の月をグレーで表示する（既定の判定）
+ANOMALY_THRESHOLD = 300000
+
+
+@dataclass(frozen=True)
+class AnomalyRules:
+    """変動の大きいセルの判定の条件（None の条件は判定しない）"""
+    absolute: Optional[float] = ANOMALY_THRESHOLD   # 前年平均との差（円）
+    relative: Optional[float] = None                # 前年平均との差の、前年平均に対する割合（0.5 で 50%）
+    zscore: Optional[float] = None                  # 前期の月の分布に対する z スコア
+    window: Optional[int] = None                    # z スコアに使う前期の月数（None で前期の全ての月）
+    month_over_month: Optional[float] = None        # 前月との差（円）
+
+    def __post_init__(self):
+        for name in ("absolute", "relative", "zscore", "month_over_month"):
+            value = getattr(self, name)
+            if value is not None and value < 0:
+                raise ValueError(f"変動の判定の {name} には0以上の値を指定してください")
+        if self.window is not None and self.window < 2:
+            raise ValueError("z スコアに使う月数は2以上を指定してください")
+
+
+DEFAULT_RULES = AnomalyRules()
+
+
+@dataclass
+class AnomalyMask:
+    """2期比較表の行 × 今期の月の列 の判定結果（行は Comparison.final_df の順）"""
+    columns: Tuple[str, ...]
+    mask: np.ndarray
+
+    @property
+    def count(self) -> int:
+        return int(self.mask.sum())
+
+    def rows(self, rows: slice) -> np.ndarray:
+        """行範囲（部門）の判定結果（コピーしない）"""
+        return self.mask[rows]
+
+    def extend(self, other: "AnomalyMask") -> "AnomalyMask":
+        if other.columns != self.columns:
+            raise ValueError("月の列が異なる判定結果は結合できません")
+        return AnomalyMask(self.columns, np.concatenate([self.mask, other.mask]))
+
+    def cells(self, df: pd.DataFrame, value_columns: Sequence[str] = ("前年平均",)) -> pd.DataFrame:
+        """判定に当たったセルの一覧（部門・勘定科目・月・金額と value_columns）"""
+        rows, cols = np.nonzero(self.mask)
+        columns = np.array(self.columns, dtype=object)
+        month_values = df[list(self.columns)].to_numpy(dtype=np.float64, na_value=np.nan)
+        data = {
+            "部門": df["部門"].to_numpy()[rows],
+            "勘定科目": df["勘定科目"].to_numpy()[rows],
+            "月": columns[cols],
+            "金額": month_values[rows, cols],
+        }
+        for c in value_columns:
+            if c in df.columns:
+                data[c] = df[c].to_numpy()[rows]
+        return pd.DataFrame(data)
+
+
+def rolling_moments(
+    prior: np.ndarray,
+    positions: np.ndarray,
+    window: Optional[int] = None,
+) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    prior（... × 前期の月）の、今期の各月に対応する前期の月の分布の平均と標準偏差（... × 今期の月）。
+    positions は今期の各月と期首からの月が同じ前期の月の位置（なければ -1）。window を指定すると
+    その位置までの直近 window か月、指定しなければ前期の全ての月の分布にする。月数が2未満なら NaN。
+    累積和の差で求めるため、前期の月数によらず配列の演算の回数は一定。
+    """
+    prior = np.asarray(prior, dtype=np.float64)
+    positions = np.asarray(positions, dtype=np.intp)
+    n_prior = prior.shape[-1]
+    present = ~np.isnan(prior)
+    x = np.where(present, prior, 0.0)
+    pad = [(0, 0)] * (prior.ndim - 1) + [(1, 0)]
+    s1 = np.pad(np.cumsum(x, axis=-1), pad)
+    s2 = np.pad(np.cumsum(x * x, axis=-1), pad)
+    sn = np.pad(np.cumsum(present, axis=-1, dtype=np.float64), pad)
+
+    if window is None:
+        hi = np.full(len(positions), n_prior)
+        lo = np.zeros(len(positions), dtype=np.intp)
+    else:
+        hi = np.where(positions >= 0, positions + 1, 0)
+        lo = np.maximum(hi - window, 0)
+    count = sn[..., hi] - sn[..., lo]
+    with np.errstate(invalid="ignore", divide="ignore"):
+        mean = (s1[..., hi] - s1[..., lo]) / count
+        var = np.maximum((s2[..., hi] - s2[..., lo]) / count - mean * mean, 0.0)
+    mean[count < 2] = np.nan
+    return mean, np.sqrt(var)
+
+
+def detect_anomalies(
+    current: np.ndarray,
+    prior_average: Optional[np.ndarray] = None,
+    rules: AnomalyRules = DEFAULT_RULES,
+    prior: Optional[np.ndarray] = None,
+    prior_positions: Optional[np.ndarray] = None,
+) -> np.ndarray:
+    """
+    current（... × 今期の月、空欄は NaN）のうち、rules のいずれかに当たるセルの bool の配列。
+    prior_average（...）は前年平均（なければ NaN）、prior（... × 前期の月）と prior_positions は
+    z スコアの判定に使う前期の月の金額と、今期の各月に対応する前期の月の位置。
+    """
+    current = np.asarray(current, dtype=np.float64)
+    valid = ~np.isnan(current)
+    mask = np.zeros(current.shape, dtype=bool)
+    with np.errstate(invalid="ignore"):
+        if prior_average is not None and (rules.absolute is not None or rules.relative is not None):
+            average = np.asarray(prior_average, dtype=np.float64)[..., np.newaxis]
+            deviation = np.abs(current - average)
+            hit = valid & ~np.isnan(average)
+            if rules.absolute is not None:
+                hit &= deviation >= rules.absolute
+            if rules.relative is not None:
+                hit &= deviation >= rules.relative * np.abs(average)
+            mask |= hit
+
+        if rules.zscore is not None and prior is not None and prior_positions is not None:
+            mean, std = rolling_moments(prior, prior_positions, rules.window)
+            deviation = np.abs(current - mean)
+            # 前期の金額が毎月同じ（標準偏差 0）なら、金額が変わった月を対象にする
+            hit = valid & ~np.isnan(mean) & (deviation > 0)
+            hit &= deviation >= rules.zscore * std
+            mask |= hit
+
+        if rules.month_over_month is not None and current.shape[-1] > 1:
+            jump = np.abs(np.diff(current, axis=-1)) >= rules.month_over_month
+            mask[..., 1:] |= jump & valid[..., 1:] & valid[..., :-1]
+    return mask
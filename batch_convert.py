@@ -0,0 +1,245 @@
+"""
+複数の顧問先の freee 出力をまとめて Excel に変換するコマンドラインツール。
+
+入力ディレクトリ直下の顧問先ごとのフォルダに、
+勘定科目一覧・前期推移表・今期推移表の3つの CSV を置いて実行します。
+
+    python batch_convert.py 入力ディレクトリ 出力ディレクトリ --workers 8
+
+--tables parquet csv のように指定すると、2期比較表を Parquet・Arrow IPC・CSV でも出力します。
+--groups 合算.txt（または顧問先フォルダの 部門合算.txt）で部門の合算を定義すると、
+合算ごとのシート・行を追加します（形式は finance_utils.parse_department_groups）。
+--anomaly-* でグレー表示する変動の大きい月の条件を指定できます（anomaly.AnomalyRules）。
+"""
+import argparse
+import csv
+import hashlib
+import os
+import sys
+import time
+import traceback
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from pathlib import Path
+from typing import Dict, List, Optional, Sequence
+
+from excel_renderer import VARIANTS, VARIANTS_BY_KEY, store_workbooks, stored_workbooks, write_workbooks
+from finance_utils import build_comparison, build_rollups, parse_department_groups, prepare_inputs
+from account_master import load_account_master
+from anomaly import ANOMALY_THRESHOLD, DEFAULT_RULES, AnomalyRules
+from freee_reader import read_suii_csv
+from result_store import result_key
+from table_export import TABLE_FORMATS, export_comparison
+
+# ファイル名にこれらの文字列を含む CSV を、それぞれの入力として扱う
+FILE_PATTERNS: Dict[str, Sequence[str]] = {
+    "kamoku": ("勘定科目", "kamoku"),
+    "before": ("前期", "before"),
+    "this":   ("今期", "this"),
+}
+
+# 顧問先フォルダにこの名前のファイルがあれば、--groups の代わりにその部門の合算を使う
+CLIENT_GROUPS_FILE = "部門合算.txt"
+
+SUMMARY_FIELDS = [
+    "client", "status", "departments",
+    "read_sec", "compute_sec", "write_sec", "total_sec", "error",
+]
+
+
+def find_inputs(client_dir: Path) -> Optional[Dict[str, Path]]:
+    """顧問先フォルダから3つの CSV を探す。揃っていなければ None。"""
+    found: Dict[str, Path] = {}
+    for path in sorted(client_dir.glob("*.csv")):
+        name = path.stem.lower()
+        for role, patterns in FILE_PATTERNS.items():
+            if role not in found and any(p in name for p in patterns):
+                found[role] = path
+                break
+    return found if len(found) == len(FILE_PATTERNS) else None
+
+
+def file_digest(path: Path) -> str:
+    return hashlib.sha256(path.read_bytes()).hexdigest()
+
+
+def find_clients(input_dir: Path) -> List[Path]:
+    """顧問先フォルダ（入力ディレクトリ直下の全てのフォルダ）。CSV が揃っていないものは変換時にエラーとする。"""
+    return sorted(p for p in input_dir.iterdir() if p.is_dir())
+
+
+def output_file_names(variant_keys: Sequence[str]) -> Dict[str, str]:
+    """種類ごとの出力ファイル名。同じ名前になる種類には key を付けて区別する。"""
+    names: Dict[str, str] = {}
+    for key in variant_keys:
+        name = VARIANTS_BY_KEY[key].file_name
+        if name in names.values():
+            stem, ext = os.path.splitext(name)
+            name = f"{stem}_{key}{ext}"
+        names[key] = name
+    return names
+
+
+def convert_client(
+    client_dir: str,
+    output_dir: str,
+    variant_keys: Sequence[str],
+    table_keys: Sequence[str] = (),
+    groups_text: str = "",
+    rules: AnomalyRules = DEFAULT_RULES,
+) -> Dict[str, object]:
+    """1顧問先分を変換して結果（所要時間・エラー）を返す。プロセスプールから呼ばれる。"""
+    client = Path(client_dir).name
+    result: Dict[str, object] = {"client": client, "status": "ok", "departments": 0, "error": ""}
+    start = time.perf_counter()
+    try:
+        inputs = find_inputs(Path(client_dir))
+        if inputs is None:
+            raise FileNotFoundError("勘定科目一覧・前期推移表・今期推移表の CSV が揃っていません")
+
+        master = load_account_master(inputs["kamoku"])
+        this_cube, before_cube = prepare_inputs(
+            master, read_suii_csv(inputs["this"]), read_suii_csv(inputs["before"])
+        )
+        t_read = time.perf_counter()
+
+        depts = [d for d in this_cube.departments if d != "集計科目"]
+        client_groups = Path(client_dir) / CLIENT_GROUPS_FILE
+        if client_groups.exists():
+            groups_text = client_groups.read_text(encoding="utf-8-sig")
+        groups = parse_department_groups(groups_text)
+
+        # 同じ入力・合算の Excel が保存されていれば、比較表を作らずにそれを書き出す
+        out = Path(output_dir) / client
+        out.mkdir(parents=True, exist_ok=True)
+        paths = {key: out / name for key, name in output_file_names(variant_keys).items()}
+        cache_key = result_key(*(file_digest(inputs[role]) for role in FILE_PATTERNS), groups_text, rules)
+        stored = stored_workbooks(cache_key, list(paths))
+        for key, data in stored.items():
+            paths[key].write_bytes(data)
+        missing = {key: str(path) for key, path in paths.items() if key not in stored}
+
+        comparison = None
+        if missing or table_keys:
+            comparison = build_comparison(this_cube, before_cube, depts, rules)
+            if groups:
+                comparison = comparison.extend(build_rollups(this_cube, before_cube, groups, rules))
+        t_compute = time.perf_counter()
+
+        if missing:
+            write_workbooks(comparison, list(comparison.partitions), missing, constant_memory=True)
+            store_workbooks(cache_key, {key: paths[key].read_bytes() for key in missing})
+        for fmt in TABLE_FORMATS:
+            if fmt.key in table_keys:
+                export_comparison(comparison, fmt.key, out / f"2期比較表{fmt.extension}")
+        t_write = time.perf_counter()
+
+        result.update(
+            departments=len(depts),
+            read_sec=round(t_read - start, 3),
+            compute_sec=round(t_compute - t_read, 3),
+            write_sec=round(t_write - t_compute, 3),
+        )
+    except Exception as e:
+        result.update(status="error", error=f"{type(e).__name__}: {e}")
+        result["traceback"] = traceback.format_exc()
+    result["total_sec"] = round(time.perf_counter() - start, 3)
+    return result
+
+
+def _init_worker(department_workers: int) -> None:
+    """
+    一括変換のプロセスの初期化。顧問先ごとのプロセスがそれぞれ CPU の数だけ部門の計算用のプロセスを
+    起動しないよう、部門の並列計算のプロセス数を department_workers 以下にする。
+    """
+    import finance_utils
+    finance_utils.PARALLEL_WORKERS = min(finance_utils.PARALLEL_WORKERS, department_workers)
+
+
+def write_summary(results: List[Dict[str, object]], path: Path) -> None:
+    with open(path, "w", encoding="utf-8-sig", newline="") as f:
+        writer = csv.DictWriter(f, fieldnames=SUMMARY_FIELDS, extrasaction="ignore")
+        writer.writeheader()
+        writer.writerows(results)
+
+
+def run(
+    input_dir: Path,
+    output_dir: Path,
+    workers: int,
+    variant_keys: Sequence[str],
+    table_keys: Sequence[str] = (),
+    groups_text: str = "",
+    rules: AnomalyRules = DEFAULT_RULES,
+) -> List[Dict[str, object]]:
+    clients = find_clients(input_dir)
+    output_dir.mkdir(parents=True, exist_ok=True)
+    results: List[Dict[str, object]] = []
+    # CPU を顧問先のプロセスで分け、残りを大きな顧問先の部門の並列計算に使う
+    department_workers = max(1, (os.cpu_count() or 1) // workers)
+    with ProcessPoolExecutor(
+        max_workers=workers, initializer=_init_worker, initargs=(department_workers,)
+    ) as pool:
+        futures = [
+            pool.submit(
+                convert_client,
+                str(c), str(output_dir), list(variant_keys), list(table_keys), groups_text, rules,
+            )
+            for c in clients
+        ]
+        for future in as_completed(futures):
+            result = future.result()
+            results.append(result)
+            print(f"[{result['status']}] {result['client']} {result['total_sec']}s {result['error']}")
+    results.sort(key=lambda r: str(r["client"]))
+    write_summary(results, output_dir / "summary.csv")
+    return results
+
+
+def main(argv: Optional[Sequence[str]] = None) -> int:
+    parser = argparse.ArgumentParser(description="freee の推移表 CSV を顧問先ごとにまとめて Excel に変換します。")
+    parser.add_argument("input_dir", type=Path, help="顧問先ごとのフォルダを含むディレクトリ")
+    parser.add_argument("output_dir", type=Path, help="Excel と summary.csv の出力先")
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 1, help="並列に処理するプロセス数")
+    parser.add_argument(
+        "--variants", nargs="+", choices=[v.key for v in VARIANTS],
+        default=[v.key for v in VARIANTS], help="出力する Excel の種類",
+    )
+    parser.add_argument(
+        "--tables", nargs="*", choices=[f.key for f in TABLE_FORMATS], default=[],
+        help="Excel のほかに出力する比較表の形式（parquet・arrow は pyarrow が必要）",
+    )
+    parser.add_argument(
+        "--groups", type=Path, default=None,
+        help=f"部門の合算の定義ファイル（顧問先フォルダに {CLIENT_GROUPS_FILE} があればそちらを使う）",
+    )
+    anomaly = parser.add_argument_group("グレー表示する変動の大きい月の条件（指定しない条件は判定しない）")
+    anomaly.add_argument(
+        "--anomaly-absolute", type=float, default=ANOMALY_THRESHOLD, help="前年平均との差（円以上、0 で判定しない）"
+    )
+    anomaly.add_argument("--anomaly-relative", type=float, help="前年平均との差の割合（0.5 で 50%%以上）")
+    anomaly.add_argument("--anomaly-zscore", type=float, help="前期の月の分布に対する z スコア")
+    anomaly.add_argument("--anomaly-window", type=int, help="z スコアに使う前期の月数（既定は前期の全ての月）")
+    anomaly.add_argument("--anomaly-mom", type=float, help="前月との差（円以上）")
+    args = parser.parse_args(argv)
+
+    try:
+        rules = AnomalyRules(
+            absolute=args.anomaly_absolute or None,
+            relative=args.anomaly_relative,
+            zscore=args.anomaly_zscore,
+            window=args.anomaly_window,
+            month_over_month=args.anomaly_mom,
+        )
+    except ValueError as e:
+        parser.error(str(e))
+    groups_text = args.groups.read_text(encoding="utf-8-sig") if args.groups else ""
+    results = run(
+        args.input_dir, args.output_dir, max(1, args.workers), args.variants, args.tables, groups_text, rules
+    )
+    failed = [r for r in results if r["status"] != "ok"]
+    print(f"{len(results) - len(failed)}/{len(results)} 件を変換しました。結果: {args.output_dir / 'summary.csv'}")
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,277 @@
+"""
+処理段階ごとの所要時間を、合成した freee の CSV で計測します。
+
+    python benchmarks/bench.py                     # small・medium を計測して results.jsonl に追記
+    python benchmarks/bench.py --sizes huge --repeat 1
+    python benchmarks/bench.py --compare           # コミットごとの結果を並べて表示
+
+計測結果は、実行時のコミット（未コミットの変更があれば "+dirty" を付ける）と共に
+benchmarks/results.jsonl に1回1行で追記します。
+"""
+import argparse
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime, timezone
+from pathlib import Path
+from typing import Callable, Dict, List, Optional, Sequence, Tuple
+
+BENCH_DIR = Path(__file__).resolve().parent
+ROOT = BENCH_DIR.parent
+sys.path.insert(0, str(ROOT))
+sys.path.insert(0, str(BENCH_DIR))
+# 計算時間を計測するため、ディスクに保存した計算結果は使わない（build_comparison_stored だけで使う）
+os.environ.setdefault("FREEE_RESULT_CACHE_MB", "0")
+
+import numpy as np
+import pandas as pd
+
+from excel_renderer import VARIANTS, render_workbooks
+from finance_utils import (
+    DepartmentGroup,
+    _comparison_axes,
+    apply_layout_block,
+    build_comparison,
+    build_rollups,
+    compute_financials_block,
+    department_cache,
+    prepare_inputs,
+)
+from freee_reader import read_kamoku_csv, read_suii_csv
+from result_store import result_store
+from synthetic_freee import SyntheticSpec, generate_freee_export
+
+RESULTS_FILE = BENCH_DIR / "results.jsonl"
+
+SIZES: Dict[str, SyntheticSpec] = {
+    "small":  SyntheticSpec(accounts=30, departments=3, months=6),
+    "medium": SyntheticSpec(accounts=200, departments=20, months=12),
+    "huge":   SyntheticSpec(accounts=800, departments=100, months=12),
+}
+
+
+def _git(*args: str) -> str:
+    try:
+        return subprocess.run(
+            ["git", *args], cwd=ROOT, capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return ""
+
+
+def current_revision() -> str:
+    rev = _git("rev-parse", "--short", "HEAD") or "unknown"
+    dirty = _git("status", "--porcelain", "--untracked-files=no")
+    return rev + ("+dirty" if dirty else "")
+
+
+def _best(
+    fn: Callable[[], object], repeat: int, setup: Optional[Callable[[], None]] = None
+) -> Tuple[float, object]:
+    """repeat 回実行した最短時間と、最後の戻り値（setup は毎回の実行の前に、計測せずに呼ぶ）"""
+    best = float("inf")
+    result = None
+    for _ in range(repeat):
+        if setup is not None:
+            setup()
+        start = time.perf_counter()
+        result = fn()
+        best = min(best, time.perf_counter() - start)
+    return best, result
+
+
+def run_size(name: str, spec: SyntheticSpec, repeat: int) -> Dict[str, Dict[str, float]]:
+    """1つの規模について各段階を計測し、段階名 → {"sec", "rows"} を返す。"""
+    stages: Dict[str, Dict[str, float]] = {}
+
+    def measure(
+        stage: str,
+        fn: Callable[[], object],
+        rows: Callable[[object], int],
+        setup: Optional[Callable[[], None]] = None,
+    ) -> object:
+        sec, result = _best(fn, repeat, setup)
+        stages[stage] = {"sec": round(sec, 6), "rows": int(rows(result))}
+        print(f"  {name:<7} {stage:<28} {sec * 1000:10.1f} ms")
+        return result
+
+    with tempfile.TemporaryDirectory() as tmp:
+        paths = generate_freee_export(tmp, spec)
+        kamoku_df, this_df, before_df = measure(
+            "read_csv",
+            lambda: (read_kamoku_csv(paths["kamoku"]), read_suii_csv(paths["this"]), read_suii_csv(paths["before"])),
+            lambda r: len(r[1]) + len(r[2]),
+        )
+        this_cube, before_cube = measure(
+            "prepare_inputs",
+            lambda: prepare_inputs(kamoku_df, this_df, before_df),
+            lambda r: len(r[0].values) + len(r[1].values),
+        )
+        depts = [d for d in this_cube.departments if d != "集計科目"]
+
+        # computed_department_blocks が直列で計算するときと同じ、全部門まとめての小計行の挿入・派生科目の計算
+        layout, _, out_accounts = _comparison_axes(this_cube)
+        inserted = measure(
+            "insert_summary_rows",
+            lambda: apply_layout_block(this_cube.dense(depts), layout),
+            lambda r: r.shape[0] * r.shape[1],
+        )
+
+        def calculate() -> np.ndarray:
+            block = inserted.copy()
+            compute_financials_block(block, out_accounts)
+            return block
+
+        measure("calculate_financials", calculate, lambda r: r.shape[0] * r.shape[1])
+
+        def cold_comparison():
+            department_cache.clear()  # 繰り返しの2回目以降も部門を計算し直す
+            return build_comparison(this_cube, before_cube, depts)
+
+        comparison = measure("build_comparison", cold_comparison, lambda r: len(r.final_df))
+        # 部門の選択を変えたときの再実行（全部門の計算結果がメモリにある）
+        measure(
+            "build_comparison_cached",
+            lambda: build_comparison(this_cube, before_cube, depts),
+            lambda r: len(r.final_df),
+        )
+
+        # サーバーの再起動後・翌月の実行（部門の計算結果をディスクから読み込む）
+        saved = result_store.directory, result_store.max_bytes
+        result_store.directory, result_store.max_bytes = Path(tmp) / "results", 1 << 30
+        try:
+            department_cache.clear()
+            build_comparison(this_cube, before_cube, depts)
+
+            def stored_comparison():
+                department_cache.clear()
+                return build_comparison(this_cube, before_cube, depts)
+
+            measure("build_comparison_stored", stored_comparison, lambda r: len(r.final_df))
+
+            # 翌月の実行: 前期の推移表は同じで、今期の推移表に1か月増えた（前期の部門は全てディスクから読み込む）
+            last_month = prepare_inputs(kamoku_df, this_df.drop(columns=[this_cube.months.labels[-1]]), before_df)
+            runs = iter(range(repeat))
+
+            def after_last_month() -> None:
+                result_store.directory = Path(tmp) / f"results_next_month_{next(runs)}"
+                build_comparison(*last_month, depts)
+                department_cache.clear()
+
+            measure(
+                "build_comparison_next_month",
+                lambda: build_comparison(this_cube, before_cube, depts),
+                lambda r: len(r.final_df),
+                setup=after_last_month,
+            )
+        finally:
+            result_store.directory, result_store.max_bytes = saved
+
+        # 部門を10ずつまとめた合算と、それらを合わせた全社の2階層
+        groups = [
+            DepartmentGroup(f"合算{i // 10 + 1}", tuple(depts[i:i + 10])) for i in range(0, len(depts), 10)
+        ]
+        groups.append(DepartmentGroup("全社", tuple(g.name for g in groups)))
+        measure(
+            "build_rollups",
+            lambda: build_rollups(this_cube, before_cube, groups),
+            lambda r: len(r.final_df),
+        )
+        for variant in VARIANTS:
+            measure(
+                f"render_{variant.key}",
+                lambda v=variant: render_workbooks(comparison, depts, [v])[v.key],
+                len,
+            )
+
+        def end_to_end() -> Dict[str, bytes]:
+            department_cache.clear()
+            cubes = prepare_inputs(
+                read_kamoku_csv(paths["kamoku"]), read_suii_csv(paths["this"]), read_suii_csv(paths["before"])
+            )
+            selected = [d for d in cubes[0].departments if d != "集計科目"]
+            return render_workbooks(build_comparison(cubes[0], cubes[1], selected), selected)
+
+        measure("end_to_end", end_to_end, lambda r: sum(len(b) for b in r.values()))
+    return stages
+
+
+def record(results: Dict[str, Dict[str, Dict[str, float]]], path: Path) -> None:
+    entry = {
+        "revision": current_revision(),
+        "recorded_at": datetime.now(timezone.utc).isoformat(timespec="seconds"),
+        "python": platform.python_version(),
+        "pandas": pd.__version__,
+        "numpy": np.__version__,
+        "machine": platform.machine(),
+        "sizes": {
+            name: {"spec": vars(SIZES[name]), "stages": stages}
+            for name, stages in results.items()
+        },
+    }
+    with open(path, "a", encoding="utf-8") as f:
+        f.write(json.dumps(entry, ensure_ascii=False) + "\n")
+
+
+def load_results(path: Path) -> List[dict]:
+    if not path.exists():
+        return []
+    with open(path, encoding="utf-8") as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def compare(path: Path, last: int) -> None:
+    """コミットごとの最新の結果を、規模・段階ごとに ms で並べて表示する。"""
+    latest: Dict[str, dict] = {}
+    for entry in load_results(path):
+        latest.pop(entry["revision"], None)
+        latest[entry["revision"]] = entry
+    entries = list(latest.values())[-last:]
+    if not entries:
+        print(f"{path} に計測結果がありません")
+        return
+
+    revisions = [e["revision"] for e in entries]
+    print(f"{'size':<7} {'stage':<28}" + "".join(f"{r:>16}" for r in revisions))
+    for size in SIZES:
+        stage_names: List[str] = []
+        for e in entries:
+            for stage in e["sizes"].get(size, {}).get("stages", {}):
+                if stage not in stage_names:
+                    stage_names.append(stage)
+        for stage in stage_names:
+            cells = []
+            for e in entries:
+                sec = e["sizes"].get(size, {}).get("stages", {}).get(stage, {}).get("sec")
+                cells.append(f"{sec * 1000:16.1f}" if sec is not None else f"{'-':>16}")
+            print(f"{size:<7} {stage:<28}" + "".join(cells))
+
+
+def main(argv: Optional[Sequence[str]] = None) -> int:
+    parser = argparse.ArgumentParser(description="変換の各段階の所要時間を計測します。")
+    parser.add_argument("--sizes", nargs="+", choices=list(SIZES), default=["small", "medium"])
+    parser.add_argument("--repeat", type=int, default=3, help="各段階の実行回数（最短時間を記録）")
+    parser.add_argument("--results", type=Path, default=RESULTS_FILE, help="結果を追記するファイル")
+    parser.add_argument("--no-record", action="store_true", help="結果をファイルに追記しない")
+    parser.add_argument("--compare", action="store_true", help="記録済みの結果をコミットごとに比較して表示する")
+    parser.add_argument("--last", type=int, default=5, help="--compare で表示するコミット数")
+    args = parser.parse_args(argv)
+
+    if args.compare:
+        compare(args.results, args.last)
+        return 0
+
+    print(f"revision {current_revision()}")
+    results = {name: run_size(name, SIZES[name], max(1, args.repeat)) for name in args.sizes}
+    if not args.no_record:
+        record(results, args.results)
+        print(f"結果を {args.results} に追記しました")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,58 @@
+"""
+menu.py の起動直後の表示（ファイルをアップロードする前の画面）までの時間と、再実行1回の時間を計測します。
+
+    python benchmarks/first_paint.py --runs 5
+
+import のキャッシュが効かないように、1回ごとに新しいプロセスで streamlit の AppTest を使って実行します。
+streamlit 自体の import の時間は含みません。
+"""
+import argparse
+import json
+import statistics
+import subprocess
+import sys
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parent.parent
+
+_CHILD = """
+import json, time
+import streamlit
+from streamlit.testing.v1 import AppTest
+at = AppTest.from_file("menu.py", default_timeout=60)
+start = time.perf_counter()
+at.run()
+first = time.perf_counter() - start
+reruns = []
+for _ in range(5):
+    start = time.perf_counter()
+    at.run()
+    reruns.append(time.perf_counter() - start)
+print(json.dumps({"first": first, "rerun": min(reruns), "errors": len(at.exception)}))
+"""
+
+
+def measure_once() -> dict:
+    out = subprocess.run(
+        [sys.executable, "-c", _CHILD], cwd=ROOT, capture_output=True, text=True, check=True
+    ).stdout
+    return json.loads(out.strip().splitlines()[-1])
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description="menu.py の起動直後の表示までの時間を計測します。")
+    parser.add_argument("--runs", type=int, default=5)
+    args = parser.parse_args()
+
+    results = [measure_once() for _ in range(max(1, args.runs))]
+    if any(r["errors"] for r in results):
+        print("menu.py の実行中に例外が発生しました")
+        return 1
+    first = statistics.median(r["first"] for r in results)
+    rerun = statistics.median(r["rerun"] for r in results)
+    print(f"first paint {first * 1000:.1f} ms / rerun {rerun * 1000:.1f} ms (median of {len(results)})")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,324 @@
+"""
+menu.py を複数のセッションから同時に使ったときの再実行の待ち時間・処理量・メモリを計測します。
+
+    python benchmarks/load_test.py                          # 20セッション（200科目 × 20部門の顧問先5社）
+    python benchmarks/load_test.py --sessions 40 --processes 2 --max-p95-ms 3000
+
+各セッションは streamlit の AppTest で、合成した freee の CSV のアップロード、部門の選択の変更、
+Excel の作成を行います。同じプロセスのセッションは st.cache_data・作成ジョブ・計算結果の保存などを
+1つのサーバーと同じように共有します。AppTest は1プロセスに1つの Runtime を前提とするため、
+同じプロセスのスクリプトの実行は1つずつ行い、その待ち時間も再実行の時間に含めます
+（Excel の作成ジョブはバックグラウンドで並行して実行されます）。--processes で複数のプロセスに
+セッションを分けると、サーバーを複数起動した場合を計測できます。
+
+再実行の p50・p95、1秒あたりの再実行数、Excel の作成時間、プロセスごとのメモリ（最大 RSS）を表示し、
+例外が発生した場合や --max-p95-ms・--max-rss-mb を超えた場合は終了コード 1 を返します。
+作成ジョブの完了を待つ間の画面の定期的な再表示（st.fragment の run_every）は再現しません。
+"""
+import argparse
+import json
+import logging
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import List, Optional, Tuple
+
+BENCH_DIR = Path(__file__).resolve().parent
+ROOT = BENCH_DIR.parent
+sys.path.insert(0, str(ROOT))
+sys.path.insert(0, str(BENCH_DIR))
+
+import numpy as np
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+from synthetic_freee import SyntheticSpec, generate_freee_export
+
+# AppTest ではファイルをアップロードできないため、session_state の "load_test_uploads"
+# （"kamoku" / "before" / "this" → CSV のバイト列）をアップロードされたファイルとして返してから menu.py を実行する
+APP_SCRIPT = """
+import io
+import runpy
+import streamlit as st
+
+_uploads = st.session_state.get("load_test_uploads", {{}})
+_roles = (("勘定科目", "kamoku"), ("前期", "before"), ("今期", "this"))
+
+
+def _file_uploader(label, *args, **kwargs):
+    for word, role in _roles:
+        if word in label and role in _uploads:
+            uploaded = io.BytesIO(_uploads[role])
+            uploaded.name = role + ".csv"
+            return uploaded
+    return None
+
+
+st.file_uploader = _file_uploader
+runpy.run_path({menu!r}, run_name="__main__")
+"""
+
+RUN_KINDS = ("first_paint", "upload", "select", "export_request", "export_done")
+
+
+@dataclass
+class Samples:
+    """1プロセスの計測結果"""
+    runs: List[Tuple[str, float]] = field(default_factory=list)      # (種類, 秒)
+    exports: List[Tuple[str, float]] = field(default_factory=list)   # (ジョブの状態, 秒)
+    errors: List[str] = field(default_factory=list)
+    _lock: threading.Lock = field(default_factory=threading.Lock, repr=False)
+
+    def add_run(self, kind: str, sec: float) -> None:
+        with self._lock:
+            self.runs.append((kind, sec))
+
+    def add_export(self, status: str, sec: float) -> None:
+        with self._lock:
+            self.exports.append((status, sec))
+
+    def add_error(self, message: str) -> None:
+        with self._lock:
+            self.errors.append(message)
+
+
+def max_rss_mb(who: int) -> Optional[float]:
+    """最大 RSS（MB）。resource がない環境では None。"""
+    if resource is None:
+        return None
+    kb = resource.getrusage(who).ru_maxrss
+    return kb / 1024 if sys.platform != "darwin" else kb / 1024 / 1024
+
+
+def run_session(index: int, args: argparse.Namespace, clients: List[Path], run_lock: threading.Lock,
+                samples: Samples) -> None:
+    """1人分の操作: 表示 → アップロード → 部門の選択の変更 × reruns → Excel の作成"""
+    from streamlit.testing.v1 import AppTest
+    from excel_renderer import VARIANTS
+    from export_jobs import export_jobs
+
+    rng = random.Random(args.seed + index)
+    at = AppTest.from_string(APP_SCRIPT.format(menu=str(ROOT / "menu.py")), default_timeout=args.timeout)
+
+    def rerun(kind: str) -> None:
+        start = time.perf_counter()
+        with run_lock:
+            at.run()
+        samples.add_run(kind, time.perf_counter() - start)
+        for e in at.exception:
+            samples.add_error(f"session {index} {kind}: {e.value}")
+
+    def think() -> None:
+        time.sleep(rng.uniform(0, args.think))
+
+    try:
+        rerun("first_paint")
+        think()
+        client = clients[index % len(clients)]
+        at.session_state["load_test_uploads"] = {
+            role: (client / f"{role}.csv").read_bytes() for role in ("kamoku", "before", "this")
+        }
+        rerun("upload")
+        for _ in range(args.reruns):
+            think()
+            options = at.multiselect[0].options
+            choices = [d for d in options if d != "集計科目"] or list(options)
+            at.multiselect[0].set_value(rng.sample(choices, rng.randint(1, len(choices))))
+            rerun("select")
+
+        think()
+        variant = rng.choice(VARIANTS)
+        at.button(key=f"build_{variant.key}").click()
+        start = time.perf_counter()
+        rerun("export_request")
+        job_ids = list(at.session_state["export_jobs"].values()) if "export_jobs" in at.session_state else []
+        job = export_jobs.get(job_ids[-1]) if job_ids else None
+        if job is None:
+            samples.add_error(f"session {index}: 作成ジョブが登録されていません")
+            return
+        job.wait(args.timeout)
+        samples.add_export(job.status, time.perf_counter() - start)
+        if job.error:
+            samples.add_error(f"session {index} export: {job.error}")
+        rerun("export_done")
+    except Exception as e:
+        samples.add_error(f"session {index}: {type(e).__name__}: {e}")
+
+
+def worker(args: argparse.Namespace) -> int:
+    """args.worker 番目のプロセスとして、割り当てられたセッションを同時に実行し結果を JSON で出力する。"""
+    os.chdir(ROOT)  # menu.py は説明の画像をカレントディレクトリから読み込む
+    # AppTest の外のスレッドから session_state を操作するたびに出る警告を抑える
+    # （streamlit がログの設定で level を変えるため filter で抑える）
+    logging.getLogger("streamlit.runtime.scriptrunner_utils.script_run_context").addFilter(
+        lambda record: "missing ScriptRunContext" not in record.getMessage()
+    )
+    clients = sorted(p for p in Path(args.data).iterdir() if p.is_dir())
+    sessions = range(args.worker, args.sessions, max(1, args.processes))
+    samples = Samples()
+    run_lock = threading.Lock()
+    threads = []
+    start = time.perf_counter()
+    for index in sessions:
+        thread = threading.Thread(target=run_session, args=(index, args, clients, run_lock, samples))
+        thread.start()
+        threads.append(thread)
+        time.sleep(args.ramp_up / max(1, len(sessions)))
+    for thread in threads:
+        thread.join()
+    wall = time.perf_counter() - start
+
+    from export_jobs import export_jobs
+    export_jobs.wait_all()
+    print(json.dumps({
+        "process": args.worker,
+        "sessions": len(sessions),
+        "wall_sec": wall,
+        "runs": samples.runs,
+        "exports": samples.exports,
+        "errors": samples.errors,
+        "max_rss_mb": max_rss_mb(resource.RUSAGE_SELF) if resource else None,
+        "children_max_rss_mb": max_rss_mb(resource.RUSAGE_CHILDREN) if resource else None,
+    }, ensure_ascii=False))
+    return 0
+
+
+def generate_clients(data_dir: Path, spec: SyntheticSpec, n: int) -> None:
+    """顧問先 n 社分の CSV を data_dir/client00/{kamoku,before,this}.csv に作成する。"""
+    for c in range(n):
+        out = data_dir / f"client{c:02d}"
+        paths = generate_freee_export(out / "src", SyntheticSpec(**{**vars(spec), "seed": c}))
+        for role, path in paths.items():
+            path.replace(out / f"{role}.csv")
+
+
+def percentiles(values: List[float]) -> Tuple[float, float, float]:
+    """(p50, p95, 最大) の ms"""
+    if not values:
+        return (float("nan"),) * 3
+    ms = np.array(values) * 1000
+    return float(np.percentile(ms, 50)), float(np.percentile(ms, 95)), float(ms.max())
+
+
+def summarize(results: List[dict]) -> dict:
+    runs = [(kind, sec) for r in results for kind, sec in r["runs"]]
+    exports = [(status, sec) for r in results for status, sec in r["exports"]]
+    wall = max(r["wall_sec"] for r in results)
+    summary = {
+        "runs": {},
+        "throughput_runs_per_sec": len(runs) / wall if wall else 0.0,
+        "wall_sec": wall,
+        "exports": {
+            "done": sum(1 for status, _ in exports if status == "done"),
+            "other": sum(1 for status, _ in exports if status != "done"),
+        },
+        "processes": [
+            {"process": r["process"], "sessions": r["sessions"],
+             "max_rss_mb": r["max_rss_mb"], "children_max_rss_mb": r["children_max_rss_mb"]}
+            for r in results
+        ],
+        "errors": [e for r in results for e in r["errors"]],
+    }
+    for kind in RUN_KINDS + ("all",):
+        values = [sec for k, sec in runs if kind in (k, "all")]
+        p50, p95, worst = percentiles(values)
+        summary["runs"][kind] = {"count": len(values), "p50_ms": p50, "p95_ms": p95, "max_ms": worst}
+    p50, p95, worst = percentiles([sec for status, sec in exports if status == "done"])
+    summary["exports"].update(p50_ms=p50, p95_ms=p95, max_ms=worst)
+    return summary
+
+
+def report(summary: dict) -> None:
+    print(f"{'kind':<16}{'runs':>6}{'p50 ms':>10}{'p95 ms':>10}{'max ms':>10}")
+    for kind, r in summary["runs"].items():
+        print(f"{kind:<16}{r['count']:>6}{r['p50_ms']:>10.1f}{r['p95_ms']:>10.1f}{r['max_ms']:>10.1f}")
+    e = summary["exports"]
+    print(f"{'export (job)':<16}{e['done']:>6}{e['p50_ms']:>10.1f}{e['p95_ms']:>10.1f}{e['max_ms']:>10.1f}"
+          f"   未完了 {e['other']}")
+    print(f"throughput {summary['throughput_runs_per_sec']:.2f} reruns/s （{summary['wall_sec']:.1f} 秒）")
+    for p in summary["processes"]:
+        rss = "-" if p["max_rss_mb"] is None else f"{p['max_rss_mb']:.0f} MB"
+        children = "-" if p["children_max_rss_mb"] is None else f"{p['children_max_rss_mb']:.0f} MB"
+        print(f"process {p['process']}: {p['sessions']} sessions  最大 RSS {rss}（子プロセス {children}）")
+
+
+def check(summary: dict, args: argparse.Namespace) -> List[str]:
+    failures = [f"例外: {e}" for e in summary["errors"]]
+    p95 = summary["runs"]["all"]["p95_ms"]
+    if args.max_p95_ms is not None and not p95 <= args.max_p95_ms:
+        failures.append(f"再実行の p95 が {p95:.0f} ms で上限 {args.max_p95_ms:.0f} ms を超えています")
+    for p in summary["processes"]:
+        if args.max_rss_mb is not None and p["max_rss_mb"] is not None and p["max_rss_mb"] > args.max_rss_mb:
+            failures.append(f"process {p['process']} の最大 RSS が {p['max_rss_mb']:.0f} MB で上限を超えています")
+    return failures
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description="menu.py を複数のセッションから同時に使ったときの性能を計測します。")
+    parser.add_argument("--sessions", type=int, default=20, help="同時に操作するセッション（利用者）の数")
+    parser.add_argument("--processes", type=int, default=1, help="セッションを分けるプロセス（サーバー）の数")
+    parser.add_argument("--clients", type=int, default=5, help="アップロードする顧問先の種類")
+    parser.add_argument("--accounts", type=int, default=200)
+    parser.add_argument("--departments", type=int, default=20)
+    parser.add_argument("--months", type=int, default=12)
+    parser.add_argument("--reruns", type=int, default=3, help="1セッションで部門の選択を変える回数")
+    parser.add_argument("--think", type=float, default=0.5, help="操作の間の最大の待ち時間（秒）")
+    parser.add_argument("--ramp-up", type=float, default=2.0, help="全セッションを開始し終えるまでの秒数")
+    parser.add_argument("--timeout", type=float, default=300, help="1回の再実行・作成ジョブの上限（秒）")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--max-p95-ms", type=float, help="再実行の p95 の上限（超えると終了コード 1）")
+    parser.add_argument("--max-rss-mb", type=float, help="プロセスごとの最大 RSS の上限（超えると終了コード 1）")
+    parser.add_argument("--json", action="store_true", help="集計結果を JSON 1行でも出力する")
+    parser.add_argument("--worker", type=int, help=argparse.SUPPRESS)
+    parser.add_argument("--data", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.worker is not None:
+        return worker(args)
+
+    with tempfile.TemporaryDirectory() as tmp:
+        data = Path(tmp) / "clients"
+        spec = SyntheticSpec(accounts=args.accounts, departments=args.departments, months=args.months)
+        generate_clients(data, spec, max(1, args.clients))
+        # 計算結果の保存先は計測ごとに空にする（同じ計測の中では共有する）
+        env = {**os.environ, "FREEE_CACHE_DIR": str(Path(tmp) / "cache")}
+        workers = [
+            subprocess.Popen(
+                [sys.executable, __file__, *sys.argv[1:], "--worker", str(k), "--data", str(data)],
+                cwd=ROOT, env=env, stdout=subprocess.PIPE, text=True,
+            )
+            for k in range(max(1, args.processes))
+        ]
+        results = []
+        for proc in workers:
+            out, _ = proc.communicate()
+            if proc.returncode != 0:
+                print(f"計測用のプロセスが終了コード {proc.returncode} で終了しました")
+                return 1
+            results.append(json.loads(out.strip().splitlines()[-1]))
+
+    summary = summarize(results)
+    print(f"{args.sessions} sessions / {len(results)} processes / "
+          f"{args.clients} clients（{args.accounts}科目 × {args.departments}部門）")
+    report(summary)
+    if args.json:
+        print(json.dumps(summary, ensure_ascii=False))
+    failures = check(summary, args)
+    for failure in failures:
+        print("NG:", failure)
+    if not failures:
+        print("OK")
+    return 1 if failures else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,142 @@
+"""
+部門ごとの処理で作られる DataFrame の数とメモリのピークを、合成した大きな入力で確認します。
+
+    python benchmarks/memory_profile.py                 # 800科目 × 100部門
+    python benchmarks/memory_profile.py --departments 200 --accounts 1000
+
+2期比較表の作成（build_comparison）、シートの値・マスクの作成（sheet_data）、
+Excel の書き込み（write_workbooks）について部門数 N と N/2 で実行し、
+次を満たさなければ終了コード 1 を返します。
+- 作られた DataFrame の数が部門数に比例しない（1部門あたり MAX_FRAMES_PER_DEPARTMENT 未満）
+- 全部門のシートの値・マスクを作る間のメモリのピーク（tracemalloc）が部門数に比例して増えない
+
+write_workbooks のピークは参考として表示します（xlsxwriter は非表示の行の設定など
+シートごとの情報を Workbook を閉じるまで保持するため、シートの数に応じて増える）。
+"""
+import argparse
+import os
+import sys
+import tempfile
+import tracemalloc
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Callable, Dict, Iterator, List
+
+BENCH_DIR = Path(__file__).resolve().parent
+ROOT = BENCH_DIR.parent
+sys.path.insert(0, str(ROOT))
+sys.path.insert(0, str(BENCH_DIR))
+# 計算を計測するため、ディスクに保存した計算結果は使わない
+os.environ.setdefault("FREEE_RESULT_CACHE_MB", "0")
+
+import pandas as pd
+from pandas.core.generic import NDFrame
+
+from excel_renderer import VARIANTS, SheetSource, write_workbooks
+from finance_utils import build_comparison, department_cache, prepare_inputs
+from freee_reader import read_kamoku_csv, read_suii_csv
+from synthetic_freee import SyntheticSpec, generate_freee_export
+
+# 部門を1つ増やしたときに増えてよい DataFrame の数
+MAX_FRAMES_PER_DEPARTMENT = 1.0
+# 部門数を2倍にしたときの、シートの値・マスクを作る間のメモリのピークの増加率の上限
+MAX_SHEET_PEAK_GROWTH = 1.2
+STAGES = ("build_comparison", "sheet_data", "write_workbooks")
+
+
+@contextmanager
+def count_frames() -> Iterator[List[int]]:
+    """with の間に作られた DataFrame の数を数える（iloc・drop などで作られるものも含む）。"""
+    counter = [0]
+    original = NDFrame.__init__
+
+    def counting_init(self, *args, **kwargs):
+        if isinstance(self, pd.DataFrame):
+            counter[0] += 1
+        original(self, *args, **kwargs)
+
+    NDFrame.__init__ = counting_init
+    try:
+        yield counter
+    finally:
+        NDFrame.__init__ = original
+
+
+def profile(fn: Callable[[], object]) -> Dict[str, float]:
+    """fn を1回実行し、作られた DataFrame の数と tracemalloc のピーク（MB）を返す。"""
+    tracemalloc.start()
+    try:
+        with count_frames() as frames:
+            fn()
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return {"frames": frames[0], "peak_mb": peak / 1024 / 1024}
+
+
+def build_sheets(comparison, depts) -> None:
+    """write_workbooks と同じく全部門のシートの値・マスク・書式を作る（xlsx には書かない）。"""
+    source = SheetSource(comparison.final_df, comparison.anomalies)
+    for dept in depts:
+        data = source.sheet(comparison.partitions[dept])
+        for show_average in (False, True):
+            data.format_codes(show_average)
+
+
+def run(spec: SyntheticSpec) -> Dict[int, Dict[str, Dict[str, float]]]:
+    results: Dict[int, Dict[str, Dict[str, float]]] = {}
+    with tempfile.TemporaryDirectory() as tmp:
+        paths = generate_freee_export(tmp, spec)
+        this_cube, before_cube = prepare_inputs(
+            read_kamoku_csv(paths["kamoku"]), read_suii_csv(paths["this"]), read_suii_csv(paths["before"])
+        )
+        all_depts = [d for d in this_cube.departments if d != "集計科目"]
+        for n in (len(all_depts) // 2, len(all_depts)):
+            depts = all_depts[:n]
+            department_cache.clear()
+            build = profile(lambda: build_comparison(this_cube, before_cube, depts))
+            comparison = build_comparison(this_cube, before_cube, depts)
+            sheets = profile(lambda: build_sheets(comparison, depts))
+            outputs = {v.key: Path(tmp) / f"{v.key}_{n}.xlsx" for v in VARIANTS}
+            write = profile(lambda: write_workbooks(comparison, depts, {k: str(p) for k, p in outputs.items()}))
+            results[n] = {"build_comparison": build, "sheet_data": sheets, "write_workbooks": write}
+            for stage, r in results[n].items():
+                print(f"  {n:>4} 部門 {stage:<18} DataFrame {r['frames']:>6}  peak {r['peak_mb']:8.1f} MB")
+    return results
+
+
+def check(results: Dict[int, Dict[str, Dict[str, float]]]) -> List[str]:
+    small, large = sorted(results)
+    failures = []
+    for stage in STAGES:
+        per_dept = (results[large][stage]["frames"] - results[small][stage]["frames"]) / (large - small)
+        print(f"{stage}: 1部門あたりの DataFrame {per_dept:.2f}")
+        if per_dept >= MAX_FRAMES_PER_DEPARTMENT:
+            failures.append(f"{stage} が1部門あたり {per_dept:.2f} 個の DataFrame を作成しています")
+    for stage in ("sheet_data", "write_workbooks"):
+        growth = results[large][stage]["peak_mb"] / max(results[small][stage]["peak_mb"], 1e-9)
+        print(f"{stage}: 部門数 {small} → {large} でメモリのピーク {growth:.2f} 倍")
+    growth = results[large]["sheet_data"]["peak_mb"] / max(results[small]["sheet_data"]["peak_mb"], 1e-9)
+    if growth > MAX_SHEET_PEAK_GROWTH:
+        failures.append(f"シートの値・マスクを作る間のメモリのピークが部門数に応じて増えています（{growth:.2f} 倍）")
+    return failures
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description="部門ごとの DataFrame の数とメモリのピークを確認します。")
+    parser.add_argument("--accounts", type=int, default=800)
+    parser.add_argument("--departments", type=int, default=100)
+    parser.add_argument("--months", type=int, default=12)
+    args = parser.parse_args()
+
+    spec = SyntheticSpec(accounts=args.accounts, departments=args.departments, months=args.months)
+    failures = check(run(spec))
+    for failure in failures:
+        print("NG:", failure)
+    if not failures:
+        print("OK")
+    return 1 if failures else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
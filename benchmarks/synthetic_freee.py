@@ -0,0 +1,208 @@
+"""
+ベンチマーク用に、freee の出力と同じ形式の CSV（cp932）を作成します。
+
+    python benchmarks/synthetic_freee.py 出力ディレクトリ --accounts 200 --departments 20 --months 12
+
+勘定科目一覧.csv・前期推移表.csv・今期推移表.csv を書き出します。
+推移表は freee と同じく1行目がタイトル、2行目が見出しで、次の行を含みます。
+- 部門ごとの行と、部門が空欄の勘定科目ごとの合計行
+- 勘定科目コード・部門が空欄の集計行（売上総損益金額、当期商品仕入 など）
+- 最後の「期間累計」列（前期推移表は prior_period_total=False で省略）
+"""
+import argparse
+import csv
+import io
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+
+ENCODING = "cp932"
+
+# 損益計算書の基本の勘定科目: (勘定科目, 小分類)
+BASE_ACCOUNTS: List[Tuple[str, str]] = [
+    ("売上高", "売上高"), ("売上値引高", "売上高"),
+    ("期首商品棚卸高", "期首商品棚卸"),
+    ("仕入高", "当期商品仕入"), ("仕入値引高", "当期商品仕入"),
+    ("期末商品棚卸高", "期末商品棚卸"),
+    ("役員報酬", "人件費"), ("給料手当", "人件費"), ("法定福利費", "人件費"),
+    ("旅費交通費", "販売管理費"), ("通信費", "販売管理費"), ("消耗品費", "販売管理費"),
+    ("地代家賃", "販売管理費"), ("支払手数料", "販売管理費"),
+    ("受取利息", "営業外収益"), ("雑収入", "営業外収益"),
+    ("支払利息", "営業外費用"), ("雑損失", "営業外費用"),
+    ("固定資産売却益", "特別利益"), ("固定資産除却損", "特別損失"),
+    ("法人税、住民税及び事業税", "法人税等"),
+]
+
+# 勘定科目一覧にだけある貸借対照表の科目（推移表には出てこない）
+BALANCE_ACCOUNTS: List[Tuple[str, str]] = [
+    ("現金", "現金及び預金"), ("普通預金", "現金及び預金"),
+    ("売掛金", "売上債権"), ("買掛金", "仕入債務"),
+]
+
+# 追加の勘定科目を割り当てる小分類と、その割合
+EXTRA_CATEGORIES: List[Tuple[str, float]] = [
+    ("販売管理費", 0.7), ("人件費", 0.1), ("売上高", 0.05),
+    ("営業外収益", 0.05), ("営業外費用", 0.05), ("特別損失", 0.05),
+]
+
+# 推移表の集計行（勘定科目コード・部門が空欄）
+AGGREGATE_ROWS = ["売上総損益金額", "当期商品仕入", "営業損益金額", "経常損益金額"]
+
+FIRST_CODE = 100
+
+
+@dataclass
+class SyntheticSpec:
+    """作成する CSV の規模"""
+    accounts: int = 30          # 推移表に出てくる勘定科目の数（基本の科目を含む）
+    departments: int = 5
+    months: int = 12            # 今期の経過月数
+    prior_months: int = 12
+    fill_rate: float = 0.7      # 部門 × 勘定科目 のうち行がある割合
+    zero_rate: float = 0.2      # 行のうち金額が全て0の割合
+    prior_period_total: bool = True   # 前期推移表に期間累計列を出力する
+    thousands_separator: bool = False
+    first_month: int = 4        # 期首の月
+    year: int = 2025            # 今期の期首の年
+    seed: int = 0
+
+
+def _accounts(n: int, rng: np.random.Generator) -> List[Tuple[str, str]]:
+    """n 科目の (勘定科目, 小分類)。追加の科目は同じ小分類の基本の科目の後ろに並べる。"""
+    n_extra = max(0, n - len(BASE_ACCOUNTS))
+    names = [c for c, _ in EXTRA_CATEGORIES]
+    weights = np.array([w for _, w in EXTRA_CATEGORIES])
+    picks = rng.choice(len(names), size=n_extra, p=weights / weights.sum())
+    extra: Dict[str, List[Tuple[str, str]]] = {c: [] for c in names}
+    for i, k in enumerate(picks):
+        extra[names[k]].append((f"{names[k]}{i + 1:04d}", names[k]))
+
+    accounts: List[Tuple[str, str]] = []
+    for k, (name, category) in enumerate(BASE_ACCOUNTS):
+        accounts.append((name, category))
+        is_last = k + 1 == len(BASE_ACCOUNTS) or BASE_ACCOUNTS[k + 1][1] != category
+        if is_last:
+            accounts.extend(extra.pop(category, []))
+    return accounts[:max(n, 1)]
+
+
+def _month_labels(first_month: int, year: int, n: int) -> List[str]:
+    labels = []
+    for i in range(n):
+        m = first_month - 1 + i
+        labels.append(f"{year + m // 12}/{m % 12 + 1:02d}")
+    return labels
+
+
+def _amount(value: int, thousands_separator: bool) -> str:
+    return f"{value:,}" if thousands_separator else str(value)
+
+
+def kamoku_rows(accounts: List[Tuple[str, str]]) -> List[List[str]]:
+    rows = [["勘定科目", "表示名（決算書）", "小分類", "中分類", "大分類", "ショートカット1", "ショートカット2"]]
+    for i, (name, category) in enumerate(BALANCE_ACCOUNTS + accounts):
+        rows.append([name, name, category, "", "", "", str(FIRST_CODE + i)])
+    return rows
+
+
+def suii_rows(
+    accounts: List[Tuple[str, str]],
+    codes: Dict[str, int],
+    departments: List[str],
+    months: List[str],
+    spec: SyntheticSpec,
+    rng: np.random.Generator,
+    period_total: bool = True,
+) -> List[List[str]]:
+    """推移表の行（タイトル行・見出し行を含む）"""
+    header = ["勘定科目コード", "勘定科目", "部門"] + months
+    if period_total:
+        header.append("期間累計")
+    rows = [["月次推移：部門別"], header]
+
+    def add(code: str, name: str, dept: str, values: np.ndarray) -> None:
+        row = [code, name, dept] + [_amount(int(v), spec.thousands_separator) for v in values]
+        if period_total:
+            row.append(_amount(int(values.sum()), spec.thousands_separator))
+        rows.append(row)
+
+    n = len(months)
+    for name, _ in accounts:
+        total = np.zeros(n, dtype=np.int64)
+        for dept in departments:
+            if rng.random() >= spec.fill_rate:
+                continue
+            values = rng.integers(-50_000, 2_000_000, n)
+            if rng.random() < spec.zero_rate:
+                values[:] = 0
+            total += values
+            add(str(codes[name]), name, dept, values)
+        add(str(codes[name]), name, "", total)
+    for name in AGGREGATE_ROWS:
+        add("", name, "", rng.integers(0, 5_000_000, n))
+    return rows
+
+
+def _write_csv(path: Path, rows: List[List[str]]) -> None:
+    buf = io.StringIO()
+    csv.writer(buf, lineterminator="\r\n").writerows(rows)
+    path.write_bytes(buf.getvalue().encode(ENCODING))
+
+
+def generate_freee_export(out_dir, spec: Optional[SyntheticSpec] = None) -> Dict[str, Path]:
+    """
+    out_dir に勘定科目一覧・前期推移表・今期推移表の CSV を書き出し、
+    "kamoku" / "before" / "this" → ファイルのパス を返します。
+    """
+    spec = spec or SyntheticSpec()
+    rng = np.random.default_rng(spec.seed)
+    out = Path(out_dir)
+    out.mkdir(parents=True, exist_ok=True)
+
+    accounts = _accounts(spec.accounts, rng)
+    kamoku = kamoku_rows(accounts)
+    codes = {row[0]: int(row[6]) for row in kamoku[1:]}
+    departments = [f"部門{i + 1:03d}" for i in range(spec.departments)]
+
+    paths = {
+        "kamoku": out / "勘定科目一覧.csv",
+        "before": out / "前期推移表.csv",
+        "this":   out / "今期推移表.csv",
+    }
+    _write_csv(paths["kamoku"], kamoku)
+    years = (
+        ("before", spec.year - 1, spec.prior_months, spec.prior_period_total),
+        ("this", spec.year, spec.months, True),
+    )
+    for role, year, n, period_total in years:
+        months = _month_labels(spec.first_month, year, n)
+        _write_csv(paths[role], suii_rows(accounts, codes, departments, months, spec, rng, period_total))
+    return paths
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="freee の勘定科目一覧・推移表と同じ形式の CSV を作成します。")
+    parser.add_argument("out_dir", type=Path)
+    parser.add_argument("--accounts", type=int, default=SyntheticSpec.accounts)
+    parser.add_argument("--departments", type=int, default=SyntheticSpec.departments)
+    parser.add_argument("--months", type=int, default=SyntheticSpec.months)
+    parser.add_argument("--prior-months", type=int, default=SyntheticSpec.prior_months)
+    parser.add_argument("--no-prior-period-total", action="store_true", help="前期推移表に期間累計列を出力しない")
+    parser.add_argument("--thousands-separator", action="store_true", help="金額を桁区切りのカンマ付きで出力する")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    spec = SyntheticSpec(
+        accounts=args.accounts, departments=args.departments,
+        months=args.months, prior_months=args.prior_months,
+        prior_period_total=not args.no_prior_period_total,
+        thousands_separator=args.thousands_separator, seed=args.seed,
+    )
+    for path in generate_freee_export(args.out_dir, spec).values():
+        print(path)
+
+
+if __name__ == "__main__":
+    main()
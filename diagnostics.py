@@ -0,0 +1,194 @@
+"""
+処理段階ごとの所要時間・行数・メモリの記録（有効にしたときだけ）。
+
+    diag = diagnostics.begin(enabled)
+    with diagnostics.stage("prepare_inputs") as s:
+        ...
+        s.rows = len(df)
+    diagnostics.end(diag)
+
+begin で有効にした Diagnostics が記録先になり、finance_utils などの stage はそこに記録します。
+有効でなければ stage は何もしません。段階が終わるたびに、JSON 1行のログを
+"for_freee.diagnostics" ロガーに出力します。メモリは tracemalloc で計測するため、
+有効にしている間は処理が遅くなります。
+
+tracemalloc はプロセス全体で1つのため、記録中のセッションが1つでもあれば計測を続け、
+最後のセッションの記録が終わったときに止めます。メモリの値はプロセス全体の割り当てで、
+他のセッションも記録している間は段階ごとの最大値を計測し直さないため、
+他のセッションの割り当ても含む（実際より大きい）値になります。
+"""
+import json
+import logging
+import sys
+import threading
+import time
+import tracemalloc
+import uuid
+import weakref
+from contextlib import contextmanager
+from contextvars import ContextVar
+from dataclasses import asdict, dataclass, field
+from typing import Iterator, List, Optional
+
+LOGGER_NAME = "for_freee.diagnostics"
+logger = logging.getLogger(LOGGER_NAME)
+
+_MB = 1024 * 1024
+
+# tracemalloc を使っている記録の数（begin で tracemalloc を開始・共有した Diagnostics の数）
+_tracing_lock = threading.Lock()
+_tracing_users = 0
+
+
+@dataclass
+class StageRecord:
+    """1つの段階の記録"""
+    name: str
+    depth: int = 0              # 入れ子の深さ（0 が最上位）
+    parent: Optional[str] = None
+    started: float = 0.0        # 記録開始からの経過秒
+    seconds: float = 0.0
+    rows: Optional[int] = None
+    peak_mb: float = 0.0        # 段階の開始時点から増えたメモリの最大値
+
+
+class _NullStage:
+    """無効なときに stage が返すもの。rows を設定しても何もしない。"""
+    rows: Optional[int] = None
+
+    def __setattr__(self, name, value):
+        pass
+
+
+_NULL_STAGE = _NullStage()
+
+
+@dataclass
+class Diagnostics:
+    """1回の実行（Streamlit の再実行1回など）の記録"""
+    run_id: str = field(default_factory=lambda: uuid.uuid4().hex[:12])
+    records: List[StageRecord] = field(default_factory=list)
+    started_at: float = field(default_factory=time.perf_counter)
+    _stack: List[list] = field(default_factory=list, repr=False)  # [record, 開始時のメモリ, 子の最大値]
+    _tracing: Optional[weakref.finalize] = field(default=None, repr=False)  # tracemalloc の参照を返す処理
+
+    @contextmanager
+    def stage(self, name: str, rows: Optional[int] = None) -> Iterator[StageRecord]:
+        parent = self._stack[-1] if self._stack else None
+        if parent is not None:
+            # 親の段階のここまでの最大値を残してから計測し直す
+            parent[2] = max(parent[2], tracemalloc.get_traced_memory()[1])
+        self._reset_peak()
+        record = StageRecord(
+            name=name,
+            depth=len(self._stack),
+            parent=parent[0].name if parent is not None else None,
+            started=round(time.perf_counter() - self.started_at, 6),
+            rows=rows,
+        )
+        entry = [record, tracemalloc.get_traced_memory()[0], 0]
+        self._stack.append(entry)
+        start = time.perf_counter()
+        try:
+            yield record
+        finally:
+            record.seconds = round(time.perf_counter() - start, 6)
+            peak = max(entry[2], tracemalloc.get_traced_memory()[1])
+            record.peak_mb = round(max(0, peak - entry[1]) / _MB, 3)
+            self._stack.pop()
+            if parent is not None:
+                parent[2] = max(parent[2], peak)
+            self._reset_peak()
+            self.records.append(record)
+            _log({"event": "stage", "run_id": self.run_id, **asdict(record)})
+
+    def _reset_peak(self) -> None:
+        """他に記録中のセッションがなければ、メモリの最大値を計測し直す。"""
+        with _tracing_lock:
+            if self._tracing is not None and _tracing_users == 1:
+                tracemalloc.reset_peak()
+
+    def to_frame(self):
+        """開始順に並べた記録の DataFrame（段階名は入れ子の深さで字下げする）"""
+        import pandas as pd
+        records = sorted(self.records, key=lambda r: r.started)
+        df = pd.DataFrame([asdict(r) for r in records], columns=list(StageRecord.__dataclass_fields__))
+        df["name"] = ["　" * r.depth + r.name for r in records]
+        return df.drop(columns=["depth", "parent"])
+
+
+_current: ContextVar[Optional[Diagnostics]] = ContextVar("diagnostics", default=None)
+
+
+def _log(payload: dict) -> None:
+    if not logger.handlers:
+        handler = logging.StreamHandler(sys.stderr)
+        handler.setFormatter(logging.Formatter("%(message)s"))
+        logger.addHandler(handler)
+        logger.setLevel(logging.INFO)
+        logger.propagate = False
+    logger.info(json.dumps(payload, ensure_ascii=False))
+
+
+def current() -> Optional[Diagnostics]:
+    return _current.get()
+
+
+def _acquire_tracing() -> bool:
+    """tracemalloc を開始する（開始済みなら共有する）。他の処理が開始したものなら使うだけで False を返す。"""
+    global _tracing_users
+    with _tracing_lock:
+        if _tracing_users == 0:
+            if tracemalloc.is_tracing():
+                return False
+            tracemalloc.start()
+        _tracing_users += 1
+        return True
+
+
+def _release_tracing() -> None:
+    """_acquire_tracing の参照を返し、最後の参照なら tracemalloc を止める。"""
+    global _tracing_users
+    with _tracing_lock:
+        _tracing_users -= 1
+        if _tracing_users == 0:
+            tracemalloc.stop()
+
+
+def begin(enabled: bool = True) -> Optional[Diagnostics]:
+    """記録を始める。enabled が False なら記録しない（前回の記録先も外す）。"""
+    diag = Diagnostics() if enabled else None
+    if diag is not None and _acquire_tracing():
+        # st.rerun などで end が呼ばれずに終わった記録も、破棄されたときに参照を返す
+        diag._tracing = weakref.finalize(diag, _release_tracing)
+    _current.set(diag)
+    return diag
+
+
+def end(diag: Optional[Diagnostics]) -> None:
+    """記録を終え、実行全体の所要時間をログに出力する。"""
+    if diag is None:
+        return
+    if _current.get() is diag:
+        _current.set(None)
+    if diag._tracing is not None:
+        diag._tracing()  # 1度だけ参照を返す
+    top = [r for r in diag.records if r.depth == 0]
+    _log({
+        "event": "run",
+        "run_id": diag.run_id,
+        "seconds": round(time.perf_counter() - diag.started_at, 6),
+        "stages": len(diag.records),
+        "peak_mb": max((r.peak_mb for r in top), default=0.0),
+    })
+
+
+@contextmanager
+def stage(name: str, rows: Optional[int] = None):
+    """記録中なら段階として記録する。記録していなければ何もしない。"""
+    diag = _current.get()
+    if diag is None:
+        yield _NULL_STAGE
+        return
+    with diag.stage(name, rows) as record:
+        yield record
@@ -0,0 +1,425 @@
+import tempfile
+import threading
+from dataclasses import dataclass, field
+from io import BytesIO
+from typing import IO, Callable, Dict, List, Optional, Sequence, Union
+
+import numpy as np
+import pandas as pd
+
+from anomaly import DEFAULT_RULES, AnomalyMask, AnomalyRules, detect_anomalies
+from diagnostics import stage
+from finance_utils import Comparison
+from result_store import result_store
+
+XLSX_MIME = "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"
+
+# 強調表示する集計行
+HIGHLIGHT_ACCOUNTS = [
+    "純売上高", "純仕入高", "売上原価", "売上総利益", "人件費合計", "販売費及び一般管理費",
+    "営業利益", "営業外収益合計", "営業外費用合計", "経常利益",
+    "特別利益合計", "特別損失合計", "税引前当期純利益",
+    "法人税・住民税・事業税", "税引後当期純利益"
+]
+
+HIGHLIGHT_SET = frozenset(HIGHLIGHT_ACCOUNTS)
+
+# 金額列の開始位置（勘定科目, 前期累計, 今期累計, 増減 の後）
+VALUE_START_COL = 4
+
+# 一時ファイルに書き出した xlsx を、このサイズまではメモリに置き、超えたらディスクに書き出す
+SPOOL_MAX_SIZE = 8 * 1024 * 1024
+
+# セル書式の種類
+BORDER, NUM, GRAY, HIGHLIGHT, HIGHLIGHT_NUM, AVERAGE = range(6)
+
+
+@dataclass(frozen=True)
+class WorkbookVariant:
+    """出力する Excel の種類"""
+    key: str
+    label: str              # ダウンロードボタンの表示
+    build_label: str        # 作成ボタンの表示
+    file_name: str
+    num_format: str
+    title: str
+    unit_note: str          # 部門名の後ろに付ける単位の注記
+    bold_subtitle: bool
+    show_average: bool      # 前年平均列とグレー表示
+    hide_empty_rows: bool   # 金額が全て0・空欄の行を非表示にする
+    column_width: int
+
+
+VARIANTS: List[WorkbookVariant] = [
+    WorkbookVariant(
+        key="yen", label="Excel(円単位)をダウンロード", build_label="Excel(円単位)を作成",
+        file_name="部門別推移表(円単位).xlsx",
+        num_format="#,##0", title="2 期 比 較 推 移表", unit_note="", bold_subtitle=False,
+        show_average=True, hide_empty_rows=False, column_width=15,
+    ),
+    WorkbookVariant(
+        key="thousand", label="Excel(千円単位)をダウンロード", build_label="Excel(千円単位)を作成",
+        file_name="部門別推移表(千円単位).xlsx",
+        num_format="#,##0,", title="2 期 比 較 推 移 表", unit_note="　※ 単位：千円", bold_subtitle=False,
+        show_average=True, hide_empty_rows=True, column_width=12,
+    ),
+    WorkbookVariant(
+        key="thousand_plain", label="通常) Excel(千円単位)をダウンロード", build_label="通常) Excel(千円単位)を作成",
+        file_name="部門別推移表(千円単位).xlsx",
+        num_format="#,##0,", title="2 期 比 較 推 移 表", unit_note="　※ 単位：千円", bold_subtitle=True,
+        show_average=False, hide_empty_rows=True, column_width=12,
+    ),
+]
+
+VARIANTS_BY_KEY: Dict[str, WorkbookVariant] = {v.key: v for v in VARIANTS}
+
+
+# シートに書かない列
+SHEET_DROP_COLUMNS = ('勘定科目コード', '部門', '小分類')
+
+
+@dataclass
+class SheetData:
+    """
+    1部門分のシートの値と、書式・非表示の判定に使うマスク。
+    SheetSource.sheet で作ったものは部門をまたいで使い回すバッファのビューで、次の部門を作るまで有効。
+    """
+    columns: List[str]
+    cells: np.ndarray       # 書き込む値（NaN は None）
+    is_number: np.ndarray   # 数値セル
+    blank: np.ndarray       # 空欄または0のセル
+    highlight: np.ndarray   # 強調表示する行
+    candidate: np.ndarray   # 前年平均と比較するセル
+    anomaly: np.ndarray     # 変動の大きいセル（anomaly.AnomalyMask、グレーで表示する）
+    avg_col: Optional[int]  # 前年平均列の位置
+    code_buffers: Dict[bool, np.ndarray] = field(default_factory=dict, repr=False)
+
+    def format_codes(self, show_average: bool) -> np.ndarray:
+        return format_codes(self, show_average, out=self.code_buffers.get(show_average))
+
+
+def sheet_name(dept: str) -> str:
+    return dept[:31].replace('/', '_').replace('\\', '_')
+
+
+class SheetSource:
+    """
+    2期比較表のシートに書く列を、列ごとの配列として持つ（float64 の列は final_df の列のビューでコピーしない）。
+    部門のシートは行範囲を指定して作り、値・マスクは部門をまたいで使い回すバッファに書き込むため、
+    部門ごとに DataFrame や部門の大きさの配列を作らない。
+    変動の大きいセルは anomalies（Comparison.anomalies）を使い、なければ df の月の列と前年平均から rules で判定する。
+    """
+
+    def __init__(
+        self,
+        df: pd.DataFrame,
+        anomalies: Optional[AnomalyMask] = None,
+        rules: AnomalyRules = DEFAULT_RULES,
+    ):
+        columns = [c for c in df.columns if c not in SHEET_DROP_COLUMNS]
+        if "前期累計" in columns:
+            columns.remove("前期累計")
+            columns.insert(1, "前期累計")
+        self.columns = columns
+        self.n_rows = len(df)
+        self.raw: List[np.ndarray] = []                 # 列ごとのセルに書く値
+        self.values: List[Optional[np.ndarray]] = []    # 数値型の列の数値（数値型でない列は None）
+        for c in columns:
+            col = df[c]
+            if col.dtype.kind in "biuf":
+                if col.dtype == np.float64:
+                    values = col.to_numpy()
+                else:
+                    values = col.to_numpy(dtype="float64", na_value=np.nan)
+                self.raw.append(col.to_numpy() if isinstance(col.dtype, np.dtype) else values)
+                self.values.append(values)
+            else:
+                self.raw.append(col.to_numpy())
+                self.values.append(None)
+        self.avg_col = columns.index("前年平均") if "前年平均" in columns else None
+        self.anomalies = anomalies
+        self.rules = rules
+        if anomalies is not None:
+            self.month_cols = [columns.index(c) for c in anomalies.columns]
+        else:
+            self.month_cols = [j for j in range(VALUE_START_COL, len(columns)) if j != self.avg_col]
+        self._capacity = -1
+
+    def _allocate(self, n: int) -> None:
+        """n 行分のバッファを用意する（列ごとに書き込むので列優先の配列にする）。"""
+        shape = (n, len(self.columns))
+        self._cells = np.empty(shape, dtype=object, order="F")
+        self._values = np.empty(shape, order="F")
+        self._na = np.empty(shape, dtype=bool, order="F")
+        self._is_number = np.empty(shape, dtype=bool, order="F")
+        self._blank = np.empty(shape, dtype=bool, order="F")
+        self._candidate = np.zeros(shape, dtype=bool, order="F")
+        self._anomaly = np.zeros(shape, dtype=bool, order="F")
+        self._codes = {flag: np.empty(shape, dtype=np.int8) for flag in (False, True)}
+        self._capacity = n
+
+    def sheet(self, rows: slice) -> SheetData:
+        """rows の行範囲（部門）のシートの値とマスク"""
+        start, stop, _ = rows.indices(self.n_rows)
+        n = max(0, stop - start)
+        if n > self._capacity:
+            self._allocate(n)
+        cells, values = self._cells[:n], self._values[:n]
+        na, is_number, blank = self._na[:n], self._is_number[:n], self._blank[:n]
+        candidate, anomaly = self._candidate[:n], self._anomaly[:n]
+
+        for j in range(len(self.columns)):
+            raw = self.raw[j][start:stop]
+            cells[:, j] = raw
+            if self.values[j] is not None:
+                # 数値型の列は NaN が空欄、それ以外が数値セル
+                values[:, j] = self.values[j][start:stop]
+                np.isnan(values[:, j], out=na[:, j])
+                np.logical_not(na[:, j], out=is_number[:, j])
+            else:
+                na[:, j] = pd.isna(raw)
+                is_number[:, j] = [isinstance(v, (int, float)) for v in raw]
+                is_number[:, j] &= ~na[:, j]
+                values[:, j] = pd.to_numeric(raw, errors="coerce")
+        highlight = np.fromiter(
+            (v in HIGHLIGHT_SET for v in cells[:, 0]), dtype=bool, count=n
+        ) if self.columns else np.zeros(n, dtype=bool)
+        cells[na] = None
+        np.equal(values, 0, out=blank)
+        blank &= is_number
+        blank |= na
+
+        candidate.fill(False)
+        anomaly.fill(False)
+        avg_col = self.avg_col
+        if avg_col is not None:
+            avg = values[:, avg_col]
+            np.logical_not(na[:, VALUE_START_COL:], out=candidate[:, VALUE_START_COL:])
+            candidate[np.isnan(avg)] = False
+            candidate[:, avg_col] = False
+            if self.anomalies is not None:
+                anomaly[:, self.month_cols] = self.anomalies.rows(rows)
+            else:
+                anomaly[:, self.month_cols] = detect_anomalies(values[:, self.month_cols], avg, self.rules)
+            anomaly &= candidate
+
+        return SheetData(
+            columns=self.columns,
+            cells=cells,
+            is_number=is_number,
+            blank=blank,
+            highlight=highlight,
+            candidate=candidate,
+            anomaly=anomaly,
+            avg_col=avg_col,
+            code_buffers={flag: buf[:n] for flag, buf in self._codes.items()},
+        )
+
+
+def format_codes(data: SheetData, show_average: bool, out: Optional[np.ndarray] = None) -> np.ndarray:
+    """セルごとの書式の種類（BORDER, NUM, ...）を行列で返す（out を指定すればそこに書き込む）。"""
+    codes = np.empty(data.is_number.shape, dtype=np.int8) if out is None else out
+    codes.fill(BORDER)
+    codes[data.is_number] = NUM
+    avg_col = data.avg_col if show_average else None
+    if avg_col is not None:
+        codes[data.candidate] = NUM
+        codes[data.anomaly] = GRAY
+        codes[:, avg_col] = AVERAGE
+    hl = data.highlight
+    codes[hl] = np.where(data.is_number[hl], HIGHLIGHT_NUM, HIGHLIGHT)
+    if avg_col is not None:
+        codes[hl, avg_col] = AVERAGE
+    return codes
+
+
+class _VariantWriter:
+    """1つの Workbook に対して、部門ごとのシートを書き込む。"""
+
+    def __init__(
+        self,
+        variant: WorkbookVariant,
+        output: Union[str, IO[bytes], None] = None,
+        constant_memory: bool = False,
+    ):
+        import xlsxwriter  # Excel を作成するときだけ読み込む
+        self.variant = variant
+        self.output = BytesIO() if output is None else output
+        # constant_memory では行ごとに一時ファイルへ書き出し、セルをメモリに溜めない（行の順に書き込むこと）
+        self.wb = xlsxwriter.Workbook(self.output, {'constant_memory': constant_memory})
+        num = variant.num_format
+        self.formats = {
+            BORDER:        self.wb.add_format({'border': 1}),
+            NUM:           self.wb.add_format({'num_format': num, 'border': 1}),
+            GRAY:          self.wb.add_format({'bg_color': '#D9D9D9', 'border': 1, 'num_format': num}),
+            HIGHLIGHT:     self.wb.add_format({'bg_color': '#C6EFCE', 'bold': True, 'border': 1}),
+            HIGHLIGHT_NUM: self.wb.add_format({'bg_color': '#C6EFCE', 'bold': True, 'border': 1, 'num_format': num}),
+            AVERAGE:       self.wb.add_format({'bold': True, 'border': 1, 'bg_color': '#FFFFCC', 'num_format': num}),
+        }
+        self.title_fmt = self.wb.add_format({'align': 'center', 'valign': 'vcenter', 'bold': True, 'font_size': 28})
+        self.subtitle_fmt = self.wb.add_format({'bold': True, 'font_size': 14}) if variant.bold_subtitle else None
+
+    def write_sheet(self, dept: str, data: SheetData) -> None:
+        variant = self.variant
+        keep = [j for j, c in enumerate(data.columns) if variant.show_average or c != "前年平均"]
+        if keep == list(range(len(keep))):
+            keep = slice(0, len(keep))  # 前年平均が最後の列なら、コピーせずにビューで取り出す
+        col_names = data.columns[keep] if isinstance(keep, slice) else [data.columns[j] for j in keep]
+        cells = data.cells[:, keep]
+        codes = data.format_codes(variant.show_average)[:, keep]
+        hidden = None
+        if variant.hide_empty_rows:
+            hidden = ~data.highlight & data.blank[:, keep][:, VALUE_START_COL:].all(axis=1)
+
+        ws = self.wb.add_worksheet(sheet_name(dept))
+        # constant_memory では書き込んだ行から順に出力されるため、行の既定の高さは最初に設定する
+        ws.set_default_row(25)
+        startrow = 2
+        last_col = len(col_names) - 1
+        ws.set_row(0, 30)
+        ws.merge_range(0, 0, 0, last_col, variant.title, self.title_fmt)
+        if self.subtitle_fmt is not None:
+            ws.write(1, 0, dept + variant.unit_note, self.subtitle_fmt)
+        else:
+            ws.write(1, 0, dept + variant.unit_note)
+
+        header_fmts = [
+            self.formats[AVERAGE if variant.show_average and c == "前年平均" else BORDER]
+            for c in col_names
+        ]
+        for col_idx, col in enumerate(col_names):
+            ws.write(startrow, col_idx, col, header_fmts[col_idx])
+
+        for i in range(len(cells)):
+            row_idx = startrow + 1 + i
+            if hidden is not None and hidden[i]:
+                ws.set_row(row_idx, 15, options={'hidden': True})  # 非表示の行は Excel 標準の高さのまま
+            self._write_runs(ws, row_idx, cells[i], codes[i])
+
+        ws.set_column('A:A', 25)
+        ws.set_column('B:Z', variant.column_width)
+
+    def _write_runs(self, ws, row_idx: int, values: np.ndarray, codes: np.ndarray) -> None:
+        """同じ書式が続くセルをまとめて write_row で書き込む。"""
+        if not len(codes):
+            return
+        bounds = (np.flatnonzero(codes[1:] != codes[:-1]) + 1).tolist()
+        starts = [0] + bounds
+        ends = bounds + [len(codes)]
+        for s, e in zip(starts, ends):
+            ws.write_row(row_idx, s, values[s:e].tolist(), self.formats[codes[s]])
+
+    def close(self) -> None:
+        self.wb.close()
+
+
+class WorkbookFile:
+    """
+    作成した xlsx を保持する一時ファイル。SPOOL_MAX_SIZE まではメモリ、超えるとディスクに置く。
+    複数のセッションから読まれるため、読み込みはロックで保護する。
+    """
+
+    def __init__(self, file: "tempfile.SpooledTemporaryFile"):
+        self.file = file
+        self.size = file.tell()
+        self._lock = threading.Lock()
+
+    def read_bytes(self) -> bytes:
+        with self._lock:
+            self.file.seek(0)
+            return self.file.read()
+
+    def close(self) -> None:
+        self.file.close()
+
+
+def write_workbooks(
+    comparison: Comparison,
+    depts: Sequence[str],
+    outputs: Dict[str, Union[str, IO[bytes]]],
+    constant_memory: bool = True,
+    progress: Optional[Callable[[int, int], None]] = None,
+) -> None:
+    """
+    variant.key → 出力先（パスまたはファイル）の outputs に Excel を書き込みます。
+    部門ごとのマスクは1度だけ計算し、指定された全ての種類のシートに使います。
+    progress を指定すると、部門を書き込むたびに (書き込んだ部門数, 全部門数) で呼び出します
+    （progress が例外を送出すると書き込みを中断する）。
+    """
+    writers = [_VariantWriter(VARIANTS_BY_KEY[key], out, constant_memory) for key, out in outputs.items()]
+    with stage("write_sheets", rows=len(comparison.final_df)):
+        source = SheetSource(comparison.final_df, comparison.anomalies)
+        for k, dept in enumerate(depts):
+            if progress is not None:
+                progress(k, len(depts))
+            data = source.sheet(comparison.partitions[dept])
+            for writer in writers:
+                writer.write_sheet(dept, data)
+        if progress is not None:
+            progress(len(depts), len(depts))
+    for writer in writers:
+        with stage(f"save_xlsx_{writer.variant.key}"):
+            writer.close()
+
+
+def stored_workbooks(cache_key: str, variant_keys: Sequence[str]) -> Dict[str, bytes]:
+    """cache_key（入力の内容のハッシュなど）で result_store に保存された Excel の variant.key → バイト列"""
+    stored = result_store.get_many("workbook", [f"{cache_key}:{key}" for key in variant_keys])
+    return {key: stored[f"{cache_key}:{key}"] for key in variant_keys if f"{cache_key}:{key}" in stored}
+
+
+def store_workbooks(cache_key: str, workbooks: Dict[str, bytes]) -> None:
+    """作成した Excel（variant.key → バイト列）を cache_key で result_store に保存する。"""
+    result_store.put_many("workbook", {f"{cache_key}:{key}": data for key, data in workbooks.items()})
+
+
+def render_workbook_files(
+    comparison: Comparison,
+    depts: Sequence[str],
+    variants: Optional[Sequence[WorkbookVariant]] = None,
+    spool_max_size: int = SPOOL_MAX_SIZE,
+    progress: Optional[Callable[[int, int], None]] = None,
+    cache_key: Optional[str] = None,
+) -> Dict[str, WorkbookFile]:
+    """
+    xlsxwriter の constant_memory で、部門数によらずメモリを一定に保って Excel を作成し、
+    variant.key → WorkbookFile（spool_max_size を超えるとディスクに書き出す一時ファイル）を返します。
+    cache_key を指定すると、同じキーで保存された Excel はディスクから読み込み、作成したものは保存します。
+    """
+    variants = VARIANTS if variants is None else variants
+    stored = stored_workbooks(cache_key, [v.key for v in variants]) if cache_key and result_store.enabled else {}
+    files = {v.key: tempfile.SpooledTemporaryFile(max_size=spool_max_size, suffix=".xlsx") for v in variants}
+    try:
+        for key, data in stored.items():
+            files[key].write(data)
+        missing = {key: f for key, f in files.items() if key not in stored}
+        if missing:
+            write_workbooks(comparison, depts, missing, constant_memory=True, progress=progress)
+        elif progress is not None:
+            progress(len(depts), len(depts))
+    except BaseException:
+        for f in files.values():
+            f.close()
+        raise
+    workbooks = {key: WorkbookFile(f) for key, f in files.items()}
+    if cache_key and missing and result_store.enabled:
+        with stage("store_workbooks", rows=len(missing)):
+            store_workbooks(cache_key, {
+                key: workbooks[key].read_bytes() for key in missing if workbooks[key].size <= result_store.max_bytes
+            })
+    return workbooks
+
+
+def render_workbooks(
+    comparison: Comparison,
+    depts: Sequence[str],
+    variants: Optional[Sequence[WorkbookVariant]] = None,
+) -> Dict[str, bytes]:
+    """
+    2期比較表から Excel を作成し、variant.key → xlsx のバイト列 を返します。
+    部門ごとのマスクは1度だけ計算し、指定された全ての種類のシートに使います。
+    """
+    variants = VARIANTS if variants is None else variants
+    outputs = {v.key: BytesIO() for v in variants}
+    write_workbooks(comparison, depts, outputs, constant_memory=False)
+    return {key: output.getvalue() for key, output in outputs.items()}
@@ -0,0 +1,193 @@
+"""
+Excel・データ出力をバックグラウンドで作成するジョブ。
+
+画面の再実行のたびに作り直さないよう、ジョブはプロセスで共有する export_jobs に登録し、
+セッションにはジョブ ID だけを保持します。同じ入力・種類のジョブが実行中・完了済みであれば
+新しく作らずにそれを返すため、同じ出力を同時に2回作成することはありません。
+共有したジョブは、待っている全てのセッションが取り消したときに取り消します。
+登録したセッションが処理時間・メモリを記録していれば（diagnostics）、ジョブも自身の記録
+（ExportJob.diagnostics）に段階を記録します。
+
+    job = export_jobs.submit(key, lambda progress: render(..., progress=progress))
+    job.progress      # (書き込んだ部門数, 全部門数)
+    export_jobs.release(job)   # このセッションは待つのをやめる（他に待つセッションがなければ取り消す）
+"""
+import os
+import threading
+import uuid
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor
+from dataclasses import dataclass, field
+from typing import Any, Callable, Dict, Hashable, Optional, Tuple
+
+import diagnostics
+from diagnostics import Diagnostics
+
+# 同時に作成する出力の数（環境変数 FREEE_EXPORT_WORKERS で変更）
+EXPORT_WORKERS = int(os.environ.get("FREEE_EXPORT_WORKERS", 2))
+# 終了したジョブ（作成済み・取消・失敗）を保持する数。超えると最も古く使われたものから破棄する。
+MAX_FINISHED_JOBS = 32
+
+QUEUED, RUNNING, DONE, CANCELLED, FAILED = "queued", "running", "done", "cancelled", "failed"
+
+ProgressCallback = Callable[[int, int], None]
+
+
+class ExportCancelled(Exception):
+    """ジョブが取り消された"""
+
+
+@dataclass
+class ExportJob:
+    """1つの出力の作成ジョブ"""
+    key: Hashable
+    id: str = field(default_factory=lambda: uuid.uuid4().hex)
+    status: str = QUEUED
+    done: int = 0
+    total: int = 0
+    result: Any = None
+    error: str = ""
+    subscribers: int = 0    # submit したセッションのうち、release していない数
+    diagnostics: Optional[Diagnostics] = field(default=None, repr=False)  # ジョブの段階の記録
+    future: Optional[Future] = field(default=None, repr=False)
+    _cancel: threading.Event = field(default_factory=threading.Event, repr=False)
+    _data: Optional[bytes] = field(default=None, repr=False)
+    _data_lock: threading.Lock = field(default_factory=threading.Lock, repr=False)
+
+    @property
+    def progress(self) -> Tuple[int, int]:
+        return self.done, self.total
+
+    @property
+    def fraction(self) -> float:
+        return self.done / self.total if self.total else 0.0
+
+    @property
+    def finished(self) -> bool:
+        return self.status in (DONE, CANCELLED, FAILED)
+
+    def cancel(self) -> None:
+        """取り消す。実行前ならそのまま、実行中なら次の部門を書き込む前に中断する。"""
+        self._cancel.set()
+        if self.future is not None and self.future.cancel():
+            self.status = CANCELLED
+
+    def result_bytes(self) -> bytes:
+        """
+        結果のバイト列（ダウンロードボタンに渡すもの）。結果が一時ファイル（read_bytes を持つもの）なら
+        最初の1回だけ読み込み、以降の再実行・セッションでは同じバイト列を返す。
+        """
+        if isinstance(self.result, bytes):
+            return self.result
+        with self._data_lock:
+            if self._data is None:
+                self._data = self.result.read_bytes()
+            return self._data
+
+    def report(self, done: int, total: int) -> None:
+        """作成処理から進み具合を受け取る。取り消されていれば ExportCancelled を送出する。"""
+        if self._cancel.is_set():
+            raise ExportCancelled()
+        self.done, self.total = done, total
+
+    def wait(self, timeout: Optional[float] = None) -> bool:
+        """終わるまで待ち、終わっていれば True を返す。"""
+        if self.future is not None:
+            try:
+                self.future.exception(timeout=timeout)
+            except Exception:
+                pass
+        return self.finished
+
+
+class ExportJobManager:
+    """
+    出力の作成ジョブを max_workers 個のスレッドで実行し、key ごとに1つだけ保持する。
+    Streamlit の複数セッションから使われるためロックで保護する。
+    """
+
+    def __init__(self, max_workers: int = EXPORT_WORKERS, max_finished: int = MAX_FINISHED_JOBS):
+        self.max_finished = max_finished
+        self._executor = ThreadPoolExecutor(max_workers=max(1, max_workers), thread_name_prefix="export")
+        self._jobs: "OrderedDict[Hashable, ExportJob]" = OrderedDict()
+        self._by_id: Dict[str, ExportJob] = {}
+        self._lock = threading.Lock()
+
+    def submit(self, key: Hashable, fn: Callable[[ProgressCallback], Any]) -> ExportJob:
+        """
+        fn(progress) を実行するジョブを登録して返す。同じ key のジョブが実行待ち・実行中・完了済みなら
+        それを返し、取り消し（中）・失敗したものは作り直す。呼び出したセッションはジョブを待つ数に加える。
+        """
+        with self._lock:
+            job = self._jobs.get(key)
+            if job is not None and job.status in (QUEUED, RUNNING, DONE) and not job._cancel.is_set():
+                self._jobs.move_to_end(key)
+                job.subscribers += 1
+                return job
+            if job is not None:
+                self._forget(job)
+            job = ExportJob(key, subscribers=1)
+            self._jobs[key] = job
+            self._by_id[job.id] = job
+            # 記録先（ContextVar）は実行するスレッドに引き継がれないため、ジョブで記録するかだけを渡す
+            record = diagnostics.current() is not None
+            job.future = self._executor.submit(self._run, job, fn, record)
+            return job
+
+    def release(self, job: ExportJob) -> None:
+        """
+        セッションがジョブを待つのをやめる（取消ボタン）。待っているセッションがなくなれば取り消し、
+        他のセッションが待っていれば作成を続ける。
+        """
+        with self._lock:
+            job.subscribers = max(0, job.subscribers - 1)
+            if job.subscribers == 0 and not job.finished:
+                job.cancel()
+                self._evict()
+
+    def get(self, job_id: str) -> Optional[ExportJob]:
+        with self._lock:
+            return self._by_id.get(job_id)
+
+    def _run(self, job: ExportJob, fn: Callable[[ProgressCallback], Any], record: bool = False) -> None:
+        job.diagnostics = diagnostics.begin(record)
+        try:
+            if job._cancel.is_set():
+                job.status = CANCELLED
+                return
+            job.status = RUNNING
+            try:
+                result = fn(job.report)
+            except ExportCancelled:
+                job.status = CANCELLED
+                return
+            except Exception as e:
+                job.error = f"{type(e).__name__}: {e}"
+                job.status = FAILED
+                return
+            job.result = result
+            job.status = DONE
+        finally:
+            diagnostics.end(job.diagnostics)
+            with self._lock:
+                self._evict()
+
+    def _forget(self, job: ExportJob) -> None:
+        # 結果（一時ファイル）はダウンロード中のセッションがあり得るので閉じず、参照がなくなったときに破棄される
+        self._jobs.pop(job.key, None)
+        self._by_id.pop(job.id, None)
+        job._data = None
+
+    def _evict(self) -> None:
+        finished = [job for job in self._jobs.values() if job.finished]
+        for job in finished[:max(0, len(finished) - self.max_finished)]:
+            self._forget(job)
+
+    def wait_all(self, timeout: Optional[float] = None) -> None:
+        with self._lock:
+            jobs = list(self._jobs.values())
+        for job in jobs:
+            job.wait(timeout)
+
+
+export_jobs = ExportJobManager()
@@ -1,5 +1,386 @@
+import atexit
+import hashlib
+import multiprocessing
+import os
+import threading
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing.shared_memory import SharedMemory
+import numpy as np
 import pandas as pd
-from typing import List, Union
+from dataclasses import dataclass, field
+from functools import cached_property, lru_cache
+from typing import Dict, List, Optional, Sequence, Tuple, Union
+
+from account_master import AccountMaster
+from anomaly import DEFAULT_RULES, AnomalyMask, AnomalyRules, detect_anomalies
+from diagnostics import stage
+from fiscal_period import MonthAxis
+from result_store import result_store
+
+KEY_COLUMNS = ["勘定科目コード", "勘定科目", "小分類", "部門"]
+
+
+@dataclass
+class FinanceCube:
+    """
+    勘定科目 × 部門 × 数値列 のデータ。
+    値のある（勘定科目, 部門）の組だけを部門順に持ち、それ以外は0として扱う。
+    """
+    accounts: pd.DataFrame      # 勘定科目軸（勘定科目コード, 勘定科目, 小分類）
+    departments: List[str]      # 部門軸
+    columns: List[str]          # 数値列
+    account_idx: np.ndarray     # 値のある組の勘定科目軸の位置
+    dept_offsets: np.ndarray    # 部門 j の組は [dept_offsets[j], dept_offsets[j + 1])
+    values: np.ndarray          # 値のある組の数値 (組の数, 列数) float64
+    months: MonthAxis = field(init=False)                   # columns のうち月の列
+    month_positions: np.ndarray = field(init=False, repr=False)  # 月の列の columns での位置
+    _department_keys: Dict[str, str] = field(default_factory=dict, init=False, repr=False)
+
+    def __post_init__(self):
+        self.months = MonthAxis.from_columns(self.columns)
+        self.month_positions = np.array([self.columns.index(c) for c in self.months.labels], dtype=np.intp)
+
+    @classmethod
+    def from_frame(
+        cls,
+        df: pd.DataFrame,
+        master: AccountMaster,
+        departments: Sequence[str],
+        accounts: Optional[pd.DataFrame] = None,
+    ) -> "FinanceCube":
+        """
+        推移表の行を、勘定科目マスタで対応付けた勘定科目軸の位置と部門軸の位置に割り当てる。
+        どちらかの軸にない行は捨て、同じ組の行は合計し、空欄は0とする。
+        """
+        accounts = master.accounts if accounts is None else accounts
+        columns = [c for c in df.columns if c not in KEY_COLUMNS]
+        df = df.reset_index(drop=True)
+
+        row_idx, account_idx = master.locate(df["勘定科目コード"], df["勘定科目"])
+        dept_idx = pd.Index(list(departments), dtype=object).get_indexer(
+            df["部門"].astype(object).to_numpy()[row_idx]
+        )
+        keep = dept_idx >= 0
+        row_idx, account_idx, dept_idx = row_idx[keep], account_idx[keep], dept_idx[keep]
+
+        values = df[columns].apply(pd.to_numeric, errors="coerce").to_numpy(dtype="float64", na_value=np.nan)
+        values = np.nan_to_num(values[row_idx], nan=0.0)
+
+        # 部門・勘定科目の順に並べ、同じ組をまとめる
+        order = np.lexsort((account_idx, dept_idx))
+        account_idx, dept_idx, values = account_idx[order], dept_idx[order], values[order]
+        if len(order):
+            first = np.r_[True, (account_idx[1:] != account_idx[:-1]) | (dept_idx[1:] != dept_idx[:-1])]
+            starts = np.flatnonzero(first)
+            values = np.add.reduceat(values, starts, axis=0)
+            account_idx, dept_idx = account_idx[starts], dept_idx[starts]
+        dept_offsets = np.searchsorted(dept_idx, np.arange(len(departments) + 1))
+        return cls(accounts, list(departments), columns, account_idx, dept_offsets, values)
+
+    @property
+    def nbytes(self) -> int:
+        return self.values.nbytes + self.account_idx.nbytes + self.dept_offsets.nbytes
+
+    def dept_position(self, dept: str) -> int:
+        return self.departments.index(dept)
+
+    def department_entries(self, dept: str) -> Tuple[np.ndarray, np.ndarray]:
+        """部門の値のある勘定科目軸の位置と数値（コピーしない）"""
+        j = self.dept_position(dept)
+        s, e = self.dept_offsets[j], self.dept_offsets[j + 1]
+        return self.account_idx[s:e], self.values[s:e]
+
+    @cached_property
+    def axis_key(self) -> str:
+        """勘定科目軸・数値列の内容のハッシュ"""
+        h = hashlib.blake2b(digest_size=16)
+        h.update(pd.util.hash_pandas_object(self.accounts.astype(object), index=False).to_numpy().tobytes())
+        h.update("\0".join(self.columns).encode())
+        return h.hexdigest()
+
+    def month_block(self) -> np.ndarray:
+        """値のある組 × 月 の数値（月の列が連続していればコピーしない）"""
+        return self.values[:, _as_slice(self.month_positions)]
+
+    def department_key(self, dept: str) -> str:
+        """部門のデータの内容のハッシュ。勘定科目軸・数値列・値が同じなら同じになる。"""
+        key = self._department_keys.get(dept)
+        if key is None:
+            idx, values = self.department_entries(dept)
+            h = hashlib.blake2b(digest_size=16)
+            h.update(self.axis_key.encode())
+            h.update(np.ascontiguousarray(idx, dtype=np.int64).tobytes())
+            h.update(np.ascontiguousarray(values).tobytes())
+            key = self._department_keys[dept] = h.hexdigest()
+        return key
+
+    def dense(self, depts: Sequence[str], out: Optional[np.ndarray] = None) -> np.ndarray:
+        """depts の部門 × 全勘定科目 × 数値列 の配列（out を指定すればそこに書き込む）"""
+        shape = (len(depts), len(self.accounts), len(self.columns))
+        if out is None:
+            block = np.zeros(shape)
+        else:
+            block = out.reshape(shape)
+            block.fill(0)
+        for k, dept in enumerate(depts):
+            idx, values = self.department_entries(dept)
+            block[k, idx] = values
+        return block
+
+    def entries_frame(self) -> pd.DataFrame:
+        """値のある組だけの DataFrame（プレビュー用）"""
+        dept_idx = np.repeat(np.arange(len(self.departments)), np.diff(self.dept_offsets))
+        df = self.accounts.iloc[self.account_idx].reset_index(drop=True)
+        df.insert(3, "部門", np.array(self.departments, dtype=object)[dept_idx])
+        return pd.concat([df, pd.DataFrame(self.values, columns=self.columns)], axis=1)
+
+
+def _as_slice(positions: np.ndarray) -> Union[slice, np.ndarray]:
+    """連続した位置なら slice（配列の添字にするとコピーせずにビューになる）"""
+    if len(positions) and np.array_equal(positions, np.arange(positions[0], positions[0] + len(positions))):
+        return slice(int(positions[0]), int(positions[0]) + len(positions))
+    return positions
+
+
+def prior_month_columns(this_cube: FinanceCube, before_cube: FinanceCube) -> Union[slice, np.ndarray]:
+    """今期の経過月と期首からの月が同じ、前期の月の列の位置（連続していれば slice）"""
+    aligned = before_cube.months.align(this_cube.months)
+    return _as_slice(before_cube.month_positions[aligned[aligned >= 0]])
+
+
+def prior_entries_frame(this_cube: FinanceCube, before_cube: FinanceCube) -> pd.DataFrame:
+    """前期の値のある組の DataFrame に、今期の経過月に対応する月の前期累計と平均を付けたもの（プレビュー用）"""
+    df = before_cube.entries_frame()
+    monthly = before_cube.values[:, prior_month_columns(this_cube, before_cube)]
+    df["前期累計"] = monthly.sum(axis=1)
+    df["平均"] = _monthly_average(monthly).astype(int)
+    return df
+
+
+def _monthly_average(monthly: np.ndarray) -> np.ndarray:
+    """最後の軸の月の金額の月平均（円未満切り捨て）。空欄（NaN）の月は数えず、月がなければ 0。"""
+    counts = (~np.isnan(monthly)).sum(axis=-1)
+    totals = np.nansum(monthly, axis=-1)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        average = np.floor(totals / counts)
+    return np.nan_to_num(average, nan=0.0)
+
+
+def prepare_inputs(
+    master: Union[AccountMaster, pd.DataFrame],
+    this_df: pd.DataFrame,
+    before_df: pd.DataFrame,
+) -> Tuple[FinanceCube, FinanceCube]:
+    """
+    freee_reader.read_suii_csv で読み込んだ今期・前期の推移表を、
+    勘定科目マスタ（または勘定科目一覧の DataFrame）の全科目 × 全部門 を軸とする FinanceCube にします。
+    前期は月の列だけにし、今期の経過月によらない（前期累計・前年平均は比較表を作るときに求める）。
+    そのため翌月に今期の推移表だけが変わっても、前期の部門のハッシュ・計算結果はそのまま使い回せる。
+    """
+    if isinstance(master, pd.DataFrame):
+        master = AccountMaster.from_frame(master)
+    this_df = this_df.rename(columns={"期間累計": "今期累計"})
+    this_df.insert(3, "前期累計", 0)
+    this_df.insert(5, "増減", 0)
+    this_df["今期累計"] = pd.to_numeric(this_df["今期累計"], errors="coerce").fillna(0)
+    before_df = before_df.drop(columns=["期間累計"], errors="ignore")
+
+    all_kamoku = master.accounts
+    all_depts = pd.concat(
+        [this_df["部門"].astype(object), before_df["部門"].astype(object)]
+    ).dropna().unique().tolist()
+    with stage("build_cube_this", rows=len(this_df)):
+        this_cube = FinanceCube.from_frame(this_df, master, all_depts, all_kamoku)
+    with stage("build_cube_before", rows=len(before_df)):
+        before_cube = FinanceCube.from_frame(before_df, master, all_depts, all_kamoku)
+    return this_cube, before_cube
+
+
+# 小計行の定義: (集計対象の小分類, 小計行の名称)。最後の集計対象行の直後に挿入する。
+SUMMARY_ROWS: List[Tuple[List[str], str]] = [
+    (["売上高"],       "純売上高"),
+    (["当期商品仕入"], "純仕入高"),
+    (["人件費"],       "人件費合計"),
+    (["人件費", "販売管理費"], "販売費及び一般管理費"),
+    (["営業外収益"],   "営業外収益合計"),
+    (["営業外費用"],   "営業外費用合計"),
+    (["特別利益"],     "特別利益合計"),
+    (["特別損失"],     "特別損失合計"),
+    (["法人税等"],     "法人税・住民税・事業税"),
+]
+
+# 必ず存在させる行: (直前の勘定科目, 追加する勘定科目)。値は0で追加する。
+REQUIRED_ROWS: List[Tuple[str, str]] = [
+    ("純仕入高",           "期末商品棚卸"),
+    ("純売上高",           "期首商品棚卸"),
+    ("期末商品棚卸",       "売上原価"),
+    ("売上原価",           "売上総利益"),
+    ("販売費及び一般管理費", "営業利益"),
+    ("営業利益",           "営業外収益合計"),
+    ("営業外収益合計",     "営業外費用合計"),
+    ("営業外費用合計",     "経常利益"),
+    ("経常利益",           "特別利益合計"),
+    ("特別利益合計",       "特別損失合計"),
+    ("特別損失合計",       "税引前当期純利益"),
+    ("税引前当期純利益",   "法人税・住民税・事業税"),
+    ("法人税・住民税・事業税", "税引後当期純利益"),
+]
+
+
+@dataclass(frozen=True)
+class SummaryLayout:
+    """
+    insert_summary_rows の出力行構成。
+    勘定科目・小分類の並びが同じ部門には同じレイアウトを使い回す。
+    """
+    source: np.ndarray           # 出力行ごとの元の行位置（挿入行は -1）
+    labels: np.ndarray           # 出力行ごとの挿入行の名称（元の行は None）
+    zero_rows: np.ndarray        # 値0で挿入する行の出力行位置
+    summary_rows: np.ndarray     # 小計行の出力行位置
+    summary_members: np.ndarray  # 小計行ごとの集計対象の元の行位置（連結）
+    summary_starts: np.ndarray   # summary_members における各小計行の開始位置
+
+    @property
+    def inserted_rows(self) -> np.ndarray:
+        return np.flatnonzero(self.source < 0)
+
+    @property
+    def has_inserts(self) -> bool:
+        return bool((self.source < 0).any())
+
+
+@lru_cache(maxsize=32)
+def compile_summary_layout(
+    accounts: Tuple[Optional[str], ...],
+    categories: Tuple[Optional[str], ...],
+) -> SummaryLayout:
+    """
+    勘定科目・小分類の並びから、小計行・必須行を挿入した後の行構成を組み立てます。
+    行の挿入は行番号のリスト上で行い、DataFrame は作りません。
+    """
+    # 各行: (元の行位置 or -1, 勘定科目, 小分類, 集計対象の元の行位置 or None)
+    rows: List[Tuple[int, Optional[str], Optional[str], Optional[Tuple[int, ...]]]] = [
+        (i, a, c, None) for i, (a, c) in enumerate(zip(accounts, categories))
+    ]
+
+    def _new(label: str, members: Optional[Tuple[int, ...]] = None):
+        return (-1, label, label, members)
+
+    if not any(r[2] == "売上高" for r in rows):
+        rows.insert(0, _new("純売上高"))
+
+    if not any(r[2] == "当期商品仕入" for r in rows):
+        idxs = [i for i, r in enumerate(rows) if r[2] == "純売上高"]
+        if not idxs:
+            idxs = [i for i, r in enumerate(rows) if r[2] == "売上高"]
+        if idxs:
+            rows[idxs[0] + 1:idxs[0] + 1] = [_new("期首商品棚卸"), _new("純仕入高")]
+
+    for targets, label in SUMMARY_ROWS:
+        idxs = [i for i, r in enumerate(rows) if r[2] in targets]
+        if not idxs:
+            continue
+        members: List[int] = []
+        for i in idxs:
+            pos, _, _, sub = rows[i]
+            if pos >= 0:
+                members.append(pos)
+            elif sub is not None:
+                members.extend(sub)
+        rows.insert(idxs[-1] + 1, _new(label, tuple(members)))
+
+    for prev, new in REQUIRED_ROWS:
+        names = [r[1] for r in rows]
+        if prev in names and new not in names:
+            last = len(names) - 1 - names[::-1].index(prev)
+            # 先頭行の直後には追加しない（従来の挙動に合わせる）
+            if last > 0:
+                rows.insert(last + 1, _new(new))
+
+    source = np.array([r[0] for r in rows], dtype=np.intp)
+    labels = np.array([r[1] if r[0] < 0 else None for r in rows], dtype=object)
+    summary = [(i, r[3]) for i, r in enumerate(rows) if r[0] < 0 and r[3] is not None]
+    zero_rows = np.array([i for i, r in enumerate(rows) if r[0] < 0 and r[3] is None], dtype=np.intp)
+    summary_rows = np.array([i for i, _ in summary], dtype=np.intp)
+    summary_members = np.array([m for _, ms in summary for m in ms], dtype=np.intp)
+    summary_starts = np.cumsum([0] + [len(ms) for _, ms in summary[:-1]]).astype(np.intp)
+    return SummaryLayout(source, labels, zero_rows, summary_rows, summary_members, summary_starts)
+
+
+def _layout_key(values: pd.Series) -> Tuple[Optional[str], ...]:
+    return tuple(None if pd.isna(v) else v for v in values.tolist())
+
+
+def _group_sums(values: np.ndarray, layout: SummaryLayout) -> np.ndarray:
+    """小計行ごとに集計対象行の合計を求める（NaN は 0 として扱う）。"""
+    members = values[layout.summary_members]
+    if members.dtype.kind == "f":
+        members = np.where(np.isnan(members), 0, members)
+    return np.add.reduceat(members, layout.summary_starts)
+
+
+def _apply_layout(df: pd.DataFrame, layout: SummaryLayout, dept) -> pd.DataFrame:
+    """レイアウトに従って出力行を1度に組み立てる。dept は挿入行の部門（スカラーまたは挿入行ごとの配列）。"""
+    n_out = len(layout.source)
+    src_rows = np.flatnonzero(layout.source >= 0)
+    src_pos = layout.source[src_rows]
+    inserted = layout.inserted_rows
+    numeric_df = df.select_dtypes(include="number")
+    numeric = set(numeric_df.columns)
+    # 小計行は数値列の合計を1本の Series として持つため、数値列の共通の型になる
+    sum_dtype = np.result_type(*[
+        dtype if isinstance(dtype, np.dtype) else np.float64 for dtype in numeric_df.dtypes
+    ]) if numeric and len(layout.summary_rows) else None
+
+    data = {}
+    for j, c in enumerate(df.columns):
+        col = df.iloc[:, j]
+        is_numeric = c in numeric and c not in ("勘定科目", "小分類", "部門")
+        if is_numeric and not isinstance(col.dtype, np.dtype):
+            values = col.to_numpy(dtype="float64", na_value=np.nan)
+        else:
+            values = col.to_numpy()
+        if not is_numeric:
+            out_dtype = object
+        elif sum_dtype is not None:
+            out_dtype = np.result_type(values.dtype, sum_dtype)
+        else:
+            out_dtype = values.dtype
+        out = np.empty(n_out, dtype=out_dtype)
+        out[src_rows] = values[src_pos]
+        if c in ("勘定科目", "小分類"):
+            out[inserted] = layout.labels[inserted]
+        elif c == "部門":
+            out[inserted] = dept
+        else:
+            out[layout.zero_rows] = 0
+            if len(layout.summary_rows):
+                out[layout.summary_rows] = _group_sums(values, layout) if is_numeric else np.nan
+        data[j] = out
+    result = pd.DataFrame(data)
+    result.columns = df.columns
+    return result
+
+
+def apply_layout_block(block: np.ndarray, layout: SummaryLayout, out: Optional[np.ndarray] = None) -> np.ndarray:
+    """
+    部門 × 勘定科目 × 列 の配列に、レイアウトの挿入行（0・小計）を加えた配列を返す。
+    out を指定すればそこに書き込む。
+    """
+    shape = (block.shape[0], len(layout.source), block.shape[2])
+    if out is None:
+        out = np.zeros(shape, dtype=block.dtype)
+    else:
+        out = out.reshape(shape)
+        out.fill(0)
+    src_rows = np.flatnonzero(layout.source >= 0)
+    out[:, src_rows] = block[:, layout.source[src_rows]]
+    if len(layout.summary_rows):
+        members = np.nan_to_num(block[:, layout.summary_members], nan=0.0)
+        out[:, layout.summary_rows] = np.add.reduceat(members, layout.summary_starts, axis=1)
+    return out
+
 
 def insert_summary_rows(
     df: pd.DataFrame,
@@ -7,96 +388,78 @@ def insert_summary_rows(
 ) -> pd.DataFrame:
     dept = selected_departments[0] if isinstance(selected_departments, list) else selected_departments
 
-    if not (df["小分類"] == "売上高").any():
-        new_row = pd.Series(0, index=df.columns)
-        new_row["勘定科目"] = "純売上高"
-        new_row["小分類"]   = "純売上高"
-        new_row["部門"]     = dept
-        df = pd.concat([pd.DataFrame([new_row]), df], ignore_index=True)
-
-    if not (df["小分類"] == "当期商品仕入").any():
-        idxs = df.index[df["小分類"] == "純売上高"]
-        if idxs.empty:
-            idxs = df.index[df["小分類"] == "売上高"]
-        if not idxs.empty:
-            insert_at = idxs[0]
-            row_begin = pd.Series(0, index=df.columns)
-            row_begin["勘定科目"] = "期首商品棚卸"
-            row_begin["小分類"]   = "期首商品棚卸"
-            row_begin["部門"]     = dept
-            row_pur = pd.Series(0, index=df.columns)
-            row_pur["勘定科目"] = "純仕入高"
-            row_pur["小分類"]   = "純仕入高"
-            row_pur["部門"]     = dept
-
-            top    = df.iloc[:insert_at+1]
-            bottom = df.iloc[insert_at+1:]
-            df = pd.concat([
-                top,
-                pd.DataFrame([row_begin, row_pur]),
-                bottom
-            ], ignore_index=True)
-
-    def _insert_summary_row(tmp: pd.DataFrame, targets: List[str], label: str) -> pd.DataFrame:
-        subset = tmp[tmp["小分類"].isin(targets)]
-        if subset.empty:
-            return tmp
-        last_idx = subset.index[-1]
-        sums = subset.select_dtypes(include="number").sum()
-        row = pd.Series(sums.to_dict(), name="summary")
-        row["勘定科目"] = label
-        row["小分類"]   = label
-        row["部門"]     = dept
-        top    = tmp.loc[:last_idx]
-        bottom = tmp.loc[last_idx+1:]
-        return pd.concat([top, pd.DataFrame([row]), bottom], ignore_index=True)
-
-    for targets, label in [
-        (["売上高"],       "純売上高"),
-        (["当期商品仕入"], "純仕入高"),
-        (["人件費"],       "人件費合計"),
-        (["人件費", "販売管理費"], "販売費及び一般管理費"),
-        (["営業外収益"],   "営業外収益合計"),
-        (["営業外費用"],   "営業外費用合計"),
-        (["特別利益"],     "特別利益合計"),
-        (["特別損失"],     "特別損失合計"),
-        (["法人税等"],     "法人税・住民税・事業税"),
-    ]:
-        df = _insert_summary_row(df, targets, label)
-
-    def _ensure_row(tmp: pd.DataFrame, prev_label: str, new_label: str) -> pd.DataFrame:
-        values = tmp["勘定科目"].values
-        if prev_label in values and new_label not in values:
-            idxs = tmp.index[tmp["勘定科目"] == prev_label]
-            if idxs.any():
-                last_idx = idxs[-1]
-                new = pd.Series(0, index=tmp.columns)
-                new["勘定科目"] = new_label
-                new["小分類"]   = new_label
-                new["部門"]     = dept
-                top    = tmp.iloc[:last_idx+1]
-                bottom = tmp.iloc[last_idx+1:]
-                return pd.concat([top, pd.DataFrame([new]), bottom], ignore_index=True)
-        return tmp
-
-    for prev, new in [
-        ("純仕入高",           "期末商品棚卸"),
-        ("純売上高",           "期首商品棚卸"),
-        ("期末商品棚卸",       "売上原価"),
-        ("売上原価",           "売上総利益"),
-        ("販売費及び一般管理費", "営業利益"),
-        ("営業利益",           "営業外収益合計"),
-        ("営業外収益合計",     "営業外費用合計"),
-        ("営業外費用合計",     "経常利益"),
-        ("経常利益",           "特別利益合計"),
-        ("特別利益合計",       "特別損失合計"),
-        ("特別損失合計",       "税引前当期純利益"),
-        ("税引前当期純利益",   "法人税・住民税・事業税"),
-        ("法人税・住民税・事業税", "税引後当期純利益"),
-    ]:
-        df = _ensure_row(df, prev, new)
+    layout = compile_summary_layout(_layout_key(df["勘定科目"]), _layout_key(df["小分類"]))
+    if not layout.has_inserts:
+        return df
+    return _apply_layout(df, layout, dept)
 
-    return df
+
+# 派生科目の計算式: (計算対象の勘定科目, [(参照する勘定科目, 係数), ...])
+# 上から順に評価し、後続の式は更新済みの値を参照する。
+FINANCIAL_FORMULAS: List[Tuple[str, List[Tuple[str, int]]]] = [
+    # 売上原価 = 期首商品棚卸 + 純仕入高 - 売上原価行の既存値
+    ("売上原価",         [("期首商品棚卸", 1), ("純仕入高", 1), ("売上原価", -1)]),
+    # 売上総利益 = 純売上高 - 売上原価
+    ("売上総利益",       [("純売上高", 1), ("売上原価", -1)]),
+    # 営業利益 = 売上総利益 - 販管費
+    ("営業利益",         [("売上総利益", 1), ("販売費及び一般管理費", -1)]),
+    # 経常利益 = 営業利益 + 営業外収益 - 営業外費用
+    ("経常利益",         [("営業利益", 1), ("営業外収益合計", 1), ("営業外費用合計", -1)]),
+    # 税引前利益 = 経常利益 + 特別利益 - 特別損失
+    ("税引前当期純利益", [("経常利益", 1), ("特別利益合計", 1), ("特別損失合計", -1)]),
+    # 税引後利益 = 税引前利益 - 税金
+    ("税引後当期純利益", [("税引前当期純利益", 1), ("法人税・住民税・事業税", -1)]),
+]
+
+
+def _first_positions(accounts: Sequence[str]) -> Dict[str, int]:
+    """勘定科目名 → 最初に現れる行位置"""
+    positions: Dict[str, int] = {}
+    for i, name in enumerate(accounts):
+        positions.setdefault(name, i)
+    return positions
+
+
+def compute_financials_block(block: np.ndarray, accounts: Sequence[str]) -> List[int]:
+    """
+    部門 × 勘定科目 × 月 の3次元配列 block (float64) に対して
+    FINANCIAL_FORMULAS の派生科目を全部門まとめて計算し、その場で書き換えます。
+    accounts は勘定科目軸の科目名です（全部門で共通のレイアウトであること）。
+    戻り値は更新した勘定科目軸の位置です。
+    """
+    positions = _first_positions(accounts)
+    updated: List[int] = []
+    for target, terms in FINANCIAL_FORMULAS:
+        names = [target] + [name for name, _ in terms]
+        if not all(name in positions for name in names):
+            continue
+        result = np.zeros(block.shape[0::2], dtype=block.dtype)
+        for name, sign in terms:
+            if sign > 0:
+                result += block[:, positions[name], :]
+            else:
+                result -= block[:, positions[name], :]
+        block[:, positions[target], :] = result
+        if positions[target] not in updated:
+            updated.append(positions[target])
+    return updated
+
+
+def _numeric_block(df: pd.DataFrame, cols: pd.Index) -> np.ndarray:
+    """月次数値列を float64 の2次元配列として取り出す（数値化できない値は NaN）。"""
+    values = df[cols]
+    if not all(dtype.kind in "biuf" for dtype in values.dtypes):
+        values = values.apply(pd.to_numeric, errors="coerce")
+    return values.to_numpy(dtype="float64", na_value=np.nan)
+
+
+def _write_back(df: pd.DataFrame, rows: np.ndarray, cols: pd.Index, values: np.ndarray) -> None:
+    """計算結果を指定行に書き戻す。整数列は値が整数で表せる限り整数のまま保つ。"""
+    for j, c in enumerate(cols):
+        col_values = values[:, j]
+        if df[c].dtype.kind in "iu" and np.isfinite(col_values).all():
+            col_values = col_values.astype(df[c].dtype)
+        df.iloc[rows, df.columns.get_loc(c)] = col_values
 
 
 def calculate_financials(df: pd.DataFrame) -> pd.DataFrame:
@@ -105,70 +468,468 @@ def calculate_financials(df: pd.DataFrame) -> pd.DataFrame:
     税引前当期純利益、税引後当期純利益を計算して反映します。
     """
     cols = df.columns[4:]  # 月次数値列
+    accounts = df["勘定科目"].tolist()
+    block = _numeric_block(df, cols)[np.newaxis]
+    updated = compute_financials_block(block, accounts)
+    if updated:
+        _write_back(df, np.array(updated), cols, block[0, updated, :])
+    return df
 
-    # 売上原価 = 期首商品棚卸 + 純仕入高 - 期末商品棚卸
-    if all(x in df["勘定科目"].values for x in ["期首商品棚卸", "純仕入高", "売上原価"]):
-        i0 = df.index[df["勘定科目"] == "期首商品棚卸"][0]
-        i1 = df.index[df["勘定科目"] == "純仕入高"][0]
-        i2 = df.index[df["勘定科目"] == "売上原価"][0]
-        for c in cols:
-            b = pd.to_numeric(df.at[i0, c], errors="coerce")
-            p = pd.to_numeric(df.at[i1, c], errors="coerce")
-            e = pd.to_numeric(df.at[i2, c], errors="coerce")
-            df.at[i2, c] = b + p - e
 
-    # 売上総利益 = 純売上高 - 売上原価
-    if all(x in df["勘定科目"].values for x in ["純売上高", "売上原価", "売上総利益"]):
-        i0 = df.index[df["勘定科目"] == "純売上高"][0]
-        i1 = df.index[df["勘定科目"] == "売上原価"][0]
-        i2 = df.index[df["勘定科目"] == "売上総利益"][0]
-        for c in cols:
-            s = pd.to_numeric(df.at[i0, c], errors="coerce")
-            k = pd.to_numeric(df.at[i1, c], errors="coerce")
-            df.at[i2, c] = s - k
 
-    # 営業利益 = 売上総利益 - 販管費
-    if all(x in df["勘定科目"].values for x in ["売上総利益", "販売費及び一般管理費", "営業利益"]):
-        i0 = df.index[df["勘定科目"] == "売上総利益"][0]
-        i1 = df.index[df["勘定科目"] == "販売費及び一般管理費"][0]
-        i2 = df.index[df["勘定科目"] == "営業利益"][0]
-        for c in cols:
-            g = pd.to_numeric(df.at[i0, c], errors="coerce")
-            h = pd.to_numeric(df.at[i1, c], errors="coerce")
-            df.at[i2, c] = g - h
 
-    # 経常利益 = 営業利益 + 営業外収益 - 営業外費用
-    if all(x in df["勘定科目"].values for x in ["営業利益", "営業外収益合計", "営業外費用合計", "経常利益"]):
-        i0 = df.index[df["勘定科目"] == "営業利益"][0]
-        i1 = df.index[df["勘定科目"] == "営業外収益合計"][0]
-        i2 = df.index[df["勘定科目"] == "営業外費用合計"][0]
-        i3 = df.index[df["勘定科目"] == "経常利益"][0]
-        for c in cols:
-            o0 = pd.to_numeric(df.at[i0, c], errors="coerce")
-            o1 = pd.to_numeric(df.at[i1, c], errors="coerce")
-            o2 = pd.to_numeric(df.at[i2, c], errors="coerce")
-            df.at[i3, c] = o0 + o1 - o2
+# 計算する 部門 × 行 × 列 のセル数がこれ以上なら、部門を分けてプロセスプールで並列に計算する。
+# これ未満では直列の方が速い（プロセスへの受け渡しの時間の方が大きい）。
+PARALLEL_MIN_CELLS = 20_000_000
+# 並列に計算するプロセス数（環境変数 FREEE_DEPARTMENT_WORKERS で変更、1 以下なら常に直列）
+PARALLEL_WORKERS = int(os.environ.get("FREEE_DEPARTMENT_WORKERS", os.cpu_count() or 1))
 
-    # 税引前利益 = 経常利益 + 特別利益 - 特別損失
-    if all(x in df["勘定科目"].values for x in ["経常利益", "特別利益合計", "特別損失合計", "税引前当期純利益"]):
-        i0 = df.index[df["勘定科目"] == "経常利益"][0]
-        i1 = df.index[df["勘定科目"] == "特別利益合計"][0]
-        i2 = df.index[df["勘定科目"] == "特別損失合計"][0]
-        i3 = df.index[df["勘定科目"] == "税引前当期純利益"][0]
-        for c in cols:
-            v0 = pd.to_numeric(df.at[i0, c], errors="coerce")
-            v1 = pd.to_numeric(df.at[i1, c], errors="coerce")
-            v2 = pd.to_numeric(df.at[i2, c], errors="coerce")
-            df.at[i3, c] = v0 + v1 - v2
+_pools: Dict[int, ProcessPoolExecutor] = {}
+_pool_lock = threading.Lock()
 
-    # 税引後利益 = 税引前利益 - 税金
-    if all(x in df["勘定科目"].values for x in ["税引前当期純利益", "法人税・住民税・事業税", "税引後当期純利益"]):
-        i0 = df.index[df["勘定科目"] == "税引前当期純利益"][0]
-        i1 = df.index[df["勘定科目"] == "法人税・住民税・事業税"][0]
-        i2 = df.index[df["勘定科目"] == "税引後当期純利益"][0]
-        for c in cols:
-            p = pd.to_numeric(df.at[i0, c], errors="coerce")
-            t = pd.to_numeric(df.at[i1, c], errors="coerce")
-            df.at[i2, c] = p - t
 
-    return df
+def _process_pool(workers: int) -> ProcessPoolExecutor:
+    """部門の計算用のプロセスプール（プロセス数ごとに初回に作成し、以降は使い回す）"""
+    with _pool_lock:
+        if workers not in _pools:
+            # Streamlit などスレッドを使うプロセスから fork しないよう spawn で起動する
+            _pools[workers] = ProcessPoolExecutor(
+                max_workers=workers, mp_context=multiprocessing.get_context("spawn")
+            )
+        return _pools[workers]
+
+
+@atexit.register
+def _shutdown_process_pools() -> None:
+    """終了時に部門の計算用のプロセスプールのプロセスを終了させる。"""
+    with _pool_lock:
+        pools = list(_pools.values())
+        _pools.clear()
+    for pool in pools:
+        pool.shutdown(wait=True, cancel_futures=True)
+
+
+def _compute_shared_chunk(
+    in_name: str,
+    in_shape: Tuple[int, int, int],
+    out_name: str,
+    out_shape: Tuple[int, int, int],
+    start: int,
+    stop: int,
+    layout: "SummaryLayout",
+    out_accounts: Sequence[str],
+) -> int:
+    """共有メモリ上の部門 start:stop を計算して、共有メモリの出力に書き込む（プロセスプールで実行）。"""
+    shm_in = SharedMemory(name=in_name)
+    shm_out = SharedMemory(name=out_name)
+    try:
+        src = np.ndarray(in_shape, dtype=np.float64, buffer=shm_in.buf)
+        dst = np.ndarray(out_shape, dtype=np.float64, buffer=shm_out.buf)
+        block = apply_layout_block(src[start:stop], layout)
+        compute_financials_block(block, out_accounts)
+        dst[start:stop] = block
+        del src, dst  # 共有メモリを閉じる前に配列の参照を外す
+    finally:
+        shm_in.close()
+        shm_out.close()
+    return stop - start
+
+
+def _compute_parallel(
+    cube: FinanceCube,
+    depts: Sequence[str],
+    layout: "SummaryLayout",
+    out_accounts: Sequence[str],
+    workers: int,
+    out: Optional[np.ndarray] = None,
+) -> np.ndarray:
+    """部門を workers 個程度に分け、入出力を共有メモリに置いてプロセスプールで計算する。"""
+    in_shape = (len(depts), len(cube.accounts), len(cube.columns))
+    out_shape = (len(depts), len(layout.source), len(cube.columns))
+    shm_in = SharedMemory(create=True, size=max(1, int(np.prod(in_shape)) * 8))
+    shm_out = SharedMemory(create=True, size=max(1, int(np.prod(out_shape)) * 8))
+    try:
+        cube.dense(depts, out=np.ndarray(in_shape, dtype=np.float64, buffer=shm_in.buf))
+        bounds = np.linspace(0, len(depts), min(len(depts), workers * 2) + 1).astype(int)
+        pool = _process_pool(workers)
+        futures = [
+            pool.submit(
+                _compute_shared_chunk, shm_in.name, in_shape, shm_out.name, out_shape,
+                int(s), int(e), layout, list(out_accounts),
+            )
+            for s, e in zip(bounds[:-1], bounds[1:]) if e > s
+        ]
+        for future in futures:
+            future.result()
+        result = np.ndarray(out_shape, dtype=np.float64, buffer=shm_out.buf)
+        if out is None:
+            out = np.empty(out_shape)
+        out[...] = result
+        del result  # 共有メモリを閉じる前に配列の参照を外す
+        return out
+    finally:
+        shm_in.close()
+        shm_in.unlink()
+        shm_out.close()
+        shm_out.unlink()
+
+
+def compute_department_blocks(
+    cube: FinanceCube,
+    depts: Sequence[str],
+    layout: "SummaryLayout",
+    out_accounts: Sequence[str],
+    workers: Optional[int] = None,
+    out: Optional[np.ndarray] = None,
+) -> np.ndarray:
+    """
+    depts の部門について小計行を挿入し、派生科目を計算した 部門 × 行 × 列 の配列を返す。
+    セル数が PARALLEL_MIN_CELLS 以上で workers が2以上ならプロセスプールで並列に計算し、
+    それ以外は全部門まとめて直列に計算する。結果は depts の順に並ぶ（out を指定すればそこに書き込む）。
+    """
+    workers = PARALLEL_WORKERS if workers is None else workers
+    n_cells = len(depts) * len(layout.source) * len(cube.columns)
+    if workers > 1 and len(depts) > 1 and n_cells >= PARALLEL_MIN_CELLS:
+        with stage(f"compute_departments_parallel_{workers}", rows=len(depts) * len(layout.source)):
+            return _compute_parallel(cube, depts, layout, out_accounts, workers, out)
+    n_rows = len(depts) * len(layout.source)
+    with stage("insert_summary_rows", rows=n_rows):
+        block = apply_layout_block(cube.dense(depts), layout, out)
+    with stage("calculate_financials", rows=n_rows):
+        compute_financials_block(block, out_accounts)
+    return block
+
+
+# 部門ごとの計算結果（小計行の挿入・派生科目の計算後）を保持する上限
+DEPARTMENT_CACHE_BYTES = 256 * 1024 * 1024
+
+
+class DepartmentCache:
+    """
+    部門のデータの内容のハッシュ → 計算済みの配列 (行数, 列数)。
+    合計サイズが max_bytes を超えると最も古く使われたものから破棄する。
+    Streamlit の複数セッションから使われるためロックで保護する。
+    """
+
+    def __init__(self, max_bytes: int = DEPARTMENT_CACHE_BYTES):
+        self.max_bytes = max_bytes
+        self._blocks: "OrderedDict[str, np.ndarray]" = OrderedDict()
+        self._nbytes = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key: str) -> Optional[np.ndarray]:
+        with self._lock:
+            block = self._blocks.get(key)
+            if block is None:
+                self.misses += 1
+                return None
+            self._blocks.move_to_end(key)
+            self.hits += 1
+            return block
+
+    def put(self, key: str, block: np.ndarray) -> None:
+        with self._lock:
+            if key in self._blocks or block.nbytes > self.max_bytes:
+                return
+            self._blocks[key] = block
+            self._nbytes += block.nbytes
+            while self._nbytes > self.max_bytes:
+                _, old = self._blocks.popitem(last=False)
+                self._nbytes -= old.nbytes
+
+    def clear(self) -> None:
+        with self._lock:
+            self._blocks.clear()
+            self._nbytes = 0
+
+
+department_cache = DepartmentCache()
+
+
+def computed_department_blocks(
+    cube: FinanceCube,
+    depts: Sequence[str],
+    layout: "SummaryLayout",
+    out_accounts: Sequence[str],
+) -> np.ndarray:
+    """
+    depts の部門について、小計行を挿入して派生科目を計算した 部門 × 行 × 列 の配列を返す。
+    部門のデータが前回と同じなら department_cache の結果を使い、なければ result_store（ディスク）に
+    保存された結果を使って、変わった部門だけ計算する（毎月同じ前期の推移表なら前期は計算しない）。
+    """
+    out = np.empty((len(depts), len(layout.source), len(cube.columns)))
+    keys = [cube.department_key(d) for d in depts]
+    missing = []
+    for k, key in enumerate(keys):
+        cached = department_cache.get(key)
+        if cached is None:
+            missing.append(k)
+        else:
+            out[k] = cached
+    if missing and result_store.enabled:
+        with stage("load_stored_departments", rows=len(missing)):
+            stored = result_store.get_arrays("department", [keys[k] for k in missing], out.shape[1:])
+        remaining = []
+        for k in missing:
+            block = stored.get(keys[k])
+            if block is not None:
+                out[k] = block
+                department_cache.put(keys[k], out[k].copy())
+            else:
+                remaining.append(k)
+        missing = remaining
+    if len(missing) == len(depts):
+        # 全部門を計算する場合は、結果の配列に直接書き込む
+        compute_department_blocks(cube, depts, layout, out_accounts, out=out)
+    elif missing:
+        block = compute_department_blocks(cube, [depts[k] for k in missing], layout, out_accounts)
+        for i, k in enumerate(missing):
+            out[k] = block[i]
+    for k in missing:
+        department_cache.put(keys[k], out[k].copy())
+    if missing and result_store.enabled:
+        with stage("store_departments", rows=len(missing)):
+            result_store.put_arrays("department", {keys[k]: out[k] for k in missing})
+    return out
+
+
+@dataclass
+class Comparison:
+    """
+    build_comparison の結果。final_df は部門ごとに連続した行で並び、
+    partitions に各部門の行範囲を持つ。anomalies は今期の月の変動の大きいセル（final_df の行順）。
+    """
+    final_df: pd.DataFrame
+    partitions: Dict[str, slice]
+    anomalies: Optional[AnomalyMask] = None
+
+    def department(self, dept: str) -> pd.DataFrame:
+        """部門の行をコピーせずに取り出す。"""
+        return self.final_df.iloc[self.partitions[dept]]
+
+    def extend(self, other: "Comparison") -> "Comparison":
+        """other（build_rollups の合算など）の行を後ろに加えた Comparison を返す。"""
+        offset = len(self.final_df)
+        partitions = dict(self.partitions)
+        for name, part in other.partitions.items():
+            partitions[name] = slice(part.start + offset, part.stop + offset)
+        final_df = pd.concat([self.final_df, other.final_df], ignore_index=True)
+        anomalies = None
+        if self.anomalies is not None and other.anomalies is not None:
+            anomalies = self.anomalies.extend(other.anomalies)
+        return Comparison(final_df, partitions, anomalies)
+
+
+def _comparison_axes(cube: FinanceCube) -> Tuple[SummaryLayout, pd.DataFrame, List[str]]:
+    """小計行を挿入した後の行構成・行の見出し（勘定科目コード, 勘定科目, 小分類）・勘定科目名"""
+    accounts = cube.accounts
+    layout = compile_summary_layout(_layout_key(accounts["勘定科目"]), _layout_key(accounts["小分類"]))
+    labels = _apply_layout(accounts.assign(部門=None), layout, None)
+    return layout, labels, labels["勘定科目"].tolist()
+
+
+def _assemble_comparison(
+    this_cube: FinanceCube,
+    before_cube: FinanceCube,
+    names: List[str],
+    layout: SummaryLayout,
+    labels: pd.DataFrame,
+    prior: np.ndarray,
+    current: np.ndarray,
+    prior_avg_source: Optional[np.ndarray],
+    rules: AnomalyRules = DEFAULT_RULES,
+) -> Comparison:
+    """
+    計算済みの前期・今期の 部門 × 行 × 列 の配列から2期比較表を組み立てる。
+    prior_avg_source は前期の 部門 × 勘定科目軸 の平均（なければ None）。
+    前期の配列は月の列だけを持ち、前期累計はここで今期の経過月に対応する月から求める。
+    今期の月の変動の大きいセルは、全部門の 部門 × 行 × 月 の配列をまとめて rules で判定する。
+    """
+    n_out = len(labels)
+
+    # 前期: 今期の経過月と期首からの月が同じ月の累計を求める（連続した列はコピーせずにビューで合計する）
+    aligned = before_cube.months.align(this_cube.months)
+    prior_total = prior[:, :, prior_month_columns(this_cube, before_cube)].sum(axis=2)
+
+    # 前年平均は元の勘定科目の行にだけ付ける
+    prior_avg = np.full((len(names), n_out), np.nan)
+    if prior_avg_source is not None:
+        src_rows = np.flatnonzero(layout.source >= 0)
+        prior_avg[:, src_rows] = prior_avg_source[:, layout.source[src_rows]]
+
+    # 今期: 前期累計・増減・前年平均を付ける
+    columns = list(this_cube.columns)
+    if "増減" in columns and "今期累計" in columns:
+        current[:, :, columns.index("増減")] = current[:, :, columns.index("今期累計")] - prior_total
+
+    data = {c: np.tile(labels[c].to_numpy(), len(names)) for c in ["勘定科目コード", "勘定科目", "小分類"]}
+    data["前期累計"] = prior_total.ravel()
+    data["部門"] = np.repeat(np.array(names, dtype=object), n_out)
+    flat = current.reshape(-1, len(columns))
+    for j, c in enumerate(columns):
+        if c != "前期累計":
+            data[c] = flat[:, j]
+    data["前年平均"] = prior_avg.ravel()
+    with stage("assemble_comparison", rows=len(names) * n_out):
+        final_df = pd.DataFrame(data)
+
+    with stage("detect_anomalies", rows=len(names) * n_out):
+        mask = detect_anomalies(
+            current[:, :, _as_slice(this_cube.month_positions)],
+            prior_avg if prior_avg_source is not None else None,
+            rules,
+            prior=prior[:, :, _as_slice(before_cube.month_positions)],
+            prior_positions=aligned,
+        )
+        mask &= ~np.isnan(prior_avg)[:, :, np.newaxis]  # 前年平均と比較する元の勘定科目の行だけ
+        anomalies = AnomalyMask(this_cube.months.labels, mask.reshape(-1, len(this_cube.months)))
+
+    partitions = {name: slice(k * n_out, (k + 1) * n_out) for k, name in enumerate(names)}
+    return Comparison(final_df, partitions, anomalies)
+
+
+def build_comparison(
+    this_cube: FinanceCube,
+    before_cube: FinanceCube,
+    depts: Sequence[str],
+    rules: AnomalyRules = DEFAULT_RULES,
+) -> Comparison:
+    """
+    今期・前期の FinanceCube から、選択部門の2期比較表を全部門まとめて作成します。
+    両期とも同じ勘定科目軸なので、小計行を挿入した後の行は部門・行位置で対応する。
+    変動の大きいセルは rules で判定する（anomaly.AnomalyRules）。
+    """
+    depts = list(depts)
+    layout, labels, out_accounts = _comparison_axes(this_cube)
+
+    # 小計行の挿入・派生科目の計算は部門ごとに保持し、データが変わった部門だけ計算する
+    prior = computed_department_blocks(before_cube, depts, layout, out_accounts)
+    current = computed_department_blocks(this_cube, depts, layout, out_accounts)
+
+    # 前年平均は派生科目を計算する前の元の数値の、今期の経過月に対応する月の平均
+    month_cols = prior_month_columns(this_cube, before_cube)
+    prior_avg_source = np.zeros((len(depts), len(before_cube.accounts)))
+    for k, dept in enumerate(depts):
+        idx, values = before_cube.department_entries(dept)
+        prior_avg_source[k, idx] = _monthly_average(values[:, month_cols])
+
+    return _assemble_comparison(
+        this_cube, before_cube, depts, layout, labels, prior, current, prior_avg_source, rules
+    )
+
+
+@dataclass(frozen=True)
+class DepartmentGroup:
+    """
+    部門の合算（連結）の定義。members には部門名または他の合算の名前を指定でき、
+    合算を入れ子にして階層（例: 全社 ← 東日本・西日本 ← 各部門）を作れる。
+    """
+    name: str
+    members: Tuple[str, ...]
+
+
+def parse_department_groups(text: str) -> List[DepartmentGroup]:
+    """
+    1行に1つ「合算名: 部門, 部門, ...」の形式で書いた合算の定義を読み込みます。
+    区切りは「:」「：」、部門の区切りは「,」「、」。空行と # で始まる行は無視します。
+    """
+    groups: List[DepartmentGroup] = []
+    for line_no, line in enumerate(text.splitlines(), start=1):
+        line = line.strip()
+        if not line or line.startswith("#"):
+            continue
+        name, sep, rest = line.replace("：", ":").partition(":")
+        name = name.strip()
+        if not sep or not name:
+            raise ValueError(f"部門の合算の {line_no} 行目は「合算名: 部門, 部門」の形式で指定してください")
+        members = tuple(m.strip() for m in rest.replace("、", ",").split(",") if m.strip())
+        groups.append(DepartmentGroup(name, members))
+    return groups
+
+
+def resolve_department_groups(
+    groups: Sequence[DepartmentGroup],
+    departments: Sequence[str],
+) -> Dict[str, List[str]]:
+    """
+    合算名 → 含まれる部門（departments の順、重複なし）。入れ子の合算は部門まで展開する。
+    部門名と重複する合算名・存在しない部門・循環する定義は ValueError。
+    """
+    by_name: Dict[str, DepartmentGroup] = {}
+    for group in groups:
+        if group.name in departments:
+            raise ValueError(f"合算の名前「{group.name}」は部門名と重複しています")
+        if group.name in by_name:
+            raise ValueError(f"合算「{group.name}」が複数回定義されています")
+        by_name[group.name] = group
+
+    order = {dept: i for i, dept in enumerate(departments)}
+    resolved: Dict[str, List[str]] = {}
+
+    def _expand(name: str, path: Tuple[str, ...]) -> List[str]:
+        if name in resolved:
+            return resolved[name]
+        if name in path:
+            raise ValueError(f"合算「{name}」の定義が循環しています")
+        members = set()
+        for member in by_name[name].members:
+            if member in order:
+                members.add(member)
+            elif member in by_name:
+                members.update(_expand(member, path + (name,)))
+            else:
+                raise ValueError(f"合算「{name}」の「{member}」は部門にも合算にもありません")
+        resolved[name] = sorted(members, key=order.__getitem__)
+        return resolved[name]
+
+    return {group.name: _expand(group.name, ()) for group in groups}
+
+
+def rollup_dense(cube: FinanceCube, groups: Dict[str, List[str]]) -> np.ndarray:
+    """
+    合算 × 全勘定科目 × 数値列 の合計。合算に含まれる部門の数値を、
+    合算 × 部門 の 0/1 行列との1回の行列積でまとめて合計する。
+    """
+    members = [d for d in cube.departments if any(d in depts for depts in groups.values())]
+    position = {dept: k for k, dept in enumerate(members)}
+    weights = np.zeros((len(groups), len(members)))
+    for g, depts in enumerate(groups.values()):
+        weights[g, [position[d] for d in depts]] = 1.0
+    return np.tensordot(weights, cube.dense(members), axes=1)
+
+
+def build_rollups(
+    this_cube: FinanceCube,
+    before_cube: FinanceCube,
+    groups: Sequence[DepartmentGroup],
+    rules: AnomalyRules = DEFAULT_RULES,
+) -> Comparison:
+    """
+    部門の合算ごとの2期比較表を作成します（部門名の代わりに合算名の行になる）。
+    部門の計算結果は合計せず、元の数値を合算ごとに合計してから小計行の挿入・派生科目
+    （売上総利益・営業利益・経常利益など）の計算をやり直す。build_comparison とは独立に計算でき、
+    Comparison.extend で部門の比較表の後ろに加える。
+    """
+    resolved = resolve_department_groups(groups, this_cube.departments)
+    names = list(resolved)
+    layout, labels, out_accounts = _comparison_axes(this_cube)
+    n_rows = len(names) * len(layout.source)
+
+    with stage("rollup_departments", rows=n_rows):
+        prior_raw = rollup_dense(before_cube, resolved)
+        current_raw = rollup_dense(this_cube, resolved)
+    with stage("insert_summary_rows", rows=n_rows):
+        prior = apply_layout_block(prior_raw, layout)
+        current = apply_layout_block(current_raw, layout)
+    with stage("calculate_financials", rows=n_rows):
+        compute_financials_block(prior, out_accounts)
+        compute_financials_block(current, out_accounts)
+
+    # 前年平均も部門の平均（切り捨て済み）を合計せず、合計した前期の月から部門の比較表と同じく求める
+    prior_avg_source = _monthly_average(prior_raw[:, :, prior_month_columns(this_cube, before_cube)])
+
+    return _assemble_comparison(
+        this_cube, before_cube, names, layout, labels, prior, current, prior_avg_source, rules
+    )
@@ -0,0 +1,94 @@
+"""
+推移表の月の列（"2025/04"・"2025年4月" など）を解析した会計期間の軸。
+
+今期・前期の月は列の位置ではなく、期首からの月（今期の 2025/04 と前期の 2024/04 など）で対応付けます。
+月として解析できない見出しがある場合は、従来どおり列の位置で対応付けます。
+"""
+import re
+from dataclasses import dataclass
+from typing import Iterable, List, Optional, Sequence, Tuple
+
+import numpy as np
+
+# 月の列ではない列（推移表の集計列と、取り込み時に追加する列）
+NON_MONTH_COLUMNS = frozenset({
+    "勘定科目", "勘定科目コード", "部門", "小分類",
+    "期間累計", "前期累計", "今期累計", "増減", "平均", "前年平均",
+})
+
+_YEAR_MONTH = re.compile(r"^\s*(\d{4})\s*[/\-.年]\s*(\d{1,2})\s*月?\s*$")
+_MONTH = re.compile(r"^\s*(\d{1,2})\s*月\s*$")
+
+Period = Tuple[Optional[int], int]  # (年, 月)。年のない見出しは年が None
+
+
+def parse_month_label(label) -> Optional[Period]:
+    """月の列の見出しを (年, 月) にする。月として解析できなければ None。"""
+    text = str(label)
+    match = _YEAR_MONTH.match(text)
+    if match:
+        year, month = int(match.group(1)), int(match.group(2))
+    else:
+        match = _MONTH.match(text)
+        if not match:
+            return None
+        year, month = None, int(match.group(1))
+    return (year, month) if 1 <= month <= 12 else None
+
+
+def month_columns(columns: Iterable[str]) -> List[str]:
+    """列の見出しのうち月の列（NON_MONTH_COLUMNS 以外）を、元の順に返す。"""
+    return [c for c in columns if c not in NON_MONTH_COLUMNS]
+
+
+@dataclass(frozen=True)
+class MonthAxis:
+    """月の列の見出しと、解析した (年, 月)"""
+    labels: Tuple[str, ...]
+    periods: Tuple[Optional[Period], ...]
+
+    @classmethod
+    def from_columns(cls, columns: Sequence[str]) -> "MonthAxis":
+        labels = tuple(month_columns(columns))
+        return cls(labels, tuple(parse_month_label(c) for c in labels))
+
+    def __len__(self) -> int:
+        return len(self.labels)
+
+    @property
+    def parsed(self) -> bool:
+        """全ての月の見出しを解析できたか"""
+        return bool(self.labels) and all(p is not None for p in self.periods)
+
+    @property
+    def has_years(self) -> bool:
+        return self.parsed and all(p[0] is not None for p in self.periods)
+
+    def fiscal_months(self, start: Period, year_offset: int = 0) -> np.ndarray:
+        """
+        start（期首の (年, 月)）から数えた各列の月（0始まり）。year_offset 年前の期の列として数える。
+        年のない見出しは 12 か月で循環させる。
+        """
+        start_year, start_month = start
+        if self.has_years and start_year is not None:
+            return np.array(
+                [(y - (start_year - year_offset)) * 12 + (m - start_month) for y, m in self.periods],
+                dtype=np.int64,
+            )
+        return np.array([(m - start_month) % 12 for _, m in self.periods], dtype=np.int64)
+
+    def align(self, current: "MonthAxis") -> np.ndarray:
+        """
+        current（今期）の各月に対応する、この軸（前期）の列位置（対応する月がなければ -1）。
+        両方の見出しを解析できれば期首からの月で、できなければ列の位置で対応付ける。
+        """
+        if self.parsed and current.parsed:
+            start = current.periods[0]
+            current_months = current.fiscal_months(start)
+            prior_months = self.fiscal_months(start, year_offset=1)
+            position = {}
+            for i, fm in enumerate(prior_months.tolist()):
+                position.setdefault(fm, i)
+            return np.array([position.get(fm, -1) for fm in current_months.tolist()], dtype=np.intp)
+        n = len(current)
+        return np.array([i if i < len(self) else -1 for i in range(n)], dtype=np.intp)
@@ -0,0 +1,167 @@
+"""
+freee から出力した CSV（勘定科目一覧・推移表）の読み込み。
+
+cp932 で読み込み、列の型を先に決めて解析します。
+金額列は桁区切りのカンマを除いて float64 に、勘定科目・小分類・部門はカテゴリ型にします。
+pyarrow があれば pyarrow の CSV リーダーを使います。
+"""
+import csv
+from io import BytesIO
+from pathlib import Path
+from typing import Dict, List, Optional
+
+import pandas as pd
+
+from diagnostics import stage
+
+try:
+    import pyarrow as pa
+    import pyarrow.compute as pc
+    import pyarrow.csv as pacsv
+except ImportError:  # pyarrow がなければ pandas の C パーサーで読む
+    pa = None
+
+ENCODING = "cp932"
+DEFAULT_ENGINE = "pyarrow" if pa is not None else "c"
+
+# カテゴリ型で読み込む列
+KAMOKU_CATEGORY_COLUMNS = ["勘定科目", "小分類", "中分類", "大分類"]
+SUII_CATEGORY_COLUMNS = ["部門"]  # 2列目（勘定科目）もカテゴリ型にする
+# 推移表で金額として扱わない列
+SUII_KEY_COLUMNS = {"勘定科目コード", "部門"}
+
+
+def _read_bytes(source) -> bytes:
+    if isinstance(source, bytes):
+        return source
+    if isinstance(source, (str, Path)):
+        return Path(source).read_bytes()
+    return source.read()
+
+
+def _header(data: bytes, header_row: int) -> List[str]:
+    """header_row 行目（0始まり）の列名"""
+    lines = data.split(b"\n", header_row + 1)
+    if len(lines) <= header_row or not lines[header_row].strip():
+        raise ValueError(f"CSV に {header_row + 1} 行目の見出しがありません")
+    return next(csv.reader([lines[header_row].decode(ENCODING).rstrip("\r")]))
+
+
+def _to_number(values: pd.Series) -> pd.Series:
+    """桁区切りのカンマを除いて数値にする（数値にできない値は NaN）。"""
+    if values.dtype.kind in "biuf":
+        return values.astype("float64")
+    return pd.to_numeric(values.astype("string").str.replace(",", "", regex=False), errors="coerce").astype("float64")
+
+
+def _read_c(data: bytes, header_row: int, categories: List[str], amounts: List[str]) -> pd.DataFrame:
+    dtype: Dict[str, str] = {c: "category" for c in categories}
+    try:
+        return pd.read_csv(
+            BytesIO(data), encoding=ENCODING, header=header_row,
+            dtype={**dtype, **{c: "float64" for c in amounts}}, thousands=",",
+        )
+    except ValueError:
+        # 数値にできない金額があれば、文字列で読んでから数値に変換する
+        df = pd.read_csv(BytesIO(data), encoding=ENCODING, header=header_row, dtype=dtype)
+        for c in amounts:
+            df[c] = _to_number(df[c])
+        return df
+
+
+def _read_pyarrow(data: bytes, header_row: int, categories: List[str], amounts: List[str]) -> pd.DataFrame:
+    def _read(amount_type):
+        column_types = {c: pa.string() for c in categories}
+        column_types.update({c: amount_type for c in amounts})
+        return pacsv.read_csv(
+            BytesIO(data),
+            read_options=pacsv.ReadOptions(encoding=ENCODING, skip_rows=header_row),
+            convert_options=pacsv.ConvertOptions(column_types=column_types, strings_can_be_null=True),
+        )
+
+    try:
+        table = _read(pa.float64())
+    except pa.ArrowInvalid:
+        # 桁区切りのカンマなどを含む場合は文字列で読み、カンマを除いて変換する
+        table = _read(pa.string())
+        for c in amounts:
+            i = table.schema.get_field_index(c)
+            cleaned = pc.replace_substring(table.column(i), ",", "")
+            try:
+                converted = pc.cast(cleaned, pa.float64())
+            except pa.ArrowInvalid:
+                converted = pa.array(_to_number(cleaned.to_pandas()), type=pa.float64())
+            table = table.set_column(i, c, converted)
+    for c in categories:
+        i = table.schema.get_field_index(c)
+        table = table.set_column(i, c, pc.dictionary_encode(table.column(i)))
+    for i, field in enumerate(table.schema):
+        if pa.types.is_null(field.type):  # 全て空欄の列は pandas と同じく float64 にする
+            table = table.set_column(i, field.name, table.column(i).cast(pa.float64()))
+    return table.to_pandas()
+
+
+def read_freee_csv(
+    source,
+    header_row: int,
+    categories: List[str],
+    amounts: List[str],
+    engine: Optional[str] = None,
+) -> pd.DataFrame:
+    """categories をカテゴリ型、amounts を float64 として CSV を読み込みます。"""
+    data = _read_bytes(source)
+    engine = engine or DEFAULT_ENGINE
+    if engine == "pyarrow" and pa is None:
+        raise ImportError("engine='pyarrow' には pyarrow が必要です")
+    with stage(f"read_csv_{engine}") as s:
+        if engine == "pyarrow":
+            df = _read_pyarrow(data, header_row, categories, amounts)
+        else:
+            df = _read_c(data, header_row, categories, amounts)
+        s.rows = len(df)
+    return df
+
+
+def read_kamoku_csv(source, engine: Optional[str] = None) -> pd.DataFrame:
+    """freee の勘定科目一覧(CSV)を読み込みます。ショートカット2 を勘定科目コードとして扱います。"""
+    data = _read_bytes(source)
+    names = _header(data, 0)
+    categories = [c for c in KAMOKU_CATEGORY_COLUMNS if c in names]
+    kamoku_df = read_freee_csv(data, 0, categories, [], engine)
+    if '勘定科目コード' not in kamoku_df.columns and 'ショートカット2' in kamoku_df.columns:
+        kamoku_df.rename(columns={'ショートカット2': '勘定科目コード'}, inplace=True)
+    return kamoku_df
+
+
+def read_suii_csv(source, engine: Optional[str] = None) -> pd.DataFrame:
+    """
+    freee の推移表(CSV)を読み込みます。
+    部門が空欄の行は、勘定科目コードがあれば「合計」、なければ「集計科目」とし、
+    期間累計列は4列目に移動します。
+    """
+    data = _read_bytes(source)
+    names = _header(data, 1)
+    account_col = names[1]
+    categories = [account_col] + [c for c in SUII_CATEGORY_COLUMNS if c in names]
+    amounts = [c for c in names[2:] if c not in SUII_KEY_COLUMNS]
+    df = read_freee_csv(data, 1, categories, amounts, engine)
+
+    df.rename(columns={account_col: "勘定科目"}, inplace=True)
+    df = df[df['勘定科目'] != '当期商品仕入'].reset_index(drop=True)
+    df["勘定科目"] = df["勘定科目"].cat.remove_unused_categories()
+    if '部門' not in df.columns:
+        df.insert(2, '部門', pd.Categorical([''] * len(df)))  # 3列目（0始まり）に空の「部門」列を追加
+
+    if {"勘定科目コード","部門"}.issubset(df.columns):
+        m1 = df["勘定科目コード"].notna() & df["部門"].isna()
+        m2 = df["勘定科目コード"].isna()  & df["部門"].isna()
+        new_categories = [c for c in ("合計", "集計科目") if c not in df["部門"].cat.categories]
+        df["部門"] = df["部門"].cat.add_categories(new_categories)
+        df.loc[m1, "部門"] = "合計"
+        df.loc[m2, "部門"] = "集計科目"
+    if "期間累計" in df.columns:
+        cols = list(df.columns)
+        cols.remove("期間累計")
+        cols.insert(3, "期間累計")
+        df = df[cols]
+    return df
@@ -1,443 +1,306 @@
+import hashlib
+import os
 import streamlit as st
-import pandas as pd
-from io import BytesIO
-import numpy as np 
-from PIL import Image
-from finance_utils import insert_summary_rows, calculate_financials
+import diagnostics
+from diagnostics import stage
+
+# pandas・numpy・PIL・xlsxwriter などは最初に使うときに import し、
+# ファイルをアップロードする前の画面を早く表示する。
 
 st.set_page_config(page_title="for_freee_user", layout="wide")
-pd.options.display.float_format = '{:,.0f}'.format
 
-image1 = Image.open("image1.png")
-image2 = Image.open("image2.png")
-image3 = Image.open("image3.png")
-image4 = Image.open("image4.png")
-image5 = Image.open("image5.png")
-image6 = Image.open("image6.png")
+
+def file_digest(uploaded_file) -> str:
+    """アップロードされたファイルの内容のハッシュ"""
+    return hashlib.sha256(uploaded_file.getvalue()).hexdigest()
+
+
+# CSV の読み込み・整形はファイル内容のハッシュごとに保持し、部門の選択を変えたときは再実行しない。
+# max_entries を超えると最も古く使われたものから破棄する。
+@st.cache_data(max_entries=16, show_spinner="CSVを読み込んでいます...")
+def load_master(digest: str, _uploaded_file):
+    from account_master import load_account_master
+    return load_account_master(_uploaded_file.getvalue())
+
+
+@st.cache_data(max_entries=16, show_spinner="CSVを読み込んでいます...")
+def load_suii(digest: str, _uploaded_file):
+    from freee_reader import read_suii_csv
+    return read_suii_csv(_uploaded_file.getvalue())
+
+
+# FinanceCube は読み取り専用のため、cache_resource で全セッション・再実行に同じものを返す
+# （cache_data のように再実行のたびに復元せず、部門のハッシュ（department_key）なども使い回す）。
+@st.cache_resource(max_entries=8, show_spinner="推移表を整形しています...")
+def load_inputs(digests: tuple, _kamoku_file, _before_file, _this_file):
+    from finance_utils import prepare_inputs
+    kamoku_digest, before_digest, this_digest = digests
+    return prepare_inputs(
+        load_master(kamoku_digest, _kamoku_file),
+        load_suii(this_digest, _this_file),
+        load_suii(before_digest, _before_file),
+    )
+
+
+# Excel・データ出力はバックグラウンドのジョブで作成し、作成中も画面を操作できるようにする。
+# ジョブは入力ファイルのハッシュ・選択部門・合算・種類ごとに全セッションで共有し、同じ出力を重複して作成しない。
+# セッションには押された作成ボタンのジョブ ID だけを保持する。
+EXPORT_POLL_SEC = 1.0
+
+
+def workbook_job(comparison, sheet_names, variant_key: str, cache_key: str):
+    """Excel（WorkbookFile）を作成するジョブの処理。同じ入力の Excel がディスクに保存されていれば読み込む。"""
+    def run(progress):
+        from excel_renderer import VARIANTS_BY_KEY, render_workbook_files
+        variants = [VARIANTS_BY_KEY[variant_key]]
+        return render_workbook_files(
+            comparison, sheet_names, variants, progress=progress, cache_key=cache_key
+        )[variant_key]
+    return run
+
+
+def table_job(comparison, fmt: str):
+    """Parquet・Arrow・CSV のバイト列を作成するジョブの処理"""
+    def run(progress):
+        from table_export import export_bytes
+        progress(0, 1)
+        data = export_bytes(comparison, fmt)
+        progress(1, 1)
+        return data
+    return run
+
+
+def session_jobs(input_key: tuple) -> dict:
+    """このセッションで作成ボタンが押された、現在の入力のジョブ（request_key → ExportJob）"""
+    from export_jobs import export_jobs
+    ids = st.session_state.get("export_jobs", {})
+    jobs = {}
+    for request_key, job_id in ids.items():
+        job = export_jobs.get(job_id)
+        if request_key[0] == input_key and job is not None:
+            jobs[request_key] = job
+    st.session_state["export_jobs"] = {k: job.id for k, job in jobs.items()}
+    return jobs
+
+
+def export_control(request_key: tuple, build_label: str, make_job, download: dict) -> None:
+    """作成ボタン、作成中の進み具合と取消ボタン、作成後のダウンロードボタンのいずれかを表示する。"""
+    from export_jobs import CANCELLED, DONE, FAILED, export_jobs
+    job = session_jobs(request_key[0]).get(request_key)
+    if job is None or job.status == CANCELLED:
+        if st.button(build_label, key=f"build_{request_key[1]}"):
+            job = export_jobs.submit(request_key, make_job())
+            st.session_state["export_jobs"][request_key] = job.id
+            st.rerun()  # 作成中の表示の自動更新を始める
+        return
+    if job.status == DONE:
+        st.download_button(data=job.result_bytes(), key=f"download_{request_key[1]}", on_click="ignore", **download)
+    elif job.status == FAILED:
+        st.error(f"{build_label}に失敗しました: {job.error}")
+        if st.button("再作成", key=f"retry_{request_key[1]}"):
+            job = export_jobs.submit(request_key, make_job())
+            st.session_state["export_jobs"][request_key] = job.id
+            st.rerun()
+    else:
+        done, total = job.progress
+        st.progress(job.fraction, text=f"{build_label}中... {done} / {total}")
+        if st.button("取消", key=f"cancel_{request_key[1]}"):
+            # 同じ出力を他のセッションも待っていれば、このセッションだけ待つのをやめる
+            export_jobs.release(job)
+            del st.session_state["export_jobs"][request_key]
+            st.rerun()
+
+
+def export_section(input_key: tuple, comparison, sheet_names, polling: bool) -> None:
+    """Excel・データ出力の作成ボタンとダウンロードボタン。作成中のジョブがあれば一定間隔で再表示する。"""
+    from excel_renderer import VARIANTS, XLSX_MIME
+    from result_store import result_key
+    from table_export import available_formats
+
+    cache_key = result_key(*input_key)
+    for variant in VARIANTS:
+        export_control(
+            (input_key, variant.key), variant.build_label,
+            lambda v=variant: workbook_job(comparison, sheet_names, v.key, cache_key),
+            dict(label=variant.label, file_name=variant.file_name, mime=XLSX_MIME),
+        )
+
+    # BI ツールなどに読み込む比較表（部門・勘定科目はカテゴリ型、金額は数値型）
+    st.subheader('データ出力')
+    for fmt in available_formats():
+        export_control(
+            (input_key, f"table_{fmt.key}"), f"{fmt.extension[1:].upper()} を作成",
+            lambda f=fmt: table_job(comparison, f.key),
+            dict(label=fmt.label, file_name=f"2期比較表{fmt.extension}", mime=fmt.mime),
+        )
+
+    running = any(not job.finished for job in session_jobs(input_key).values())
+    if polling and not running:
+        st.rerun()  # 全て作成し終えたら自動更新をやめる
+
+
+# st.image はこの幅より大きい画像を表示のたびに縮小・PNG に再変換するため、
+# 説明用の画像はプロセスごとに1度だけ縮小した PNG を作り、全てのセッション・再実行で使い回す。
+IMAGE_MAX_WIDTH = 1460
+
+
+@st.cache_resource(show_spinner=False)
+def tutorial_image(file_name: str) -> bytes:
+    from io import BytesIO
+    from PIL import Image
+    image = Image.open(file_name)
+    if image.width > IMAGE_MAX_WIDTH:
+        height = int(1.0 * image.height * IMAGE_MAX_WIDTH / image.width)
+        image = image.resize((IMAGE_MAX_WIDTH, height), resample=Image.BILINEAR)
+    output = BytesIO()
+    image.save(output, format="PNG")
+    return output.getvalue()
+
+
+def anomaly_rules_input():
+    """グレー表示する変動の大きい月の条件（anomaly.AnomalyRules）。0 の条件は判定しない。"""
+    from anomaly import ANOMALY_THRESHOLD, AnomalyRules
+    with st.expander('グレー表示する月（前期と比べて変動の大きい月）の条件'):
+        absolute = st.number_input(
+            "前年平均との差（円以上）", min_value=0, value=ANOMALY_THRESHOLD, step=10000, key="anomaly_absolute"
+        )
+        relative = st.number_input(
+            "前年平均との差の割合（%以上、差の金額と両方を満たす月）", min_value=0.0, value=0.0, step=10.0,
+            key="anomaly_relative",
+        )
+        zscore = st.number_input(
+            "前期の月の金額の分布に対する z スコア（以上）", min_value=0.0, value=0.0, step=0.5, key="anomaly_zscore"
+        )
+        window = st.number_input(
+            "z スコアに使う前期の月数（0 で前期の全ての月）", min_value=0, max_value=12, value=0, key="anomaly_window"
+        )
+        month_over_month = st.number_input(
+            "前月との差（円以上）", min_value=0, value=0, step=10000, key="anomaly_mom"
+        )
+    return AnomalyRules(
+        absolute=absolute or None,
+        relative=relative / 100 or None,
+        zscore=zscore or None,
+        window=window or None,
+        month_over_month=month_over_month or None,
+    )
+
 
 st.subheader('部門別推移表変換 freee形式 to 財務R4形式')
 
+# 処理時間・メモリの記録（環境変数 FREEE_DIAGNOSTICS=1 で既定で有効）
+diagnostics_enabled = st.sidebar.checkbox(
+    "処理時間・メモリを記録する",
+    value=os.environ.get("FREEE_DIAGNOSTICS") == "1",
+)
+diag = diagnostics.begin(diagnostics_enabled)
+
 # freee側の設定
 with st.expander('freeeから勘定科目一覧(CSV)を出力する方法'):
-        st.image(image1, caption="「マスタ・口座」から「勘定科目」を選択してください。", use_container_width=True)
-        st.image(image2, caption="「エクスポート」から「勘定科目csvエクスポート」を選択してください。", use_container_width=True)
-        st.image(image3, caption="「ショートカット2」に必ず勘定科目コードを設定してください。", use_container_width=True)
+        st.image(tutorial_image("image1.png"), caption="「マスタ・口座」から「勘定科目」を選択してください。", use_container_width=True)
+        st.image(tutorial_image("image2.png"), caption="「エクスポート」から「勘定科目csvエクスポート」を選択してください。", use_container_width=True)
+        st.image(tutorial_image("image3.png"), caption="「ショートカット2」に必ず勘定科目コードを設定してください。", use_container_width=True)
         
 with st.expander('freeeから推移表(CSV)を出力する方法'):
-        st.image(image4, caption="「マスタ・口座」から「勘定科目」を選択してください。", use_container_width=True)
-        st.image(image5, caption="「エクスポート」から「勘定科目csvエクスポート」を選択してください。", use_container_width=True)
-        st.image(image6, caption="「ショートカット2」に必ず勘定科目コードを設定してください。", use_container_width=True)
+        st.image(tutorial_image("image4.png"), caption="「マスタ・口座」から「勘定科目」を選択してください。", use_container_width=True)
+        st.image(tutorial_image("image5.png"), caption="「エクスポート」から「勘定科目csvエクスポート」を選択してください。", use_container_width=True)
+        st.image(tutorial_image("image6.png"), caption="「ショートカット2」に必ず勘定科目コードを設定してください。", use_container_width=True)
 
 # ファイルアップロード
 freee_kamoku_file = st.file_uploader("freeeから出力した勘定科目一覧(CSV)をアップロードしてください。")
 freee_before_file = st.file_uploader("freeeから出力した前期の推移表(CSV)をアップロードしてください。")
 freee_this_file   = st.file_uploader("freeeから出力した今期の推移表(CSV)をアップロードしてください。")
 
-if freee_kamoku_file:
-    kamoku_df = pd.read_csv(freee_kamoku_file, encoding="cp932", header=0)
-
-    if '勘定科目コード' not in kamoku_df.columns and 'ショートカット2' in kamoku_df.columns:
-        kamoku_df.rename(columns={'ショートカット2': '勘定科目コード'}, inplace=True)
-        with st.expander('勘定科目一覧を表示する。'):
-            st.dataframe(kamoku_df)
-    else:         
-        with st.expander('勘定科目一覧を表示する。'):
-            st.dataframe(kamoku_df)
-    this_df = pd.read_csv(freee_this_file, encoding="cp932", header=1)
-    this_df.rename(columns={this_df.columns[1]: "勘定科目"}, inplace=True)
-    this_df = this_df[this_df['勘定科目'] != '当期商品仕入']
-    if '部門' not in this_df.columns:
-        this_df.insert(2, '部門', '')  # 3列目（0始まり）に空の「部門」列を追加
-
-    if {"勘定科目コード","部門"}.issubset(this_df.columns):
-        m1 = this_df["勘定科目コード"].notna() & this_df["部門"].isna()
-        m2 = this_df["勘定科目コード"].isna()  & this_df["部門"].isna()
-        this_df.loc[m1, "部門"] = "合計"
-        this_df.loc[m2, "部門"] = "集計科目"
-    if "期間累計" in this_df.columns:
-        cols = list(this_df.columns)
-        cols.remove("期間累計")
-        cols.insert(3, "期間累計")
-        this_df = this_df[cols]
-    this_df.rename(columns={"期間累計": "今期累計"}, inplace=True)
-    this_df.insert(3, "前期累計", 0)
-    this_df.insert(5, "増減", 0)
-    this_df["今期累計"] = pd.to_numeric(this_df["今期累計"], errors="coerce").fillna(0)
-    this_df = this_df.merge(kamoku_df[["勘定科目","小分類"]], on="勘定科目", how="left")
-
-    excl = {"勘定科目","勘定科目コード","部門","前期累計","増減","今期累計","小分類"}
-    elapsed_months = len([c for c in this_df.columns if c not in excl])
-
-    before_df = pd.read_csv(freee_before_file, encoding="cp932", header=1)
-    before_df.rename(columns={before_df.columns[1]: "勘定科目"}, inplace=True)
-    before_df = before_df[this_df['勘定科目'] != '当期商品仕入']
-    if '部門' not in before_df.columns:
-        before_df.insert(2, '部門', '')  # 3列目（0始まり）に空の「部門」列を追加
-        
-    if {"勘定科目コード","部門"}.issubset(before_df.columns):
-        m1 = before_df["勘定科目コード"].notna() & before_df["部門"].isna()
-        m2 = before_df["勘定科目コード"].isna()  & before_df["部門"].isna()
-        before_df.loc[m1, "部門"] = "合計"
-        before_df.loc[m2, "部門"] = "集計科目"
-    if "期間累計" in before_df.columns:
-        cols = list(before_df.columns)
-        cols.remove("期間累計")
-        cols.insert(3, "期間累計")
-        before_df = before_df[cols].rename(columns={"期間累計": "前期累計"})
-    else:
-        before_df["前期累計"] = 0
-    before_df = before_df.merge(kamoku_df[["勘定科目","小分類"]], on="勘定科目", how="left")
-
-    monthly_cols = [
-        c for c in before_df.columns
-        if c not in {"勘定科目","勘定科目コード","部門","前期累計","小分類"}
-    ][:elapsed_months]
-
-    before_df["前期累計"] = (
-        before_df[monthly_cols].replace({',':''}, regex=True)
-        .apply(pd.to_numeric, errors="coerce").sum(axis=1)
-    )
-
-    before_df["平均"] = (
-        before_df[monthly_cols].replace({',': ''}, regex=True)
-        .apply(pd.to_numeric, errors="coerce").mean(axis=1)
-        .apply(np.floor).fillna(0).astype(int)
-    )
-
-    all_kamoku = kamoku_df[["勘定科目コード", "勘定科目", "小分類"]].drop_duplicates()
-    all_depts = pd.concat([this_df["部門"], before_df["部門"]]).dropna().unique()
-    dept_df = pd.DataFrame(all_depts, columns=["部門"])
-    all_combos = all_kamoku.merge(dept_df, how="cross")
-    this_df = all_combos.merge(this_df, on=["勘定科目コード", "勘定科目", "小分類", "部門"], how="left")
-    before_df = all_combos.merge(before_df, on=["勘定科目コード", "勘定科目", "小分類", "部門"], how="left")
-
-    for df in [this_df, before_df]:
-        for col in df.columns:
-            if col not in ["勘定科目コード", "勘定科目", "小分類", "部門"] and df[col].dtype.kind in "fi":
-                df[col] = df[col].fillna(0)
+if freee_kamoku_file and freee_before_file and freee_this_file:
+    import pandas as pd
+    from finance_utils import build_comparison, build_rollups, parse_department_groups, prior_entries_frame
+    pd.options.display.float_format = '{:,.0f}'.format
+
+    with stage("file_digest"):
+        kamoku_digest = file_digest(freee_kamoku_file)
+        before_digest = file_digest(freee_before_file)
+        this_digest = file_digest(freee_this_file)
+    with stage("load_master") as s:
+        master = load_master(kamoku_digest, freee_kamoku_file)
+        s.rows = len(master)
+    with st.expander('勘定科目一覧を表示する。'):
+        st.dataframe(master.accounts)
+
+    with stage("load_inputs") as s:
+        this_cube, before_cube = load_inputs(
+            (kamoku_digest, before_digest, this_digest),
+            freee_kamoku_file, freee_before_file, freee_this_file
+        )
+        s.rows = len(this_cube.values) + len(before_cube.values)
 
     st.subheader('前期推移表プレビュー')
-    st.dataframe(before_df)
+    with stage("preview_before"):
+        st.dataframe(prior_entries_frame(this_cube, before_cube))
 
-    depts = pd.concat([this_df["部門"], before_df["部門"]]).dropna().unique().tolist()
+    depts = this_cube.departments
     default = [d for d in depts if d != "集計科目"]
     selected = st.multiselect(
         "表示する部門を選択してください（デフォルトは『集計科目』以外）",
         options=depts, default=default
     )
 
+    # 部門の合算（合計の P/L をシート・行として追加する）
+    groups_text = st.text_area(
+        "部門の合算（任意）: 1行に「合算名: 部門, 部門, ...」。合算名を部門として書くと入れ子にできます。",
+        value="", key="department_groups",
+    )
+    try:
+        groups = parse_department_groups(groups_text)
+    except ValueError as e:
+        st.error(str(e))
+        groups = []
+    try:
+        rules = anomaly_rules_input()
+    except ValueError as e:
+        from anomaly import DEFAULT_RULES
+        st.error(str(e))
+        rules = DEFAULT_RULES
+
     if selected:
-        prior_parts = []
-        for dept in selected:
-            df_b = before_df[before_df["部門"] == dept].copy()
-            df_b = insert_summary_rows(df_b, dept)
-            df_b = calculate_financials(df_b)
-            cols_b = [
-                c for c in df_b.columns
-                if c not in {"勘定科目","勘定科目コード","部門","小分類","前期累計","増減"}
-            ][:elapsed_months]
-            df_b["前期累計"] = df_b[cols_b].sum(axis=1)
-            prior_parts.append(df_b[["勘定科目","部門","前期累計"]])
-        prior_df_lookup = pd.concat(prior_parts).drop_duplicates()
-
-        dfs = []
-        for dept in selected:
-            df_t = this_df[this_df["部門"] == dept].copy()
-            df_t = insert_summary_rows(df_t, dept)
-            df_t = calculate_financials(df_t)
-            df_t.drop(columns=["前期累計"], inplace=True)
-            df_t = df_t.merge(prior_df_lookup, on=["勘定科目","部門"], how="left")
-            df_t["前期累計"] = df_t["前期累計"].fillna(0)
-            df_t["増減"]     = df_t["今期累計"] - df_t["前期累計"]
-            dfs.append(df_t)
-
-        final_df = pd.concat(dfs, ignore_index=True)
-        cols = final_df.columns.tolist()
-        if "前期累計" in cols:
-            cols.remove("前期累計")
-            cols.insert(3, "前期累計")
-            final_df = final_df[cols]
-
-        avg_df = before_df[["勘定科目", "部門", "平均"]].copy()
-        avg_df.rename(columns={"平均": "前年平均"}, inplace=True)
-        final_df = final_df.merge(avg_df, on=["勘定科目", "部門"], how="left")
+        with stage("build_comparison") as s:
+            comparison = build_comparison(this_cube, before_cube, selected, rules)
+            s.rows = len(comparison.final_df)
+        if groups:
+            try:
+                with stage("build_rollups") as s:
+                    comparison = comparison.extend(build_rollups(this_cube, before_cube, groups, rules))
+                    s.rows = len(comparison.final_df)
+            except ValueError as e:
+                st.error(str(e))
+                groups = []
+        final_df = comparison.final_df
+        sheet_names = list(comparison.partitions)  # 選択部門の後に合算
 
         st.subheader('今期推移表プレビュー')
-        st.dataframe(final_df)
-
-        output = BytesIO()
-        with pd.ExcelWriter(output, engine="xlsxwriter") as writer:
-            wb = writer.book
-            num_fmt        = wb.add_format({'num_format': '#,##0', 'border': 1})
-            border_fmt     = wb.add_format({'border': 1})
-            gray_fmt       = wb.add_format({'bg_color': '#D9D9D9', 'border': 1, 'num_format': '#,##0'})
-            highlight_fmt  = wb.add_format({'bg_color': '#C6EFCE', 'bold': True, 'border': 1})
-            highlight_num  = wb.add_format({'bg_color': '#C6EFCE', 'bold': True, 'border': 1, 'num_format': '#,##0'})
-            average_fmt    = wb.add_format({'bold': True, 'border': 1, 'bg_color': '#FFFFCC', 'num_format': '#,##0'})
-            title_fmt      = wb.add_format({'align': 'center', 'valign': 'vcenter', 'bold': True, 'font_size': 28})
-
-            highlights = [
-                "純売上高", "純仕入高", "売上原価", "売上総利益", "人件費合計", "販売費及び一般管理費",
-                "営業利益", "営業外収益合計", "営業外費用合計", "経常利益",
-                "特別利益合計", "特別損失合計", "税引前当期純利益",
-                "法人税・住民税・事業税", "税引後当期純利益"
-            ]
-
-            for dept in selected:
-                df = final_df[final_df["部門"] == dept].copy()
-                df = df.drop(columns=['勘定科目コード', '部門', '小分類'], errors='ignore')
-                cols = df.columns.tolist()
-                if "前期累計" in cols:
-                    cols.remove("前期累計")
-                    cols.insert(1, "前期累計")
-                    df = df[cols]
-
-                sheet = dept[:31].replace('/', '_').replace('\\', '_')
-                ws = writer.book.add_worksheet(sheet)
-                writer.sheets[sheet] = ws
-                startrow = 2
-                col_names = df.columns.tolist()
-                last_col = len(col_names) - 1
-                ws.set_row(0, 30)
-                ws.merge_range(0, 0, 0, last_col, '2 期 比 較 推 移表', title_fmt)
-                ws.write(1, 0, dept)
-                for col_idx, col in enumerate(col_names):
-                    fmt = average_fmt if col == "前年平均" else border_fmt
-                    ws.write(startrow, col_idx, col, fmt)
-
-                for row_idx, (_, row) in enumerate(df.iterrows(), start=startrow + 1):
-                    is_highlight = row.iloc[0] in highlights
-                    avg_val = row.get("前年平均", None)
-                    for col_idx, val in enumerate(row):
-                        col_name = col_names[col_idx]
-                        if is_highlight:
-                            if col_name == "前年平均":
-                                fmt = average_fmt
-                            elif pd.isna(val):
-                                fmt = highlight_fmt
-                            elif isinstance(val, (int, float)):
-                                fmt = highlight_num
-                            else:
-                                fmt = highlight_fmt
-                        elif col_idx >= 4 and col_name != "前年平均" and pd.notna(val) and pd.notna(avg_val):
-                            if abs(val - avg_val) >= 300000:
-                                fmt = gray_fmt
-                            else:
-                                fmt = num_fmt
-                        elif col_name == "前年平均":
-                            fmt = average_fmt
-                        elif pd.isna(val):
-                            fmt = border_fmt
-                        elif isinstance(val, (int, float)):
-                            fmt = num_fmt
-                        else:
-                            fmt = border_fmt
-                        if pd.isna(val):
-                            ws.write_blank(row_idx, col_idx, None, fmt)
-                        else:
-                            ws.write(row_idx, col_idx, val, fmt)
-
-                ws.set_default_row(25)
-                ws.set_column('A:A', 25)
-                ws.set_column('B:Z', 15)
-
-        output.seek(0)
-        st.download_button(
-            label="Excel(円単位)をダウンロード",
-            data=output,
-            file_name="部門別推移表(円単位).xlsx",
-            mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"
+        with stage("preview_comparison"):
+            st.dataframe(final_df)
+        # Excel でグレー表示するセルの一覧（セルごとの色付けは Styler の変換が遅いため一覧で表示する）
+        if comparison.anomalies is not None and comparison.anomalies.count:
+            with st.expander(f'グレー表示する月（{comparison.anomalies.count} 件）'):
+                with stage("preview_anomalies", rows=comparison.anomalies.count):
+                    st.dataframe(comparison.anomalies.cells(final_df), hide_index=True)
+
+        # Excel・データ出力は作成ボタンが押された種類だけ、バックグラウンドで作成する
+        input_key = (kamoku_digest, before_digest, this_digest, tuple(selected), tuple(groups), rules)
+        polling = any(not job.finished for job in session_jobs(input_key).values())
+        st.fragment(export_section, run_every=EXPORT_POLL_SEC if polling else None)(
+            input_key, comparison, sheet_names, polling
         )
 
-    # Excel出力
-    output = BytesIO()
-    with pd.ExcelWriter(output, engine="xlsxwriter") as writer:
-        wb = writer.book
-
-        # フォーマット（千円単位表示に変更）
-        num_fmt        = wb.add_format({'num_format': '#,##0,', 'border': 1})
-        border_fmt     = wb.add_format({'border': 1})
-        gray_fmt       = wb.add_format({'bg_color': '#D9D9D9', 'border': 1, 'num_format': '#,##0,'})
-        highlight_fmt  = wb.add_format({'bg_color': '#C6EFCE', 'bold': True, 'border': 1})
-        highlight_num  = wb.add_format({'bg_color': '#C6EFCE', 'bold': True, 'border': 1, 'num_format': '#,##0,'})
-        average_fmt    = wb.add_format({'bold': True, 'border': 1, 'bg_color': '#FFFFCC', 'num_format': '#,##0,'})
-        title_fmt      = wb.add_format({'align': 'center', 'valign': 'vcenter', 'bold': True, 'font_size': 28})
-
-        highlights = [
-            "純売上高", "純仕入高", "売上原価", "売上総利益", "人件費合計", "販売費及び一般管理費",
-            "営業利益", "営業外収益合計", "営業外費用合計", "経常利益",
-            "特別利益合計", "特別損失合計", "税引前当期純利益",
-            "法人税・住民税・事業税", "税引後当期純利益"
-        ]
-
-        for dept in selected:
-            df = final_df[final_df["部門"] == dept].copy()
-            df = df.drop(columns=['勘定科目コード', '部門', '小分類'], errors='ignore')
-            cols = df.columns.tolist()
-            if "前期累計" in cols:
-                cols.remove("前期累計")
-                cols.insert(1, "前期累計")
-                df = df[cols]
-
-            sheet = dept[:31].replace('/', '_').replace('\\', '_')
-            ws = writer.book.add_worksheet(sheet)
-            writer.sheets[sheet] = ws
-            startrow = 2
-            col_names = df.columns.tolist()
-            last_col = len(col_names) - 1
-            ws.set_row(0, 30)
-
-            # タイトル
-            ws.merge_range(0, 0, 0, last_col, '2 期 比 較 推 移 表', title_fmt)
-            ws.write(1, 0, dept + "　※ 単位：千円")
-
-            # ヘッダー
-            for col_idx, col in enumerate(col_names):
-                fmt = average_fmt if col == "前年平均" else border_fmt
-                ws.write(startrow, col_idx, col, fmt)
-
-            # データ行
-            for row_idx, (_, row) in enumerate(df.iterrows(), start=startrow + 1):
-                is_highlight = row.iloc[0] in highlights
-                avg_val = row.get("前年平均", None)
-
-                # 金額列だけ抽出（通常は4列目以降）
-                value_cols = row.iloc[4:]
-                is_all_zero_or_blank = not is_highlight and value_cols.apply(lambda x: pd.isna(x) or x == 0).all()
-
-                # 非表示行の場合、set_rowで行自体に設定
-                if is_all_zero_or_blank:
-                    ws.set_row(row_idx, options={'hidden': True})
-                else:
-                    ws.set_row(row_idx, 25)  # 通常行の高さ指定
-
-                for col_idx, val in enumerate(row):
-                    col_name = col_names[col_idx]
-                    if is_highlight:
-                        if col_name == "前年平均":
-                            fmt = average_fmt
-                        elif pd.isna(val):
-                            fmt = highlight_fmt
-                        elif isinstance(val, (int, float)):
-                            fmt = highlight_num
-                        else:
-                            fmt = highlight_fmt
-                    elif col_idx >= 4 and col_name != "前年平均" and pd.notna(val) and pd.notna(avg_val):
-                        if abs(val - avg_val) >= 300000:
-                            fmt = gray_fmt
-                        else:
-                            fmt = num_fmt
-                    elif col_name == "前年平均":
-                        fmt = average_fmt
-                    elif pd.isna(val):
-                        fmt = border_fmt
-                    elif isinstance(val, (int, float)):
-                        fmt = num_fmt
-                    else:
-                        fmt = border_fmt
-
-                    if pd.isna(val):
-                        ws.write_blank(row_idx, col_idx, None, fmt)
-                    else:
-                        ws.write(row_idx, col_idx, val, fmt)
-
-
-
-            # レイアウト調整
-            ws.set_default_row(25)
-            ws.set_column('A:A', 25)
-            ws.set_column('B:Z', 12)
-
-    output.seek(0)
-    st.download_button(
-        label="Excel(千円単位)をダウンロード",
-        data=output,
-        file_name="部門別推移表(千円単位).xlsx",
-        mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"
-    )
-
-    # Excel出力
-    output = BytesIO()
-    with pd.ExcelWriter(output, engine="xlsxwriter") as writer:
-        wb = writer.book
-
-        # フォーマット（千円単位表示に変更）
-        num_fmt        = wb.add_format({'num_format': '#,##0,', 'border': 1})
-        border_fmt     = wb.add_format({'border': 1})
-        highlight_fmt  = wb.add_format({'bg_color': '#C6EFCE', 'bold': True, 'border': 1})
-        highlight_num  = wb.add_format({'bg_color': '#C6EFCE', 'bold': True, 'border': 1, 'num_format': '#,##0,'})
-        title_fmt      = wb.add_format({'align': 'center', 'valign': 'vcenter', 'bold': True, 'font_size': 28})
-        subtitle_fmt  = wb.add_format({'bold': True, 'font_size': 14})
-
-        highlights = [
-            "純売上高", "純仕入高", "売上原価", "売上総利益", "人件費合計", "販売費及び一般管理費",
-            "営業利益", "営業外収益合計", "営業外費用合計", "経常利益",
-            "特別利益合計", "特別損失合計", "税引前当期純利益",
-            "法人税・住民税・事業税", "税引後当期純利益"
-        ]
-
-        for dept in selected:
-            df = final_df[final_df["部門"] == dept].copy()
-            df = df.drop(columns=['勘定科目コード', '部門', '小分類', '前年平均'], errors='ignore')
-            sheet = dept[:31].replace('/', '_').replace('\\', '_')
-            ws = writer.book.add_worksheet(sheet)
-            writer.sheets[sheet] = ws
-            startrow = 2
-            col_names = df.columns.tolist()
-            last_col = len(col_names) - 1
-            ws.set_row(0, 30)
-
-            # タイトル
-            ws.merge_range(0, 0, 0, last_col, '2 期 比 較 推 移 表', title_fmt)
-            ws.write(1, 0, dept + "　※ 単位：千円", subtitle_fmt)
-
-            # ヘッダー
-            for col_idx, col in enumerate(col_names):
-                ws.write(startrow, col_idx, col, border_fmt)
-
-            # データ行
-            for row_idx, (_, row) in enumerate(df.iterrows(), start=startrow + 1):
-                is_highlight = row.iloc[0] in highlights
-
-                # 金額列だけ抽出（通常は4列目以降）
-                value_cols = row.iloc[4:]
-                is_all_zero_or_blank = not is_highlight and value_cols.apply(lambda x: pd.isna(x) or x == 0).all()
-
-                # 非表示設定または通常行設定
-                if is_all_zero_or_blank:
-                    ws.set_row(row_idx, options={'hidden': True})
-                else:
-                    ws.set_row(row_idx, 25)
-
-                for col_idx, val in enumerate(row):
-                    if is_highlight:
-                        if pd.isna(val):
-                            fmt = highlight_fmt
-                        elif isinstance(val, (int, float)):
-                            fmt = highlight_num
-                        else:
-                            fmt = highlight_fmt
-                    elif pd.isna(val):
-                        fmt = border_fmt
-                    elif isinstance(val, (int, float)):
-                        fmt = num_fmt
-                    else:
-                        fmt = border_fmt
-
-                    if pd.isna(val):
-                        ws.write_blank(row_idx, col_idx, None, fmt)
-                    else:
-                        ws.write(row_idx, col_idx, val, fmt)
-
-            # レイアウト調整
-            ws.set_default_row(25)
-            ws.set_column('A:A', 25)
-            ws.set_column('B:Z', 12)
-
-    output.seek(0)
-    st.download_button(
-        label="通常) Excel(千円単位)をダウンロード",
-        data=output,
-        file_name="部門別推移表(千円単位).xlsx",
-        mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"
-    )
+diagnostics.end(diag)
+if diag is not None:
+    with st.expander('診断情報（処理時間・メモリ）'):
+        st.caption(f"実行ID: {diag.run_id}　キャッシュ済みの処理は内部の段階が記録されません。")
+        st.dataframe(diag.to_frame())
+        # Excel・データ出力の作成ジョブはバックグラウンドのスレッドで実行されるため、ジョブごとに記録する
+        from export_jobs import export_jobs
+        for request_key, job_id in st.session_state.get("export_jobs", {}).items():
+            job = export_jobs.get(job_id)
+            if job is not None and job.diagnostics is not None:
+                st.caption(f"作成ジョブ {request_key[1]}（実行ID: {job.diagnostics.run_id}、{job.status}）")
+                st.dataframe(job.diagnostics.to_frame())
@@ -0,0 +1,203 @@
+"""
+計算結果・作成した Excel をディスクに保存し、サーバーの再起動後や翌月の実行でも使い回すキャッシュ。
+
+保存先は FREEE_CACHE_DIR（既定は ~/.cache/for_freee）の results/results.sqlite です。
+結果は入力の内容のハッシュと CODE_VERSION（計算・出力に関わるモジュールのソースのハッシュ）ごとに保存するため、
+コードを変更すると古い結果は使われず、期限・容量の上限によって削除されます。
+
+    stored = result_store.get_arrays("department", keys)   # key → 配列（保存されているものだけ）
+    result_store.put_arrays("department", {key: block})
+"""
+import hashlib
+import os
+import sqlite3
+import time
+from pathlib import Path
+from typing import Dict, Mapping, Optional, Sequence, Tuple
+
+import numpy as np
+
+from account_master import CACHE_DIR
+
+# 保存する結果の合計サイズの上限（環境変数 FREEE_RESULT_CACHE_MB で変更、0 で保存しない）
+RESULT_CACHE_MB = float(os.environ.get("FREEE_RESULT_CACHE_MB", 1024))
+# 最後に使われてからこの日数を過ぎた結果は削除する（環境変数 FREEE_RESULT_CACHE_DAYS で変更）
+RESULT_CACHE_DAYS = float(os.environ.get("FREEE_RESULT_CACHE_DAYS", 90))
+
+# 計算・出力の結果に関わるモジュール。いずれかのソースが変わると CODE_VERSION が変わる
+VERSIONED_MODULES = (
+    "account_master.py",
+    "freee_reader.py",
+    "fiscal_period.py",
+    "anomaly.py",
+    "finance_utils.py",
+    "excel_renderer.py",
+)
+
+# SQLite の1回の問い合わせに渡すキーの数
+_QUERY_CHUNK = 500
+
+
+def code_version() -> str:
+    """VERSIONED_MODULES のソースのハッシュ"""
+    h = hashlib.blake2b(digest_size=8)
+    for name in VERSIONED_MODULES:
+        h.update(name.encode())
+        try:
+            h.update(Path(__file__).with_name(name).read_bytes())
+        except OSError:
+            pass
+    return h.hexdigest()
+
+
+CODE_VERSION = code_version()
+
+
+def result_key(*parts) -> str:
+    """入力のハッシュ・選択部門などからキーを作る（parts は repr が内容で決まるもの）"""
+    return hashlib.blake2b(repr(parts).encode("utf-8"), digest_size=16).hexdigest()
+
+
+class ResultStore:
+    """
+    種類（kind）・キー → バイト列 を SQLite に保存する。
+    合計サイズが max_bytes を超えると最も古く使われたものから、max_age_days を過ぎて使われていないものは
+    保存のたびに削除する。一括変換の複数のプロセス・画面の複数のスレッドから使えるよう、操作ごとに接続する。
+    保存先に書き込めない・ファイルが壊れている場合は、保存されていないものとして動作する。
+    """
+
+    def __init__(
+        self,
+        directory: Path,
+        max_bytes: int = int(RESULT_CACHE_MB * 1024 * 1024),
+        max_age_days: float = RESULT_CACHE_DAYS,
+        version: str = CODE_VERSION,
+    ):
+        self.directory = Path(directory)
+        self.max_bytes = max_bytes
+        self.max_age_days = max_age_days
+        self.version = version
+        self.hits = 0
+        self.misses = 0
+
+    @property
+    def path(self) -> Path:
+        return self.directory / "results.sqlite"
+
+    @property
+    def enabled(self) -> bool:
+        return self.max_bytes > 0
+
+    def _connect(self) -> sqlite3.Connection:
+        self.directory.mkdir(parents=True, exist_ok=True)
+        conn = sqlite3.connect(str(self.path), timeout=30)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS results ("
+            " kind TEXT NOT NULL, key TEXT NOT NULL, version TEXT NOT NULL,"
+            " size INTEGER NOT NULL, created REAL NOT NULL, accessed REAL NOT NULL, data BLOB NOT NULL,"
+            " PRIMARY KEY (kind, key, version))"
+        )
+        conn.execute("CREATE INDEX IF NOT EXISTS results_accessed ON results (accessed)")
+        return conn
+
+    def get_many(self, kind: str, keys: Sequence[str]) -> Dict[str, bytes]:
+        """keys のうち保存されているものの key → バイト列"""
+        if not self.enabled or not keys:
+            return {}
+        found: Dict[str, bytes] = {}
+        try:
+            conn = self._connect()
+            try:
+                with conn:
+                    for i in range(0, len(keys), _QUERY_CHUNK):
+                        chunk = list(keys[i:i + _QUERY_CHUNK])
+                        marks = ",".join("?" * len(chunk))
+                        params = [kind, self.version, *chunk]
+                        rows = conn.execute(
+                            f"SELECT key, data FROM results WHERE kind = ? AND version = ? AND key IN ({marks})",
+                            params,
+                        ).fetchall()
+                        found.update(rows)
+                        conn.execute(
+                            f"UPDATE results SET accessed = ? WHERE kind = ? AND version = ? AND key IN ({marks})",
+                            [time.time(), *params],
+                        )
+            finally:
+                conn.close()
+        except (sqlite3.Error, OSError):
+            return {}
+        self.hits += len(found)
+        self.misses += len(keys) - len(found)
+        return found
+
+    def put_many(self, kind: str, items: Mapping[str, bytes]) -> None:
+        """key → バイト列 を保存し、期限・容量の上限を超えた結果を削除する。"""
+        items = {key: data for key, data in items.items() if len(data) <= self.max_bytes}
+        if not self.enabled or not items:
+            return
+        now = time.time()
+        try:
+            conn = self._connect()
+            try:
+                with conn:
+                    conn.executemany(
+                        "INSERT OR REPLACE INTO results VALUES (?, ?, ?, ?, ?, ?, ?)",
+                        [(kind, key, self.version, len(data), now, now, data) for key, data in items.items()],
+                    )
+                    self._evict(conn, now)
+            finally:
+                conn.close()
+        except (sqlite3.Error, OSError):
+            pass
+
+    def _evict(self, conn: sqlite3.Connection, now: float) -> None:
+        conn.execute("DELETE FROM results WHERE accessed < ?", (now - self.max_age_days * 86400,))
+        total = conn.execute("SELECT COALESCE(SUM(size), 0) FROM results").fetchone()[0]
+        if total <= self.max_bytes:
+            return
+        expired = []
+        for rowid, size in conn.execute("SELECT rowid, size FROM results ORDER BY accessed"):
+            if total <= self.max_bytes:
+                break
+            expired.append((rowid,))
+            total -= size
+        conn.executemany("DELETE FROM results WHERE rowid = ?", expired)
+
+    def get(self, kind: str, key: str) -> Optional[bytes]:
+        return self.get_many(kind, [key]).get(key)
+
+    def put(self, kind: str, key: str, data: bytes) -> None:
+        self.put_many(kind, {key: data})
+
+    def get_arrays(self, kind: str, keys: Sequence[str], shape: Tuple[int, ...]) -> Dict[str, np.ndarray]:
+        """
+        keys のうち保存されている shape の float64 の配列の key → 配列（読み取り専用のビュー）。
+        大きさの合わないものは保存されていないものとして扱う。
+        """
+        size = int(np.prod(shape)) * 8
+        return {
+            key: np.frombuffer(data, dtype=np.float64).reshape(shape)
+            for key, data in self.get_many(kind, keys).items()
+            if len(data) == size
+        }
+
+    def put_arrays(self, kind: str, arrays: Mapping[str, np.ndarray]) -> None:
+        """float64 の配列を保存する（形は get_arrays で指定する）。"""
+        self.put_many(kind, {
+            key: np.ascontiguousarray(array, dtype=np.float64).tobytes() for key, array in arrays.items()
+        })
+
+    def clear(self) -> None:
+        try:
+            conn = self._connect()
+            try:
+                with conn:
+                    conn.execute("DELETE FROM results")
+            finally:
+                conn.close()
+        except (sqlite3.Error, OSError):
+            pass
+
+
+result_store = ResultStore(CACHE_DIR / "results")
@@ -0,0 +1,163 @@
+"""
+2期比較表（build_comparison の結果）を Parquet・Arrow IPC・CSV で出力します。
+
+    from table_export import export_comparison
+    export_comparison(comparison, "parquet", "比較表.parquet")
+
+部門・勘定科目・小分類はカテゴリ型（辞書型）、金額列は float64 で出力するので、
+xlsx を読み直すより速く、型を保ったまま読み込めます。Parquet・Arrow IPC には pyarrow が必要です。
+"""
+import csv
+import io
+from dataclasses import dataclass
+from pathlib import Path
+from typing import IO, Callable, Dict, Iterator, List, Optional, Union
+
+import pandas as pd
+
+from diagnostics import stage
+from finance_utils import Comparison
+
+try:
+    import pyarrow as pa
+    import pyarrow.ipc as paipc
+    import pyarrow.parquet as pq
+except ImportError:  # pyarrow がなければ CSV だけ出力できる
+    pa = None
+
+CATEGORY_COLUMNS = ["部門", "勘定科目", "小分類"]
+CSV_CHUNK_ROWS = 10_000
+
+Target = Union[str, Path, IO[bytes]]
+
+
+def comparison_table(comparison: Comparison) -> pd.DataFrame:
+    """
+    出力用の DataFrame。部門・勘定科目・小分類はカテゴリ型、
+    勘定科目コードは整数（欠損可）、それ以外の金額列は float64 にする。
+    """
+    df = comparison.final_df
+    out = {}
+    for col in df.columns:
+        values = df[col]
+        if col in CATEGORY_COLUMNS:
+            out[col] = values.astype(object).astype("category")
+        elif col == "勘定科目コード":
+            # 整数でないコードが混じる勘定科目一覧もあるため、そのときは文字列にする
+            numeric = pd.to_numeric(values, errors="coerce")
+            if numeric.notna().equals(values.notna()) and (numeric.dropna() % 1 == 0).all():
+                out[col] = numeric.astype("Int64")
+            else:
+                out[col] = values.astype("string")
+        else:
+            out[col] = pd.to_numeric(values, errors="coerce").astype("float64")
+    return pd.DataFrame(out, columns=df.columns)
+
+
+def to_arrow_table(comparison: Comparison) -> "pa.Table":
+    """カテゴリ列を辞書型にした Arrow のテーブル"""
+    if pa is None:
+        raise ImportError("Parquet・Arrow の出力には pyarrow が必要です")
+    return pa.Table.from_pandas(comparison_table(comparison), preserve_index=False)
+
+
+def _open(target: Target):
+    if isinstance(target, (str, Path)):
+        return open(target, "wb"), True
+    return target, False
+
+
+def write_parquet(comparison: Comparison, target: Target) -> None:
+    table = to_arrow_table(comparison)
+    f, should_close = _open(target)
+    try:
+        with stage("write_parquet", rows=table.num_rows):
+            pq.write_table(table, f)
+    finally:
+        if should_close:
+            f.close()
+
+
+def write_arrow_ipc(comparison: Comparison, target: Target) -> None:
+    """Arrow IPC（Feather v2）ファイル形式で書き込む。"""
+    table = to_arrow_table(comparison)
+    f, should_close = _open(target)
+    try:
+        with stage("write_arrow_ipc", rows=table.num_rows), paipc.new_file(f, table.schema) as writer:
+            writer.write_table(table)
+    finally:
+        if should_close:
+            f.close()
+
+
+def iter_csv(comparison: Comparison, chunk_rows: int = CSV_CHUNK_ROWS, bom: bool = False) -> Iterator[bytes]:
+    """UTF-8 の CSV を chunk_rows 行ずつのバイト列で返す（全体を1度に作らない）。"""
+    df = comparison.final_df
+    if bom:
+        yield "\ufeff".encode("utf-8")
+    for start in range(0, max(len(df), 1), chunk_rows):
+        buf = io.StringIO()
+        df.iloc[start:start + chunk_rows].to_csv(
+            buf, index=False, header=start == 0, lineterminator="\n", quoting=csv.QUOTE_MINIMAL
+        )
+        yield buf.getvalue().encode("utf-8")
+
+
+def write_csv(comparison: Comparison, target: Target, bom: bool = False) -> None:
+    f, should_close = _open(target)
+    try:
+        with stage("write_csv", rows=len(comparison.final_df)):
+            for chunk in iter_csv(comparison, bom=bom):
+                f.write(chunk)
+    finally:
+        if should_close:
+            f.close()
+
+
+@dataclass(frozen=True)
+class TableFormat:
+    """出力形式"""
+    key: str
+    label: str              # ダウンロードボタンの表示
+    extension: str
+    mime: str
+    write: Callable[[Comparison, Target], None]
+    requires_pyarrow: bool
+
+
+TABLE_FORMATS: List[TableFormat] = [
+    TableFormat("parquet", "Parquet をダウンロード", ".parquet", "application/vnd.apache.parquet", write_parquet, True),
+    TableFormat("arrow", "Arrow IPC をダウンロード", ".arrow", "application/vnd.apache.arrow.file", write_arrow_ipc, True),
+    TableFormat("csv", "CSV(UTF-8) をダウンロード", ".csv", "text/csv", write_csv, False),
+]
+
+TABLE_FORMATS_BY_KEY: Dict[str, TableFormat] = {f.key: f for f in TABLE_FORMATS}
+
+
+def available_formats() -> List[TableFormat]:
+    """この環境で出力できる形式（pyarrow がなければ CSV だけ）"""
+    return [f for f in TABLE_FORMATS if pa is not None or not f.requires_pyarrow]
+
+
+def export_comparison(comparison: Comparison, fmt: str, target: Target) -> None:
+    """比較表を fmt（"parquet" / "arrow" / "csv"）の形式で target（パスまたはファイル）に書き込む。"""
+    TABLE_FORMATS_BY_KEY[fmt].write(comparison, target)
+
+
+def export_bytes(comparison: Comparison, fmt: str) -> bytes:
+    """export_comparison の結果をバイト列で返す（ダウンロードボタン用）。"""
+    buf = io.BytesIO()
+    export_comparison(comparison, fmt, buf)
+    return buf.getvalue()
+
+
+def read_comparison(path: Union[str, Path], fmt: Optional[str] = None) -> pd.DataFrame:
+    """出力したファイルを読み込む（形式は拡張子から判断）。"""
+    path = Path(path)
+    fmt = fmt or {f.extension: f.key for f in TABLE_FORMATS}.get(path.suffix, "csv")
+    if fmt == "parquet":
+        return pd.read_parquet(path)
+    if fmt == "arrow":
+        with paipc.open_file(pa.memory_map(str(path))) as reader:
+            return reader.read_pandas()
+    return pd.read_csv(path, encoding="utf-8-sig")